@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 import os
+import sys
 from pathlib import Path
 print(os.environ.get('DJANGO_SETTINGS_MODULE'))
 
@@ -42,25 +43,34 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
 ASGI_APPLICATION = 'SmartCloud.asgi.application'  # Matches your project name
 
 # Channels settings
-# Use InMemoryChannelLayer for development; for production, consider using Redis or another backend.
-# For production, you would typically set up a Redis server and use 'channels_redis' as the backend.
-
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer",
-    },
-}
-
-"""
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
-        "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+# CHANNEL_LAYER_BACKEND=sqlite (default): queues and groups in a local SQLite file,
+# shared by every worker process on this host (see SmileHealth/channel_layers.py).
+# "memory" keeps everything in one process and only works with a single worker.
+CHANNEL_LAYER_BACKEND = os.getenv('CHANNEL_LAYER_BACKEND', 'sqlite').strip().lower()
+CHANNELS_DB_PATH = (SERVER_DATA_ROOT if USE_SERVER_PATHS else BASE_DIR) / 'channels.sqlite3'
+
+if CHANNEL_LAYER_BACKEND == 'memory':
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
         },
-    },
-}
-"""
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "SmileHealth.channel_layers.SQLiteChannelLayer",
+            "CONFIG": {
+                "path": str(CHANNELS_DB_PATH),
+                "expiry": 60,                       # seconds an undelivered message is kept
+                "capacity": 100,                    # per-channel queue limit for send()
+                # per-member limit applied by group_send()
+                "group_capacity": {"chat_*": 200, "groupchat_*": 200},
+            },
+        },
+    }
+
+# Read chat messages older than this move to ArchivedMessage (manage.py archive_messages)
+MESSAGE_RETENTION_DAYS = int(os.getenv('MESSAGE_RETENTION_DAYS', 365))
 
 
 # Quick-start development settings - unsuitable for production
@@ -108,6 +118,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'SmileHealth.middleware.ProfileMiddleware',  # lazy cached request.profile
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -145,6 +156,53 @@ DATABASES = {
 }
 
 
+# Cache
+# CACHE_BACKEND=tiered (default): per-process LRU in front of a file cache shared
+# by all worker processes on this host. "local" / "file" / "dummy" use one tier only.
+CACHE_DIR = SERVER_DATA_ROOT / 'cache' if USE_SERVER_PATHS else BASE_DIR / '.cache'
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'tiered').strip().lower()
+
+_SHARED_CACHE = {
+    'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+    'LOCATION': str(CACHE_DIR),
+    'TIMEOUT': 60 * 60,
+    'OPTIONS': {'MAX_ENTRIES': 20000, 'CULL_FREQUENCY': 4},
+}
+_CACHE_CHOICES = {
+    'tiered': {
+        'BACKEND': 'SmileHealth.cache_backends.TieredCache',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'SHARED': 'shared',
+            'LOCAL_MAX_BYTES': int(os.getenv('CACHE_LOCAL_MAX_BYTES', 32 * 1024 * 1024)),
+            'LOCAL_TIMEOUT': 60,
+        },
+    },
+    'local': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'file': _SHARED_CACHE,
+    'dummy': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+}
+CACHES = {
+    'default': _CACHE_CHOICES[CACHE_BACKEND],
+    'shared': _SHARED_CACHE,
+}
+
+# `manage.py test` must not flush the cache directory or write into the
+# channel database of the installation it runs on: in-process backends only.
+# Tests of TieredCache and SQLiteChannelLayer build them on temporary paths.
+TESTING = sys.argv[1:2] == ['test']
+if TESTING:
+    CACHES = {
+        'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'default'},
+        'shared': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'shared'},
+    }
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+        },
+    }
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -194,6 +252,12 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 FILE_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024      # 10MB in-memory, rest to disk
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10 * 1024 * 1024      # 10MB
 
+# Videos and STL files are uploaded in chunks instead (SmileHealth/uploads.py).
+# Partial files stay next to MEDIA_ROOT, on the same filesystem so the finished
+# file is moved into place rather than copied, but outside of what /media/ serves.
+CHUNKED_UPLOAD_DIR = str(MEDIA_STORAGE_PATH.parent / 'upload_sessions')
+CHUNKED_UPLOAD_MAX_SIZE = int(os.getenv('CHUNKED_UPLOAD_MAX_SIZE', 8 * 1024 ** 3))   # 8GB
+
 
 
 # Default primary key field type
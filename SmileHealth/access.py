@@ -0,0 +1,115 @@
+# SmileHealth/access.py
+"""
+Bulk permission checks for patients and case groups.
+
+AccessEvaluator answers view/edit/create questions for any number of
+objects with a constant number of queries: one PatientVisibility lookup for
+all patients and one CaseGroup.shared_with lookup for all groups. Queries run
+lazily, the first time a question needs them.
+"""
+from django.db.models import Q
+
+from .models import CaseGroup, PatientVisibility
+
+
+def is_admin(user):
+    return user.is_superuser or user.is_staff
+
+
+class AccessEvaluator:
+    def __init__(self, user, patients=(), groups=()):
+        self.user = user
+        self.is_admin = user.is_authenticated and is_admin(user)
+        self._pending_patients = set()
+        self._pending_groups = set()
+        self._loaded_patients = set()
+        self._loaded_groups = set()
+        self._visible_patient_ids = set()
+        self._shared_group_ids = set()
+        self.add_patients(patients)
+        self.add_groups(groups)
+
+    # ---- registration ----
+
+    def add_patients(self, patients):
+        self._pending_patients.update(p.pk for p in patients)
+        return self
+
+    def add_groups(self, groups):
+        self._pending_groups.update(g.pk for g in groups)
+        return self
+
+    def _needs_queries(self):
+        return self.user.is_authenticated and not self.is_admin
+
+    def _load_patients(self):
+        if not self._pending_patients:
+            return
+        ids, self._pending_patients = self._pending_patients - self._loaded_patients, set()
+        self._loaded_patients |= ids
+        if not ids or not self._needs_queries():
+            return
+        self._visible_patient_ids.update(
+            PatientVisibility.objects
+            .filter(patient_id__in=ids)
+            .filter(Q(user=self.user) | Q(user__isnull=True))
+            .values_list("patient_id", flat=True)
+        )
+
+    def _load_groups(self):
+        if not self._pending_groups:
+            return
+        ids, self._pending_groups = self._pending_groups - self._loaded_groups, set()
+        self._loaded_groups |= ids
+        if not ids or not self._needs_queries():
+            return
+        self._shared_group_ids.update(
+            CaseGroup.shared_with.through.objects
+            .filter(casegroup_id__in=ids, user_id=self.user.id)
+            .values_list("casegroup_id", flat=True)
+        )
+
+    # ---- patients ----
+
+    def can_view_patient(self, patient):
+        if not self.user.is_authenticated:
+            return False
+        if self.is_admin:
+            return True
+        self._pending_patients.add(patient.pk)
+        self._load_patients()
+        return patient.pk in self._visible_patient_ids
+
+    def can_edit_patient(self, patient):
+        if not self.user.is_authenticated:
+            return False
+        return self.is_admin or patient.usrID_id == self.user.id
+
+    def viewable_patients(self, patients):
+        patients = list(patients)
+        self.add_patients(patients)
+        return [p for p in patients if self.can_view_patient(p)]
+
+    # ---- groups ----
+
+    def _is_group_member(self, group):
+        if group.created_by_id == self.user.id:
+            return True
+        if group.visibility != CaseGroup.Visibility.SHARED:
+            return False
+        self._pending_groups.add(group.pk)
+        self._load_groups()
+        return group.pk in self._shared_group_ids
+
+    def can_view_group(self, group):
+        if not self.user.is_authenticated:
+            return False
+        return self.is_admin or self._is_group_member(group)
+
+    def can_manage_group(self, group):
+        if not self.user.is_authenticated:
+            return False
+        return self.is_admin or group.created_by_id == self.user.id
+
+    def can_create_in_group(self, group):
+        return self.can_view_group(group)
@@ -3,7 +3,8 @@ from django.contrib.auth.admin import UserAdmin as BaseUserAdmin
 from django.contrib.auth.models import User
 
 from .models import (
-    Patient, Image, Message, Profile, Comment, Model3D, Video, Branch, ActivityLog, CaseGroup
+    Patient, Image, Message, ArchivedMessage, GroupMessage, Profile, Comment, Model3D, Video, Branch, ActivityLog,
+    CaseGroup, Job, UploadSession,
 )
 
 # --- User + Profile inline (role/branches) ---
@@ -71,8 +72,12 @@ class ProfileAdmin(admin.ModelAdmin):
 
 # --- Other models ---
 admin.site.register(Message)
+admin.site.register(ArchivedMessage)
+admin.site.register(GroupMessage)
 admin.site.register(Comment)
 admin.site.register(Model3D)
 admin.site.register(Video)
 admin.site.register(ActivityLog)
 admin.site.register(CaseGroup)
+admin.site.register(Job)
+admin.site.register(UploadSession)
@@ -7,5 +7,6 @@ class SmilehealthConfig(AppConfig):
     name = 'SmileHealth'
 
     def ready(self):
-        # Ensure signal receivers are registered
+        # Ensure signal receivers and background job kinds are registered
         import SmileHealth.signals  # noqa
+        import SmileHealth.tasks  # noqa
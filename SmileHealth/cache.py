@@ -0,0 +1,80 @@
+# SmileHealth/cache.py
+"""
+Version-counter based invalidation on top of Django's cache.
+
+Cached values embed the current version of every scope they depend on in
+their key, so invalidating is a single `bump()`; stale entries simply stop
+being read and expire on their own.
+
+Keys are namespaced per model (`model_namespace(Patient, "detail")` ->
+"SmileHealth.patient.detail") so the hit/miss counters of the tiered backend
+(SmileHealth/cache_backends.py) can be read per model and purpose.
+"""
+import time
+
+from django.core.cache import cache
+
+
+def _version_key(scope):
+    return f"v:{scope}"
+
+
+def _fresh_version():
+    # Time-based so a version that was evicted never restarts at an old value
+    return int(time.time() * 1000)
+
+
+def get_version(scope):
+    key = _version_key(scope)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, _fresh_version(), timeout=None)
+        value = cache.get(key)
+    return value
+
+
+def bump(*scopes):
+    for scope in scopes:
+        key = _version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, _fresh_version(), timeout=None)
+
+
+def patient_scope(patient_id):
+    """Bumped whenever a patient or its media/comments change."""
+    return f"patient:{patient_id}"
+
+
+def groups_scope(user_id):
+    """Bumped when a group the user sees (or saw), its shares, cases or activity change."""
+    return f"casegroups:user:{user_id}"
+
+
+# Admins see every group and share one listing, so every group change bumps it
+GROUPS_ALL_SCOPE = "casegroups:all"
+
+
+def model_namespace(model, purpose=""):
+    label = model._meta.label_lower
+    return f"{label}.{purpose}" if purpose else label
+
+
+def counter_key(name, *parts):
+    """
+    Key for a mutable counter (incr/decr). The "counter:" prefix keeps it out
+    of the per-process tier of TieredCache so all workers see one value.
+    """
+    return ":".join(["counter", name, *(str(p) for p in parts)])
+
+
+def stats():
+    """Hit/miss counters of this process, or {} for backends without them."""
+    counters = getattr(cache, "stats", None)
+    return counters.snapshot() if counters is not None else {}
+
+
+def versioned_key(name, *parts, scopes=()):
+    versions = ".".join(str(get_version(scope)) for scope in scopes)
+    return ":".join([name, *(str(p) for p in parts), versions])
@@ -0,0 +1,200 @@
+# SmileHealth/cache_backends.py
+"""
+Two-tier Django cache backend: a per-process LRU in front of a shared cache.
+
+    CACHES = {
+        "default": {
+            "BACKEND": "SmileHealth.cache_backends.TieredCache",
+            "OPTIONS": {"SHARED": "shared", "LOCAL_MAX_BYTES": 32 * 1024 * 1024, "LOCAL_TIMEOUT": 60},
+        },
+        "shared": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": ...},
+    }
+
+The shared tier (normally FileBasedCache) is visible to every worker process
+on the host. The local tier holds pickled values, evicts least-recently-used
+entries once LOCAL_MAX_BYTES is exceeded and never keeps an entry longer than
+LOCAL_TIMEOUT seconds. Keys starting with one of LOCAL_BYPASS_PREFIXES (the
+version counters and counter_key() values from SmileHealth/cache.py) always
+go to the shared tier, so an invalidation or increment in one process is seen
+by all others immediately; everything keyed by those versions is immutable
+and safe to keep locally.
+"""
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+_MISSING = object()
+
+
+class LocalLRU:
+    """Thread-safe LRU of pickled values bounded by total payload size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()  # key -> (expires_at, payload)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISSING
+            expires_at, payload = entry
+            if expires_at <= time.monotonic():
+                self._pop(key)
+                return _MISSING
+            self._data.move_to_end(key)
+        return pickle.loads(payload)
+
+    def set(self, key, value, timeout):
+        if timeout is not None and timeout <= 0:
+            self.delete(key)
+            return
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            self.delete(key)
+            return
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (time.monotonic() + timeout, payload)
+            self.size += len(payload)
+            while self.size > self.max_bytes:
+                self._pop(next(iter(self._data)))
+
+    def delete(self, key):
+        with self._lock:
+            return self._pop(key)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        self.size -= len(entry[1])
+        return True
+
+
+class CacheStats:
+    """Per-process hit/miss counters, grouped by key namespace."""
+
+    def __init__(self):
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def namespace(key):
+        ns = key.split(":", 1)[0]
+        if ns.startswith("template.cache."):  # {% cache %} fragments: keep the fragment name
+            ns = ns.rsplit(".", 1)[0]
+        return ns
+
+    def record(self, key, outcome):
+        ns = self.namespace(key)
+        with self._lock:
+            counts = self._counts.setdefault(ns, {"local_hits": 0, "shared_hits": 0, "misses": 0})
+            counts[outcome] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {ns: dict(counts) for ns, counts in sorted(self._counts.items())}
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class TieredCache(BaseCache):
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get("OPTIONS", {})
+        self._shared_alias = options.get("SHARED", "shared")
+        self._local_timeout = options.get("LOCAL_TIMEOUT", 60)
+        self._bypass = tuple(options.get("LOCAL_BYPASS_PREFIXES", ("v:", "counter:")))
+        self._local = LocalLRU(options.get("LOCAL_MAX_BYTES", 32 * 1024 * 1024))
+        self.stats = CacheStats()
+
+    @property
+    def shared(self):
+        return caches[self._shared_alias]
+
+    def _local_key(self, key, version):
+        if key.startswith(self._bypass):
+            return None
+        return self.make_and_validate_key(key, version=version)
+
+    def _local_ttl(self, timeout):
+        timeout = self.get_backend_timeout(timeout)
+        if timeout is None:
+            return self._local_timeout
+        return min(timeout - time.time(), self._local_timeout)
+
+    def get(self, key, default=None, version=None):
+        local_key = self._local_key(key, version)
+        if local_key is not None:
+            value = self._local.get(local_key)
+            if value is not _MISSING:
+                self.stats.record(key, "local_hits")
+                return value
+        value = self.shared.get(key, _MISSING, version=version)
+        if value is _MISSING:
+            self.stats.record(key, "misses")
+            return default
+        self.stats.record(key, "shared_hits")
+        if local_key is not None:
+            self._local.set(local_key, value, self._local_timeout)
+        return value
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.shared.set(key, value, timeout=self._shared_timeout(timeout), version=version)
+        local_key = self._local_key(key, version)
+        if local_key is not None:
+            self._local.set(local_key, value, self._local_ttl(timeout))
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        added = self.shared.add(key, value, timeout=self._shared_timeout(timeout), version=version)
+        local_key = self._local_key(key, version)
+        if added and local_key is not None:
+            self._local.set(local_key, value, self._local_ttl(timeout))
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        return self.shared.touch(key, timeout=self._shared_timeout(timeout), version=version)
+
+    def delete(self, key, version=None):
+        local_key = self._local_key(key, version)
+        if local_key is not None:
+            self._local.delete(local_key)
+        return self.shared.delete(key, version=version)
+
+    def has_key(self, key, version=None):
+        local_key = self._local_key(key, version)
+        if local_key is not None and self._local.get(local_key) is not _MISSING:
+            return True
+        return self.shared.has_key(key, version=version)
+
+    def incr(self, key, delta=1, version=None):
+        local_key = self._local_key(key, version)
+        if local_key is not None:
+            self._local.delete(local_key)
+        return self.shared.incr(key, delta, version=version)
+
+    def clear(self):
+        self._local.clear()
+        self.shared.clear()
+
+    def _shared_timeout(self, timeout):
+        # Resolve our own default so the shared tier does not apply a different one
+        return self.default_timeout if timeout is DEFAULT_TIMEOUT else timeout
+
+    @property
+    def local_size(self):
+        return self._local.size
@@ -0,0 +1,73 @@
+# SmileHealth/cards.py
+"""
+Compact view-models for the patient cards on the index grid.
+
+Cards are built from values() rows (one query for the page, one for its
+shares) so the template only reads precomputed attributes instead of
+touching User objects or evaluating patient.shared_with per card.
+"""
+from .models import Patient
+
+SHARE_CHIPS = 5
+
+
+def _display_name(first, last, username):
+    return f"{first} {last}".strip() or username
+
+
+def _initial(name):
+    return name[:1].upper()
+
+
+class PatientCard:
+    __slots__ = (
+        "id", "name", "lastname", "visibility", "thumbnail_url",
+        "is_owner", "owner_name", "owner_initial",
+        "share_chips", "share_count", "shared_with_me",
+    )
+
+    def __init__(self, row, user_id):
+        self.id = row["id"]
+        self.name = row["ptnName"]
+        self.lastname = row["ptnLastname"]
+        self.visibility = row["visibility"]
+        thumb = row["thumbnail"]
+        self.thumbnail_url = Patient._meta.get_field("thumbnail").storage.url(thumb) if thumb else ""
+        self.is_owner = row["usrID_id"] == user_id
+        self.owner_name = _display_name(row["usrID__first_name"], row["usrID__last_name"], row["usrID__username"])
+        self.owner_initial = _initial(self.owner_name)
+        self.share_chips = []  # (initial, name) of the first SHARE_CHIPS users
+        self.share_count = 0
+        self.shared_with_me = False
+
+    @property
+    def share_more(self):
+        return max(self.share_count - SHARE_CHIPS, 0)
+
+
+CARD_FIELDS = (
+    "id", "ptnName", "ptnLastname", "visibility", "thumbnail", "usrID_id",
+    "usrID__first_name", "usrID__last_name", "usrID__username",
+)
+
+
+def build_patient_cards(rows, user):
+    """Turn Patient values(*CARD_FIELDS) rows into PatientCard objects (one extra query)."""
+    cards = [PatientCard(row, user.id) for row in rows]
+    by_id = {card.id: card for card in cards}
+    if not by_id:
+        return cards
+
+    shares = Patient.shared_with.through.objects \
+        .filter(patient_id__in=by_id) \
+        .order_by("patient_id", "id") \
+        .values_list("patient_id", "user_id", "user__first_name", "user__last_name", "user__username")
+    for patient_id, uid, first, last, username in shares:
+        card = by_id[patient_id]
+        card.share_count += 1
+        if uid == user.id:
+            card.shared_with_me = True
+        if len(card.share_chips) < SHARE_CHIPS:
+            name = _display_name(first, last, username)
+            card.share_chips.append((_initial(name), name))
+    return cards
@@ -0,0 +1,307 @@
+# SmileHealth/channel_layers.py
+"""
+Channel layer for several worker processes on one host, without Redis.
+
+Queues and group memberships live in a local SQLite file (WAL mode), so a
+group_send from one process reaches consumers in every other process:
+
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "SmileHealth.channel_layers.SQLiteChannelLayer",
+            "CONFIG": {
+                "path": "/var/.../channels.sqlite3",
+                "expiry": 60,                         # seconds a message waits
+                "capacity": 100,                      # per-channel queue limit
+                "group_capacity": {"chat_*": 200},    # limit applied by group_send
+            },
+        },
+    }
+
+Consumer channels are process-specific ("specific.<process token>!<id>").
+Each process runs one poller that pops the messages of all its channels in a
+batch and hands them to the waiting receive() calls, so idle connections cost
+nothing beyond that single indexed query. The poller backs off from
+poll_interval to max_poll_interval while nothing arrives.
+
+Like InMemoryChannelLayer, send() raises ChannelFull at capacity and
+group_send() silently skips members that are full; messages expire after
+`expiry` seconds and a channel whose message expired unread is dropped from
+its groups.
+"""
+import asyncio
+import pickle
+import secrets
+import sqlite3
+import threading
+import time
+
+from channels.exceptions import ChannelFull
+from channels.layers import BaseChannelLayer
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS channel_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    expires REAL NOT NULL,
+    body BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS channel_messages_channel ON channel_messages (channel, id);
+CREATE INDEX IF NOT EXISTS channel_messages_expires ON channel_messages (expires);
+CREATE TABLE IF NOT EXISTS channel_groups (
+    grp TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    joined REAL NOT NULL,
+    PRIMARY KEY (grp, channel)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS channel_groups_channel ON channel_groups (channel);
+"""
+
+POP_BATCH = 200
+
+
+class SQLiteChannelLayer(BaseChannelLayer):
+    extensions = ["groups", "flush"]
+
+    def __init__(
+        self,
+        path,
+        expiry=60,
+        group_expiry=86400,
+        capacity=100,
+        channel_capacity=None,
+        group_capacity=None,
+        poll_interval=0.005,
+        max_poll_interval=0.1,
+        **kwargs,
+    ):
+        super().__init__(expiry=expiry, capacity=capacity, channel_capacity=channel_capacity, **kwargs)
+        self.path = str(path)
+        self.group_expiry = group_expiry
+        self.channel_capacity = self.compile_capacities(self.channel_capacity)
+        self.group_capacity = self.compile_capacities(group_capacity or {})
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.client_prefix = secrets.token_hex(6)
+
+        self._local = threading.local()
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+        self._last_cleanup = 0.0
+        self._reset_receivers(None)
+
+    # ---- storage ----
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with self._schema_lock:
+                if not self._schema_ready:
+                    conn.executescript(SCHEMA)
+                    self._schema_ready = True
+            self._local.conn = conn
+        return conn
+
+    async def _run(self, func, *args):
+        return await asyncio.to_thread(func, *args)
+
+    def _queue_lengths(self, conn, channels, now):
+        marks = ",".join("?" * len(channels))
+        rows = conn.execute(
+            f"SELECT channel, COUNT(*) FROM channel_messages "
+            f"WHERE channel IN ({marks}) AND expires > ? GROUP BY channel",
+            (*channels, now),
+        )
+        return dict(rows)
+
+    def _insert(self, channels, message, capacity_for):
+        """Queue message on every channel below its capacity; returns the full ones."""
+        conn = self._connection()
+        body = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            lengths = self._queue_lengths(conn, channels, now)
+            full = [c for c in channels if lengths.get(c, 0) >= capacity_for(c)]
+            conn.executemany(
+                "INSERT INTO channel_messages (channel, expires, body) VALUES (?, ?, ?)",
+                [(c, now + self.expiry, body) for c in channels if c not in full],
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return full
+
+    def _pop(self, low, high, limit):
+        """Atomically remove and return [(id, channel, message)] with low <= channel < high."""
+        rows = self._connection().execute(
+            "DELETE FROM channel_messages WHERE id IN ("
+            "  SELECT id FROM channel_messages"
+            "  WHERE channel >= ? AND channel < ? AND expires > ? ORDER BY id LIMIT ?"
+            ") RETURNING id, channel, body",
+            (low, high, time.time(), limit),
+        ).fetchall()
+        return sorted((row_id, channel, pickle.loads(body)) for row_id, channel, body in rows)
+
+    def _cleanup(self):
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # A message that expired unread means its consumer is gone
+            conn.execute(
+                "DELETE FROM channel_groups WHERE channel IN "
+                "(SELECT DISTINCT channel FROM channel_messages WHERE expires <= ?)",
+                (now,),
+            )
+            conn.execute("DELETE FROM channel_messages WHERE expires <= ?", (now,))
+            conn.execute("DELETE FROM channel_groups WHERE joined < ?", (now - self.group_expiry,))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def _maybe_cleanup(self):
+        if time.monotonic() - self._last_cleanup >= min(self.expiry, 30):
+            self._last_cleanup = time.monotonic()
+            await self._run(self._cleanup)
+
+    # ---- channel API ----
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), "message is not a dict"
+        self.require_valid_channel_name(channel)
+        assert "__asgi_channel__" not in message
+        if await self._run(self._insert, [channel], message, self.get_capacity):
+            raise ChannelFull(channel)
+
+    async def new_channel(self, prefix="specific"):
+        return f"{prefix}.{self.client_prefix}!{secrets.token_hex(8)}"
+
+    async def receive(self, channel):
+        self.require_valid_channel_name(channel)
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._reset_receivers(loop)
+
+        prefix = self.non_local_name(channel)
+        if prefix == channel:
+            return await self._receive_direct(channel)
+
+        queue = self._buffers.setdefault(channel, asyncio.Queue())
+        self._waiting[channel] = self._waiting.get(channel, 0) + 1
+        if self._pollers.get(prefix) is None or self._pollers[prefix].done():
+            self._pollers[prefix] = asyncio.ensure_future(self._poll(prefix))
+        try:
+            while True:
+                expires, message = await queue.get()
+                if expires > time.time():
+                    return message
+        finally:
+            self._waiting[channel] -= 1
+            if not self._waiting[channel]:
+                del self._waiting[channel]
+                if queue.empty():
+                    self._buffers.pop(channel, None)
+                    self._buffer_expiry.pop(channel, None)
+
+    async def _receive_direct(self, channel):
+        delay = self.poll_interval
+        while True:
+            rows = await self._run(self._pop, channel, channel + "\x00", 1)
+            if rows:
+                return rows[0][2]
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    async def _poll(self, prefix):
+        """Feed the receive() buffers of every channel under prefix, one query per round."""
+        delay = self.poll_interval
+        high = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        while any(name.startswith(prefix) for name in self._waiting):
+            await self._maybe_cleanup()
+            rows = await self._run(self._pop, prefix, high, POP_BATCH)
+            expires = time.time() + self.expiry
+            for _, channel, message in rows:
+                self._buffers.setdefault(channel, asyncio.Queue()).put_nowait((expires, message))
+                self._buffer_expiry[channel] = max(expires, self._buffer_expiry.get(channel, 0))
+            if rows:
+                delay = self.poll_interval
+                continue
+            self._drop_stale_buffers()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_poll_interval)
+
+    def _drop_stale_buffers(self):
+        # Messages for local channels whose consumer already left. Only the
+        # newest expiry per buffer is tracked: once it has passed, all have.
+        now = time.time()
+        for channel in list(self._buffers):
+            if channel not in self._waiting and self._buffer_expiry.get(channel, 0) <= now:
+                del self._buffers[channel]
+                self._buffer_expiry.pop(channel, None)
+
+    def _reset_receivers(self, loop):
+        self._loop = loop
+        self._buffers = {}
+        self._buffer_expiry = {}   # channel -> expiry of its newest buffered message
+        self._waiting = {}
+        self._pollers = {}
+
+    # ---- groups extension ----
+
+    def get_group_capacity(self, group):
+        for pattern, capacity in self.group_capacity:
+            if pattern.match(group):
+                return capacity
+        return self.capacity
+
+    async def group_add(self, group, channel):
+        self.require_valid_group_name(group)
+        self.require_valid_channel_name(channel)
+        await self._run(lambda: self._connection().execute(
+            "INSERT OR REPLACE INTO channel_groups (grp, channel, joined) VALUES (?, ?, ?)",
+            (group, channel, time.time()),
+        ))
+
+    async def group_discard(self, group, channel):
+        self.require_valid_channel_name(channel)
+        self.require_valid_group_name(group)
+        await self._run(lambda: self._connection().execute(
+            "DELETE FROM channel_groups WHERE grp = ? AND channel = ?", (group, channel),
+        ))
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), "Message is not a dict"
+        self.require_valid_group_name(group)
+        await self._maybe_cleanup()
+
+        def members():
+            return [row[0] for row in self._connection().execute(
+                "SELECT channel FROM channel_groups WHERE grp = ? AND joined >= ?",
+                (group, time.time() - self.group_expiry),
+            )]
+
+        channels = await self._run(members)
+        if channels:
+            capacity = self.get_group_capacity(group)
+            # Members at capacity are skipped, as in InMemoryChannelLayer
+            await self._run(self._insert, channels, message, lambda _: capacity)
+
+    # ---- flush extension ----
+
+    async def flush(self):
+        def clear():
+            conn = self._connection()
+            conn.execute("DELETE FROM channel_messages")
+            conn.execute("DELETE FROM channel_groups")
+
+        await self._run(clear)
+        self._reset_receivers(self._loop)
+
+    async def close(self):
+        for task in self._pollers.values():
+            task.cancel()
@@ -1,12 +1,39 @@
+import asyncio
 import json
+import time
+from datetime import datetime
 from channels.generic.websocket import AsyncWebsocketConsumer
 from channels.db import database_sync_to_async
 
+HISTORY_PAGE_SIZE = 50
+# Read receipts and MESSAGE_SENT activity rows are written in batches, at most
+# this many seconds after the message (and on disconnect)
+FLUSH_INTERVAL = 1.0
+# Typing and seen events only travel over the channel layer. A connection
+# forwards at most one "typing" per TYPING_INTERVAL; its seen watermark goes
+# out with the batched flush, so at most once per FLUSH_INTERVAL.
+TYPING_INTERVAL = 2.0
+
+
+def _parse_cursor(cursor):
+    """{"timestamp": iso, "id": n} from the client -> (datetime, int), or None."""
+    try:
+        return datetime.fromisoformat(cursor["timestamp"]), int(cursor["id"])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
 class ChatConsumer(AsyncWebsocketConsumer):
 
-    async def connect(self):
-        from django.contrib.auth.models import User
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._read_upto = 0     # newest message id from the peer delivered to this socket
+        self._flushed_upto = 0  # ... already persisted and announced as seen
+        self._pending_logs = []
+        self._flush_task = None
+        self._typing_sent_at = None
 
+    async def connect(self):
         user = self.scope["user"]
         print(f"ChatConsumer connect called. User: {user}, authenticated: {user.is_authenticated}")
 
@@ -18,6 +45,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         self.user = user
         self.receiver_id = int(self.scope['url_route']['kwargs']['receiver_id'])
         self.room_group_name = f"chat_{min(self.user.id, self.receiver_id)}_{max(self.user.id, self.receiver_id)}"
+        self.receiver_username = await self.get_username(self.receiver_id)
+        if self.receiver_username is None:
+            await self.close()
+            return
 
         # Join room group
         await self.channel_layer.group_add(
@@ -26,28 +57,49 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
         await self.accept()
 
-        # Send chat history
-        messages_data = await self.get_serialized_chat_history(self.user.id, self.receiver_id)
-        for message in messages_data:
-            await self.send(text_data=json.dumps(message))
+        # Latest page of the conversation in a single frame; older pages via load_older
+        marked = await self.mark_conversation_read(self.user.id, self.receiver_id)
+        page = await self.get_history_page(self.user.id, self.receiver_id)
+        await self.send(text_data=json.dumps({'type': 'history', **page}))
+        peer_ids = [m['message_id'] for m in page['messages'] if m['sender_id'] == self.receiver_id]
+        self._read_upto = self._flushed_upto = max(peer_ids, default=0)
+        if marked and peer_ids:
+            await self.announce_seen(self._read_upto)
 
     async def disconnect(self, close_code):
+        if not hasattr(self, 'room_group_name'):
+            return  # rejected in connect()
         print(f"Disconnecting user {self.user} from room {self.room_group_name}")
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush_pending()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
         )
 
     async def receive(self, text_data):
-        from django.contrib.auth.models import User
-
         data = json.loads(text_data)
+        if data.get('command') == 'load_older':
+            before = _parse_cursor(data.get('before'))
+            if before is None:
+                return
+            page = await self.get_history_page(self.user.id, self.receiver_id, before)
+            await self.send(text_data=json.dumps({'type': 'history', 'older': True, **page}))
+            return
+        if data.get('command') == 'typing':
+            await self.set_typing(bool(data.get('typing', True)))
+            return
+
         message = data.get('message', '').strip()
         if not message:
             return  # ignore empty messages
 
-        # Save message in DB
+        # Save message and its Conversation summary (the activity row is batched)
         msg = await self.save_message(self.user.id, self.receiver_id, message)
+        self._typing_sent_at = None  # the peer hides the indicator when the message arrives
+        self._pending_logs.append(self._activity_row(msg))
+        self._schedule_flush()
 
         # Broadcast message to room group
         await self.channel_layer.group_send(
@@ -62,8 +114,10 @@ class ChatConsumer(AsyncWebsocketConsumer):
         )
 
     async def chat_message(self, event):
-        if self.user.id != event['sender_id']:
-            await self.mark_message_read(event.get('message_id'))
+        if self.user.id != event['sender_id'] and event.get('message_id'):
+            # An open chat reads what it receives; flush_pending persists the watermark
+            self._read_upto = max(self._read_upto, event['message_id'])
+            self._schedule_flush()
         await self.send(text_data=json.dumps({
             'message': event['message'],
             'sender_id': event['sender_id'],
@@ -71,41 +125,366 @@ class ChatConsumer(AsyncWebsocketConsumer):
             'message_id': event.get('message_id'),
         }))
 
+    # ---- ephemeral events (channel layer only) ----
+
+    async def set_typing(self, typing):
+        now = time.monotonic()
+        if typing:
+            if self._typing_sent_at is not None and now - self._typing_sent_at < TYPING_INTERVAL:
+                return  # coalesced: the peer still shows the last one
+            self._typing_sent_at = now
+        elif self._typing_sent_at is None:
+            return  # the peer was never told
+        else:
+            self._typing_sent_at = None
+        await self.channel_layer.group_send(
+            self.room_group_name, {'type': 'chat_typing', 'user_id': self.user.id, 'typing': typing},
+        )
+
+    async def announce_seen(self, upto):
+        await self.channel_layer.group_send(
+            self.room_group_name, {'type': 'chat_seen', 'reader_id': self.user.id, 'upto': upto},
+        )
+
+    async def chat_typing(self, event):
+        if event['user_id'] != self.user.id:
+            await self.send(text_data=json.dumps({'type': 'typing', 'typing': event['typing']}))
+
+    async def chat_seen(self, event):
+        if event['reader_id'] != self.user.id:
+            await self.send(text_data=json.dumps({'type': 'seen', 'upto': event['upto']}))
+
+    @database_sync_to_async
+    def get_history_page(self, user1_id, user2_id, before=None, limit=HISTORY_PAGE_SIZE):
+        """
+        Up to `limit` messages older than the (timestamp, id) cursor `before`,
+        oldest first, plus the cursor for the next load_older request.
+
+        Each direction is read separately so both queries walk the
+        (sender, receiver, timestamp) index backwards and stop after limit+1
+        rows; the merge below is O(page), not O(conversation). Once a page
+        reaches back to the newest archived message (retention.horizon()),
+        ArchivedMessage is read the same way and merged in.
+        """
+        from django.db.models import Q
+        from . import retention
+        from .models import ArchivedMessage, Message
+
+        def newest_first(model):
+            rows = []
+            for sender_id, receiver_id in ((user1_id, user2_id), (user2_id, user1_id)):
+                qs = model.objects.filter(sender_id=sender_id, receiver_id=receiver_id)
+                if before is not None:
+                    ts, msg_id = before
+                    qs = qs.filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=msg_id))
+                rows.extend(
+                    qs.order_by('-timestamp', '-id')
+                    .values('id', 'content', 'sender_id', 'sender__username', 'timestamp')[:limit + 1]
+                )
+            return rows
+
+        rows = newest_first(Message)
+        rows.sort(key=lambda r: (r['timestamp'], r['id']), reverse=True)
+        archived_until = retention.horizon()
+        if archived_until is not None and (len(rows) <= limit or rows[limit]['timestamp'] <= archived_until):
+            rows.extend(newest_first(ArchivedMessage))
+            rows.sort(key=lambda r: (r['timestamp'], r['id']), reverse=True)
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+
+        cursor = None
+        if has_more:
+            cursor = {'timestamp': rows[0]['timestamp'].isoformat(), 'id': rows[0]['id']}
+        return {
+            'messages': [
+                {
+                    'message': r['content'],
+                    'sender_id': r['sender_id'],
+                    'sender_username': r['sender__username'],
+                    'message_id': r['id'],
+                    'timestamp': r['timestamp'].strftime('%Y-%m-%d %H:%M:%S'),
+                }
+                for r in rows
+            ],
+            'has_more': has_more,
+            'cursor': cursor,
+        }
+
     @database_sync_to_async
-    def get_serialized_chat_history(self, user1_id, user2_id):
+    def mark_conversation_read(self, user_id, other_id):
+        from . import conversations, unread
         from .models import Message
-        messages = Message.objects.filter(
-            sender_id__in=[user1_id, user2_id],
-            receiver_id__in=[user1_id, user2_id]
-        ).select_related('sender').order_by('timestamp')
-
-        Message.objects.filter(
-            sender_id=user2_id,
-            receiver_id=user1_id,
+        updated = Message.objects.filter(
+            sender_id=other_id,
+            receiver_id=user_id,
             is_read=False
         ).update(is_read=True)
+        if updated:
+            conversations.mark_read(user_id, other_id)
+            unread.adjust(user_id, -updated)
+        return updated
 
-        return [
-            {
-                'message': msg.content,
-                'sender_id': msg.sender.id,
-                'sender_username': msg.sender.username,
-                'timestamp': msg.timestamp.strftime('%Y-%m-%d %H:%M:%S'),
-            }
-            for msg in messages
-        ]
+    # ---- batched writes ----
+
+    def _activity_row(self, msg):
+        from .models import ActivityLog
+        return ActivityLog(
+            actor_id=msg.sender_id,
+            action=ActivityLog.Action.MESSAGE_SENT,
+            target_type="Message",
+            target_id=msg.id,
+            target_label=f"From {self.user.username} to {self.receiver_username} at {msg.timestamp}",
+        )
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FLUSH_INTERVAL)
+        self._flush_task = None
+        await self.flush_pending()
+
+    async def flush_pending(self):
+        read_upto = self._read_upto if self._read_upto > self._flushed_upto else None
+        self._flushed_upto = self._read_upto
+        logs, self._pending_logs = self._pending_logs, []
+        if read_upto or logs:
+            await self.write_pending(read_upto, logs)
+        # Only once committed: the sender's "seen" must not get ahead of Message.is_read
+        if read_upto:
+            await self.announce_seen(read_upto)
 
     @database_sync_to_async
-    def save_message(self, sender_id, receiver_id, content):
+    def write_pending(self, read_upto, activity_rows):
+        from django.db import transaction
+        from . import conversations, unread
+        from .models import ActivityLog, Message
+        with transaction.atomic():
+            if read_upto:
+                # "Read up to read_upto": one UPDATE however many messages arrived
+                updated = Message.objects.filter(
+                    sender_id=self.receiver_id, receiver_id=self.user.id, is_read=False, id__lte=read_upto,
+                ).update(is_read=True)
+                conversations.mark_read(self.user.id, self.receiver_id, updated)
+                unread.adjust(self.user.id, -updated)
+            if activity_rows:
+                ActivityLog.objects.bulk_create(activity_rows)
+
+    # ---- single statements ----
+
+    @database_sync_to_async
+    def get_username(self, user_id):
         from django.contrib.auth.models import User
-        from .models import Message
-        sender = User.objects.get(id=sender_id)
-        receiver = User.objects.get(id=receiver_id)
-        return Message.objects.create(sender=sender, receiver=receiver, content=content)
+        return User.objects.filter(id=user_id).values_list('username', flat=True).first()
 
     @database_sync_to_async
-    def mark_message_read(self, message_id):
-        if not message_id:
-            return 0
+    def save_message(self, sender_id, receiver_id, content):
+        """
+        Two statements, committed together: the Message INSERT and the
+        Conversation UPDATE (an INSERT for a new pair) that its post_save
+        signal issues via conversations.record_message.
+        """
+        from django.db import transaction
         from .models import Message
-        return Message.objects.filter(id=message_id).update(is_read=True)
+        msg = Message(sender_id=sender_id, receiver_id=receiver_id, content=content)
+        msg._activity_deferred = True  # logged by flush_pending, see log_message_sent
+        with transaction.atomic():  # a failed Conversation write rolls the message back
+            msg.save()
+        return msg
+
+
+class GroupChatConsumer(AsyncWebsocketConsumer):
+    """
+    Conversation with every member of a Branch or CaseGroup
+    (ws/group/<kind>/<id>/). Each message is stored once and reaches every
+    open socket of the group through one group_send; see
+    SmileHealth/group_chat.py.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._read_upto = 0
+        self._flushed_upto = 0
+        self._flush_task = None
+
+    async def connect(self):
+        from . import group_chat
+
+        user = self.scope["user"]
+        if not user.is_authenticated:
+            await self.close()
+            return
+
+        self.user = user
+        self.kind = self.scope['url_route']['kwargs']['kind']
+        self.target_id = int(self.scope['url_route']['kwargs']['target_id'])
+        if not await database_sync_to_async(group_chat.is_member)(user.id, self.kind, self.target_id):
+            await self.close()
+            return
+
+        self.room_group_name = group_chat.room_group(self.kind, self.target_id)
+        self.member_group_name = group_chat.member_group(user.id)
+        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_add(self.member_group_name, self.channel_name)
+        await self.accept()
+
+        await database_sync_to_async(group_chat.mark_read)(user.id, self.kind, self.target_id)
+        page = await database_sync_to_async(group_chat.history_page)(self.kind, self.target_id)
+        await self.send(text_data=json.dumps({'type': 'history', **page}))
+        self._read_upto = self._flushed_upto = max(
+            (m['message_id'] for m in page['messages'] if m['sender_id'] != user.id), default=0,
+        )
+
+    async def disconnect(self, close_code):
+        if not hasattr(self, 'room_group_name'):
+            return  # rejected in connect()
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        await self.flush_pending()
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.channel_layer.group_discard(self.member_group_name, self.channel_name)
+
+    async def receive(self, text_data):
+        from . import group_chat
+
+        data = json.loads(text_data)
+        if data.get('command') == 'load_older':
+            before = _parse_cursor(data.get('before'))
+            if before is None:
+                return
+            page = await database_sync_to_async(group_chat.history_page)(self.kind, self.target_id, before)
+            await self.send(text_data=json.dumps({'type': 'history', 'older': True, **page}))
+            return
+
+        message = data.get('message', '').strip()
+        if not message:
+            return
+
+        msg = await database_sync_to_async(group_chat.send)(self.user.id, self.kind, self.target_id, message)
+        # One group_send however many members the group has
+        await self.channel_layer.group_send(
+            self.room_group_name,
+            {
+                'type': 'group.message',
+                'kind': self.kind,
+                'target_id': self.target_id,
+                'message': message,
+                'sender_id': self.user.id,
+                'sender_username': self.user.username,
+                'message_id': msg.id,
+            }
+        )
+
+    async def group_message(self, event):
+        if event['sender_id'] != self.user.id:
+            self._read_upto = max(self._read_upto, event['message_id'])
+            self._schedule_flush()
+        await self.send(text_data=json.dumps({
+            'message': event['message'],
+            'sender_id': event['sender_id'],
+            'sender_username': event['sender_username'],
+            'message_id': event['message_id'],
+        }))
+
+    async def group_membership(self, event):
+        from . import group_chat
+
+        if event['joined'] or (event['kind'], event['target_id']) != (self.kind, self.target_id):
+            return
+        if await database_sync_to_async(group_chat.is_member)(self.user.id, self.kind, self.target_id):
+            return
+        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
+        await self.send(text_data=json.dumps({'type': 'removed'}))
+        await self.close()
+
+    # ---- batched read receipts, as in ChatConsumer ----
+
+    def _schedule_flush(self):
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FLUSH_INTERVAL)
+        self._flush_task = None
+        await self.flush_pending()
+
+    async def flush_pending(self):
+        from . import group_chat
+
+        if self._read_upto > self._flushed_upto:
+            self._flushed_upto = self._read_upto
+            await database_sync_to_async(group_chat.mark_read)(
+                self.user.id, self.kind, self.target_id, self._read_upto,
+            )
+
+
+class NotifyConsumer(AsyncWebsocketConsumer):
+    """Per-user socket for the unread badge; see SmileHealth/unread.py."""
+
+    async def connect(self):
+        from . import group_chat, unread
+
+        user = self.scope["user"]
+        if not user.is_authenticated:
+            await self.close()
+            return
+
+        self.user = user
+        self.group_name = unread.notify_group(user.id)
+        self.member_group_name = group_chat.member_group(user.id)
+        await self.channel_layer.group_add(self.group_name, self.channel_name)
+        await self.channel_layer.group_add(self.member_group_name, self.channel_name)
+        # Group conversations reach the user here too; membership events keep this set current
+        self.rooms = {
+            group_chat.room_group(kind, target_id)
+            for kind, target_id in await database_sync_to_async(group_chat.memberships)(user.id)
+        }
+        for room in self.rooms:
+            await self.channel_layer.group_add(room, self.channel_name)
+        await self.accept()
+        count = await database_sync_to_async(unread.count)(user.id)
+        await self.send(text_data=json.dumps({'type': 'unread', 'count': count, 'delta': 0}))
+
+    async def disconnect(self, close_code):
+        if hasattr(self, 'group_name'):
+            for group in (self.group_name, self.member_group_name, *self.rooms):
+                await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def unread_count(self, event):
+        await self.send(text_data=json.dumps({
+            'type': 'unread',
+            'count': event['count'],
+            'delta': event['delta'],
+        }))
+
+    async def group_message(self, event):
+        if event['sender_id'] == self.user.id:
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'group_message',
+            'kind': event['kind'],
+            'target_id': event['target_id'],
+            'message': event['message'],
+            'sender_id': event['sender_id'],
+            'sender_username': event['sender_username'],
+            'message_id': event['message_id'],
+        }))
+
+    async def group_membership(self, event):
+        from . import group_chat
+
+        room = group_chat.room_group(event['kind'], event['target_id'])
+        member = await database_sync_to_async(group_chat.is_member)(self.user.id, event['kind'], event['target_id'])
+        if member and room not in self.rooms:
+            self.rooms.add(room)
+            await self.channel_layer.group_add(room, self.channel_name)
+        elif not member and room in self.rooms:
+            self.rooms.discard(room)
+            await self.channel_layer.group_discard(room, self.channel_name)
+        else:
+            return
+        await self.send(text_data=json.dumps({
+            'type': 'membership', 'kind': event['kind'], 'target_id': event['target_id'], 'joined': member,
+        }))
@@ -1,12 +1,17 @@
 # SmileHealth/context_processors.py
-from .models import Profile
+from .middleware import get_profile
+
 
 def user_avatar(request):
     """
     Make `avatar` available in ALL templates.
-    Ensures a Profile exists for the logged-in user.
+    Read-only: resolves request.profile from ProfileMiddleware on every
+    rendered request, which costs a query only when the profile cache is cold.
     """
     if not request.user.is_authenticated:
         return {}
-    profile, _ = Profile.objects.get_or_create(user=request.user)
-    return {"avatar": profile}
+    # Resolving the lazy loader here also primes request.user.profile for templates;
+    # falls back to get_profile when the middleware is not installed (RequestFactory).
+    profile = request.profile if hasattr(request, "profile") else get_profile(request.user)
+    # `or None`: a user without Profile gets None, not the resolved lazy wrapper
+    return {"avatar": profile or None}
@@ -0,0 +1,148 @@
+# SmileHealth/conversations.py
+"""
+Maintenance of the Conversation summary table (one row per user pair).
+
+Every change is a single UPDATE with F()/Case expressions, so concurrent
+sends in the same conversation cannot lose an unread increment or move
+last_message backwards. The row is created on the first message of a pair;
+a concurrent creator hitting the unique constraint falls back to the UPDATE.
+"""
+from django.apps import apps as global_apps
+from django.db import IntegrityError, transaction
+from django.db.models import BigIntegerField, Case, Count, DateTimeField, F, Max, Q, Value, When
+from django.db.models.functions import Greatest, Least
+
+BATCH_SIZE = 1000
+
+
+def _model():
+    return global_apps.get_model("SmileHealth", "Conversation")
+
+
+def pair(user_a, user_b):
+    return (user_a, user_b) if user_a < user_b else (user_b, user_a)
+
+
+def _side(receiver_id, low):
+    return "unread_low" if receiver_id == low else "unread_high"
+
+
+def record_message(message):
+    """Fold a newly created Message into its conversation row."""
+    if message.sender_id == message.receiver_id:
+        return
+    Conversation = _model()
+    low, high = pair(message.sender_id, message.receiver_id)
+    unread_field = _side(message.receiver_id, low)
+    is_newer = (
+        Q(last_message_at__isnull=True)
+        | Q(last_message_at__lt=message.timestamp)
+        | Q(last_message_at=message.timestamp, last_message_id__lt=message.id)
+    )
+    changes = {
+        "last_message_id": Case(
+            When(is_newer, then=Value(message.id)), default=F("last_message_id"), output_field=BigIntegerField(),
+        ),
+        "last_message_at": Case(
+            When(is_newer, then=Value(message.timestamp)), default=F("last_message_at"), output_field=DateTimeField(),
+        ),
+    }
+    if not message.is_read:
+        changes[unread_field] = F(unread_field) + 1
+
+    rows = Conversation.objects.filter(user_low_id=low, user_high_id=high)
+    if rows.update(**changes):
+        return
+    try:
+        with transaction.atomic():
+            Conversation.objects.create(
+                user_low_id=low, user_high_id=high,
+                last_message_id=message.id, last_message_at=message.timestamp,
+                **{unread_field: 0 if message.is_read else 1},
+            )
+    except IntegrityError:
+        rows.update(**changes)  # created concurrently
+
+
+def mark_read(user_id, peer_id, count=None):
+    """`count` messages from peer_id were marked read by user_id (None: all of them)."""
+    if count == 0 or user_id == peer_id:
+        return
+    low, high = pair(user_id, peer_id)
+    field = _side(user_id, low)
+    value = 0 if count is None else Greatest(F(field) - count, Value(0))
+    _model().objects.filter(user_low_id=low, user_high_id=high).update(**{field: value})
+
+
+def for_user(user_id):
+    """The user's conversations, most recent first."""
+    return _model().objects.filter(Q(user_low_id=user_id) | Q(user_high_id=user_id)) \
+        .select_related("last_message").order_by("-last_message_at")
+
+
+def summaries_by_peer(user_id):
+    """{peer_id: (last_message_at, unread_for_user, last_message_text)}"""
+    result = {}
+    for conv in for_user(user_id):
+        mine_low = conv.user_low_id == user_id
+        peer = conv.user_high_id if mine_low else conv.user_low_id
+        text = conv.last_message.content if conv.last_message else ""
+        result[peer] = (conv.last_message_at, conv.unread_low if mine_low else conv.unread_high, text)
+    return result
+
+
+def compute_rows():
+    """Conversation field dicts recomputed from Message (a GROUP BY over the whole table)."""
+    Message = global_apps.get_model("SmileHealth", "Message")
+    stats = list(
+        Message.objects.order_by()
+        .annotate(low=Least("sender_id", "receiver_id"), high=Greatest("sender_id", "receiver_id"))
+        .values("low", "high")
+        .annotate(
+            last_id=Max("id"),
+            unread_low=Count("id", filter=Q(is_read=False, receiver_id=F("low"))),
+            unread_high=Count("id", filter=Q(is_read=False, receiver_id=F("high"))),
+        )
+        .filter(low__lt=F("high"))
+    )
+    # Max(id) is the newest message; ids and auto_now_add timestamps grow together
+    timestamps = {}
+    last_ids = [row["last_id"] for row in stats]
+    for start in range(0, len(last_ids), BATCH_SIZE):
+        timestamps.update(
+            Message.objects.filter(id__in=last_ids[start:start + BATCH_SIZE]).values_list("id", "timestamp")
+        )
+    for row in stats:
+        yield {
+            "user_low_id": row["low"],
+            "user_high_id": row["high"],
+            "last_message_id": row["last_id"],
+            "last_message_at": timestamps[row["last_id"]],
+            "unread_low": row["unread_low"],
+            "unread_high": row["unread_high"],
+        }
+
+
+def rebuild():
+    """Replace the whole table with rows recomputed from Message. Returns the row count."""
+    Conversation = _model()
+    rows = [Conversation(**fields) for fields in compute_rows()]
+    with transaction.atomic():
+        Conversation.objects.all().delete()
+        Conversation.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+    return len(rows)
+
+
+def verify():
+    """[(user_low_id, user_high_id, stored, expected)] for rows that differ from Message."""
+    fields = ("last_message_id", "last_message_at", "unread_low", "unread_high")
+    expected = {(r["user_low_id"], r["user_high_id"]): tuple(r[f] for f in fields) for r in compute_rows()}
+    stored = {
+        (row[0], row[1]): tuple(row[2:])
+        for row in _model().objects.values_list("user_low_id", "user_high_id", *fields)
+    }
+    return [
+        (low, high, stored.get((low, high)), expected.get((low, high)))
+        for low, high in sorted(expected.keys() | stored.keys())
+        if stored.get((low, high)) != expected.get((low, high))
+    ]
@@ -0,0 +1,116 @@
+# SmileHealth/derivatives.py
+"""
+Display copies of patient images, so the gallery does not download 5-20 MB
+originals for every tile:
+
+- thumbnail: THUMBNAIL_SIZE JPEG, centre-cropped, for the gallery grid
+- preview:   WebP, longest side PREVIEW_MAX, for the viewer overlay
+
+Both are written next to the original ("<name>_thumb.jpg",
+"<name>_preview.webp") and recorded on Image. The original is still what
+the download button serves.
+
+New uploads get an "image.derivatives" job from the post_save signal (see
+signals.py and tasks.py). `manage.py build_image_derivatives` backfills
+existing images in a process pool. In both cases workers only read and
+write files; the parent process writes to the database. Raising
+DERIVATIVES_VERSION makes the backfill redo images built with older
+settings.
+
+The original is decoded once, with JPEG draft mode scaling it down already
+in the decoder, and both sizes are cut from that one decode. 16-bit X-rays
+are stretched to 8 bits over their own value range instead of being
+clipped.
+"""
+import io
+import math
+import os
+
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage, ImageOps
+
+from .models import Image
+
+DERIVATIVES_VERSION = 1
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_QUALITY = 80
+PREVIEW_MAX = 1600
+PREVIEW_QUALITY = 80
+
+# Raised by Pillow for unreadable, truncated or oversized files
+RENDER_ERRORS = (OSError, ValueError, SyntaxError, PILImage.DecompressionBombError)
+
+
+def _storage():
+    return Image._meta.get_field("image").storage
+
+
+def _decode(fp):
+    """Open the original at (about) preview resolution, upright, as 8-bit L or RGB."""
+    img = PILImage.open(fp)
+    width, height = img.size
+    if max(width, height) > PREVIEW_MAX:
+        scale = PREVIEW_MAX / max(width, height)
+        # JPEG only: decode at 1/2, 1/4 or 1/8 scale, never below the requested size
+        img.draft(img.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+    img = ImageOps.exif_transpose(img)
+
+    if img.mode in ("I", "F") or img.mode.startswith("I;16"):
+        img = img.convert("F")
+        low, high = img.getextrema()
+        span = (high - low) or 1
+        img = img.point(lambda v: (v - low) * 255.0 / span).convert("L")
+    elif img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info):
+        rgba = img.convert("RGBA")
+        img = PILImage.new("RGB", rgba.size, "white")
+        img.paste(rgba, mask=rgba.getchannel("A"))
+    elif img.mode not in ("L", "RGB"):
+        img = img.convert("RGB")
+    return img
+
+
+def render(fp):
+    """(thumbnail JPEG bytes, preview WebP bytes) for an open image file."""
+    img = _decode(fp)
+    preview = img.copy()
+    preview.thumbnail((PREVIEW_MAX, PREVIEW_MAX), PILImage.LANCZOS, reducing_gap=3.0)
+    thumbnail = ImageOps.fit(preview, THUMBNAIL_SIZE, PILImage.LANCZOS)
+
+    thumb_out, preview_out = io.BytesIO(), io.BytesIO()
+    thumbnail.save(thumb_out, "JPEG", quality=THUMBNAIL_QUALITY, optimize=True, progressive=True)
+    preview.save(preview_out, "WEBP", quality=PREVIEW_QUALITY, method=4)
+    return thumb_out.getvalue(), preview_out.getvalue()
+
+
+def create_files(name, replace=()):
+    """
+    Render the derivatives of the stored original `name` and save them next to
+    it. Files named in `replace` (derivatives of an earlier run) are deleted
+    first. Returns (thumbnail name, preview name). Touches no database.
+    """
+    storage = _storage()
+    with storage.open(name, "rb") as fp:
+        thumb, preview = render(fp)
+    for old in replace:
+        if old:
+            storage.delete(old)
+    stem = os.path.splitext(name)[0]
+    return (
+        storage.save(f"{stem}_thumb.jpg", ContentFile(thumb)),
+        storage.save(f"{stem}_preview.webp", ContentFile(preview)),
+    )
+
+
+def record(image_id, thumbnail, preview):
+    # update(): no post_save, so the upload signals do not run again
+    Image.objects.filter(pk=image_id).update(
+        thumbnail=thumbnail, preview=preview, derivatives_version=DERIVATIVES_VERSION,
+    )
+
+
+def pending(force=False):
+    """Images whose derivatives are missing or were built with older settings."""
+    qs = Image.objects.exclude(image="")
+    if not force:
+        qs = qs.filter(derivatives_version__lt=DERIVATIVES_VERSION)
+    return qs
@@ -0,0 +1,88 @@
+# SmileHealth/directory.py
+"""
+Process-wide directory of active users for chat lists and share pickers.
+
+Holds only id, username, display name and avatar URL per user (no password
+hashes or other User columns). The snapshot is rebuilt lazily when the
+"directory" cache version changes (bumped by User/Profile signals) or after
+DIRECTORY_TTL seconds as a safety net.
+"""
+import threading
+import time
+
+from django.contrib.auth.models import User
+
+from . import cache
+
+DIRECTORY_SCOPE = "directory"
+DIRECTORY_TTL = 5 * 60
+DEFAULT_AVATAR_URL = "https://i.pravatar.cc/150?img=1"
+
+
+class DirectoryUser:
+    __slots__ = ("id", "username", "display_name", "avatar_url", "search_text")
+
+    def __init__(self, id, username, first_name, last_name, avatar_url):
+        self.id = id
+        self.username = username
+        full_name = f"{first_name} {last_name}".strip()
+        self.display_name = full_name or username
+        self.avatar_url = avatar_url or DEFAULT_AVATAR_URL
+        self.search_text = f"{self.display_name} {username}".lower()
+
+    @property
+    def initial(self):
+        return self.display_name[:1].upper()
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "name": self.display_name,
+            "avatar_url": self.avatar_url,
+        }
+
+
+_lock = threading.Lock()
+_snapshot = {"version": None, "loaded_at": 0.0, "users": ()}
+
+
+def _load():
+    rows = User.objects.filter(is_active=True).order_by("id").values_list(
+        "id", "username", "first_name", "last_name", "profile__avatar_url",
+    )
+    return tuple(DirectoryUser(*row) for row in rows)
+
+
+def active_users():
+    """All active users as a tuple of DirectoryUser, cached per process."""
+    version = cache.get_version(DIRECTORY_SCOPE)
+    snap = _snapshot
+    if snap["version"] == version and time.monotonic() - snap["loaded_at"] < DIRECTORY_TTL:
+        return snap["users"]
+    with _lock:
+        if _snapshot["version"] != version or time.monotonic() - _snapshot["loaded_at"] >= DIRECTORY_TTL:
+            _snapshot.update(version=version, loaded_at=time.monotonic(), users=_load())
+        return _snapshot["users"]
+
+
+def users_except(user_id):
+    return [u for u in active_users() if u.id != user_id]
+
+
+def search(query, exclude_id=None, limit=50):
+    """Case-insensitive substring match on display name and username (limit=None: all)."""
+    terms = (query or "").lower().split()
+    matches = []
+    for u in active_users():
+        if u.id == exclude_id:
+            continue
+        if all(term in u.search_text for term in terms):
+            matches.append(u)
+            if limit is not None and len(matches) >= limit:
+                break
+    return matches
+
+
+def invalidate():
+    cache.bump(DIRECTORY_SCOPE)
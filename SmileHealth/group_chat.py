@@ -0,0 +1,157 @@
+# SmileHealth/group_chat.py
+"""
+Group conversations: everyone in a Branch (Profile.branches) or a CaseGroup
+(its creator, plus shared_with while the group is SHARED) can write to all
+members at once.
+
+send() stores a message once and adds one GroupMessageRecipient row per
+member in a single bulk INSERT. GroupChatConsumer then fans it out with one
+group_send to room_group(kind, id). NotifyConsumer joins the rooms of every
+group the user belongs to, so members without the chat open still get the
+message. The chat box in index.html lists rooms() next to the direct chats.
+
+Membership changes (signals.py) call membership_changed(). Once the
+transaction commits, it tells the affected users' sockets through
+member_group(user_id), and they join or leave the room. Sockets re-check
+is_member() before acting on the event, so the signals may over-notify.
+"""
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.db import transaction
+from django.db.models import Q
+
+from .models import Branch, CaseGroup, GroupMessage, GroupMessageRecipient, Profile
+
+# Route kind -> GroupMessage foreign key column
+KINDS = {"branch": "branch_id", "casegroup": "case_group_id"}
+HISTORY_PAGE_SIZE = 50
+
+
+def room_group(kind, target_id):
+    return f"groupchat_{kind}_{target_id}"
+
+
+def member_group(user_id):
+    return f"groupmember_{user_id}"
+
+
+def _shared_ids(user_id):
+    return CaseGroup.shared_with.through.objects.filter(user_id=user_id).values("casegroup_id")
+
+
+def _visible_case_groups(user_id):
+    return CaseGroup.objects.filter(
+        Q(created_by_id=user_id)
+        | (Q(visibility=CaseGroup.Visibility.SHARED) & Q(pk__in=_shared_ids(user_id)))
+    )
+
+
+def is_member(user_id, kind, target_id):
+    if kind == "branch":
+        return Profile.objects.filter(user_id=user_id, branches=target_id).exists()
+    return _visible_case_groups(user_id).filter(pk=target_id).exists()
+
+
+def member_ids(kind, target_id):
+    """Ids of the users a message to this group is delivered to (one query)."""
+    if kind == "branch":
+        return list(Profile.objects.filter(branches=target_id).values_list("user_id", flat=True))
+    owner = CaseGroup.objects.filter(pk=target_id).values_list("created_by_id", flat=True)
+    shared = CaseGroup.shared_with.through.objects.filter(
+        casegroup_id=target_id, casegroup__visibility=CaseGroup.Visibility.SHARED,
+    ).values_list("user_id", flat=True)
+    return list(owner.union(shared))
+
+
+def memberships(user_id):
+    """[(kind, target_id)] of every group conversation the user belongs to."""
+    branches = Profile.branches.through.objects.filter(profile__user_id=user_id).values_list("branch_id", flat=True)
+    groups = _visible_case_groups(user_id).values_list("id", flat=True)
+    return [("branch", pk) for pk in branches] + [("casegroup", pk) for pk in groups]
+
+
+def rooms(user_id):
+    """[{kind, id, name}] of the user's group conversations for the chat list, by name (two queries)."""
+    branches = Branch.objects.filter(users__user_id=user_id).order_by("name").values_list("id", "name")
+    groups = _visible_case_groups(user_id).order_by("name").values_list("id", "name")
+    return [
+        {"kind": kind, "id": pk, "name": name}
+        for kind, rows in (("branch", branches), ("casegroup", groups))
+        for pk, name in rows
+    ]
+
+
+def send(sender_id, kind, target_id, content):
+    """
+    Store a message for every current member: the message INSERT, one SELECT
+    for the member ids and one bulk INSERT for the recipient rows, whatever
+    the size of the group. The sender gets no recipient row.
+    """
+    with transaction.atomic():
+        message = GroupMessage.objects.create(sender_id=sender_id, content=content, **{KINDS[kind]: target_id})
+        GroupMessageRecipient.objects.bulk_create([
+            GroupMessageRecipient(message=message, user_id=user_id)
+            for user_id in member_ids(kind, target_id) if user_id != sender_id
+        ])
+    return message
+
+
+def history_page(kind, target_id, before=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Up to `limit` messages older than the (timestamp, id) cursor `before`,
+    oldest first, in the shape ChatConsumer uses for its history frames.
+    """
+    qs = GroupMessage.objects.filter(**{KINDS[kind]: target_id})
+    if before is not None:
+        ts, msg_id = before
+        qs = qs.filter(Q(timestamp__lt=ts) | Q(timestamp=ts, id__lt=msg_id))
+    rows = list(
+        qs.order_by("-timestamp", "-id")
+        .values("id", "content", "sender_id", "sender__username", "timestamp")[:limit + 1]
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+
+    cursor = None
+    if has_more:
+        cursor = {"timestamp": rows[0]["timestamp"].isoformat(), "id": rows[0]["id"]}
+    return {
+        "messages": [
+            {
+                "message": r["content"],
+                "sender_id": r["sender_id"],
+                "sender_username": r["sender__username"],
+                "message_id": r["id"],
+                "timestamp": r["timestamp"].strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            for r in rows
+        ],
+        "has_more": has_more,
+        "cursor": cursor,
+    }
+
+
+def mark_read(user_id, kind, target_id, upto=None):
+    """Mark the user's recipient rows in this group read (up to message id `upto`); one UPDATE."""
+    qs = GroupMessageRecipient.objects.filter(
+        user_id=user_id, is_read=False, **{f"message__{KINDS[kind]}": target_id},
+    )
+    if upto is not None:
+        qs = qs.filter(message_id__lte=upto)
+    return qs.update(is_read=True)
+
+
+def membership_changed(user_ids, kind, target_id, joined):
+    user_ids = [user_id for user_id in user_ids if user_id]
+    if user_ids:
+        transaction.on_commit(lambda: _push_membership(user_ids, kind, target_id, joined))
+
+
+def _push_membership(user_ids, kind, target_id, joined):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    event = {"type": "group.membership", "kind": kind, "target_id": target_id, "joined": joined}
+    for user_id in user_ids:
+        async_to_sync(layer.group_send)(member_group(user_id), event)
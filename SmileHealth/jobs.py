@@ -0,0 +1,179 @@
+# SmileHealth/jobs.py
+"""
+Local job queue in the Job table, so requests only store what was uploaded
+and return. `manage.py run_jobs` works it off with a process pool.
+
+A job kind (registered in SmileHealth/tasks.py) has two parts:
+
+- run(payload): executed in a worker process. It reads and writes files and
+  returns a JSON-serialisable result. It must not touch the database.
+- apply(payload, result): executed in the run_jobs parent. It records the
+  result, e.g. fills Image.thumbnail. Optional.
+
+Web requests (and signals) insert Job rows through enqueue(); everything
+after that is written by the run_jobs parent: claims, results, retries and
+purges. Worker processes never write, so each write is a short transaction
+that SQLite's single writer serialises with the requests' own.
+
+enqueue() inserts the row in the caller's transaction, so a job never sees
+rows that were rolled back. claim() picks due PENDING rows with a single
+UPDATE, which is safe when several workers poll the same table.
+
+A job that raises is retried after RETRY_BASE * 2**(attempts-1) seconds
+(with jitter, capped at RETRY_MAX) until max_attempts is reached. Raise
+PermanentError to fail a job at once, e.g. for a file Pillow cannot read.
+A worker that dies mid-job leaves it RUNNING; after LOCK_TIMEOUT the job is
+handed out again.
+"""
+import random
+import traceback
+import uuid
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import Callable, Optional
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import Job
+
+RETRY_BASE = 10          # seconds before the first retry
+RETRY_MAX = 60 * 60      # longest wait between attempts
+LOCK_TIMEOUT = timedelta(minutes=15)
+KEEP_DONE = timedelta(days=7)
+
+
+class PermanentError(Exception):
+    """Raised by a job's run() when retrying cannot help."""
+
+
+@dataclass(frozen=True)
+class Kind:
+    run: Callable
+    apply: Optional[Callable] = None
+    max_attempts: int = 5
+
+
+KINDS = {}
+
+
+def register(name, run, apply=None, max_attempts=5):
+    KINDS[name] = Kind(run, apply, max_attempts)
+
+
+def enqueue(kind, payload, patient_id=None, created_by_id=None, delay=0):
+    if kind not in KINDS:
+        raise ValueError(f"Unknown job kind {kind!r}")
+    return Job.objects.create(
+        kind=kind,
+        payload=payload,
+        max_attempts=KINDS[kind].max_attempts,
+        run_after=timezone.now() + timedelta(seconds=delay),
+        patient_id=patient_id,
+        created_by_id=created_by_id,
+    )
+
+
+def claim(worker, limit):
+    """Lock up to `limit` due jobs for `worker` and return them, oldest due first."""
+    now = timezone.now()
+    token = f"{worker}:{uuid.uuid4().hex[:8]}"
+    due = Job.objects.filter(status=Job.Status.PENDING, run_after__lte=now).order_by("run_after", "id")
+    # status is re-checked by the UPDATE itself: a row another worker took meanwhile is skipped
+    Job.objects.filter(pk__in=due.values("pk")[:limit], status=Job.Status.PENDING).update(
+        status=Job.Status.RUNNING, locked_by=token, locked_at=now, attempts=F("attempts") + 1,
+    )
+    return list(Job.objects.filter(locked_by=token, status=Job.Status.RUNNING).order_by("run_after", "id"))
+
+
+def execute(kind, payload):
+    """
+    Run a job's run() part; called in the worker process. Returns
+    ("ok", result) or ("error", permanent, message), because arbitrary
+    exceptions do not always survive the trip back to the parent.
+    """
+    try:
+        return "ok", KINDS[kind].run(payload)
+    except PermanentError as exc:
+        return "error", True, str(exc)
+    except Exception:
+        return "error", False, traceback.format_exc(limit=5)
+
+
+def finish(job, outcome):
+    """Apply a worker's outcome to the job (parent process)."""
+    if outcome[0] == "ok":
+        try:
+            with transaction.atomic():
+                apply = KINDS[job.kind].apply
+                if apply is not None:
+                    apply(job.payload, outcome[1])
+                _update(job, status=Job.Status.DONE, finished_at=timezone.now(), last_error="")
+            return
+        except Exception:
+            outcome = ("error", False, traceback.format_exc(limit=5))
+    _, permanent, message = outcome
+    if permanent or job.attempts >= job.max_attempts:
+        _update(job, status=Job.Status.FAILED, finished_at=timezone.now(), last_error=message)
+    else:
+        _update(job, status=Job.Status.PENDING, run_after=timezone.now() + backoff(job.attempts), last_error=message)
+
+
+def backoff(attempts):
+    delay = min(RETRY_BASE * 2 ** max(attempts - 1, 0), RETRY_MAX)
+    return timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+def _update(job, **fields):
+    fields.setdefault("locked_by", "")
+    fields.setdefault("locked_at", None)
+    for name, value in fields.items():
+        setattr(job, name, value)
+    Job.objects.filter(pk=job.pk).update(**fields)
+
+
+def run_pending(worker="inline", limit=100):
+    """Claim and run due jobs in this process until none are left; returns how many ran."""
+    ran = 0
+    while True:
+        batch = claim(worker, limit)
+        if not batch:
+            return ran
+        for job in batch:
+            finish(job, execute(job.kind, job.payload))
+        ran += len(batch)
+
+
+def release(job_ids):
+    """Hand claimed jobs back without counting the attempt (worker shutting down)."""
+    return Job.objects.filter(pk__in=job_ids, status=Job.Status.RUNNING).update(
+        status=Job.Status.PENDING, attempts=F("attempts") - 1, locked_by="", locked_at=None,
+    )
+
+
+def requeue_stale(now=None):
+    """RUNNING jobs whose worker went away without finishing them become due again."""
+    now = now or timezone.now()
+    return Job.objects.filter(status=Job.Status.RUNNING, locked_at__lt=now - LOCK_TIMEOUT).update(
+        status=Job.Status.PENDING, run_after=now, locked_by="", locked_at=None,
+    )
+
+
+def purge(now=None):
+    """Delete DONE jobs older than KEEP_DONE; FAILED ones stay for inspection."""
+    now = now or timezone.now()
+    return Job.objects.filter(status=Job.Status.DONE, finished_at__lt=now - KEEP_DONE).delete()[0]
+
+
+def status(job):
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "status": job.status,
+        "attempts": job.attempts,
+        "max_attempts": job.max_attempts,
+        "run_after": job.run_after.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+        "error": job.last_error.strip().splitlines()[-1] if job.last_error.strip() else "",
+    }
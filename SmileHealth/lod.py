@@ -0,0 +1,208 @@
+# SmileHealth/lod.py
+"""
+Level-of-detail variants of uploaded STL scans, so the viewer can show a
+coarse mesh within a fraction of a second and refine it while the finer
+levels download, instead of waiting for the whole STL file.
+
+Each level (LEVELS: fractions of the original triangle count) is stored
+next to the original as "<name>_lod<percent>.mesh" in this format, all
+little-endian:
+
+    header   "SHM1", vertex count, triangle count, index size (2 or 4),
+             origin (3 x float32), step (float32)           -- 32 bytes
+    vertices uint16 x 3 per vertex, padded to 4 bytes
+    indices  uint16 or uint32 x 3 per triangle
+
+A vertex is origin + step * (x, y, z). Every level shares one origin and
+step, so the viewer can swap levels without moving the model. 16 bits over
+the longest side of a dental model are about a micrometre. Vertices are
+shared (the STL repeats them for every triangle), which together with the
+quantisation makes the full level about a third of the binary STL.
+
+Coarser levels use vertex clustering: vertices are merged per grid cell,
+and the grid is refined until the triangle count is near the target.
+Levels below MIN_TRIANGLES are skipped; the full level always exists.
+
+New uploads get a "model3d.lods" job (see signals.py and tasks.py);
+`manage.py build_model_lods` backfills existing models. The viewer reads
+views.model_manifest.
+"""
+import math
+import os
+import struct
+
+import numpy as np
+from django.core.files.base import ContentFile
+
+from . import stl
+from .models import Model3D
+
+LOD_VERSION = 1
+LEVELS = (0.05, 0.25, 1.0)
+MIN_TRIANGLES = 2_000        # no coarse level below this many triangles
+TOLERANCE = 0.15             # of the target triangle count
+SEARCH_STEPS = 6
+QUANT_MAX = 0xFFFF
+
+MAGIC = b"SHM1"
+HEADER = struct.Struct("<4sIII3ff")
+
+
+def _storage():
+    return Model3D._meta.get_field("file").storage
+
+
+def quantize(triangles):
+    """(uint16 vertices (n*3, 3), origin, step) on one grid over the model's longest side."""
+    vertices = triangles.reshape(-1, 3)
+    origin = vertices.min(axis=0)
+    step = float((vertices.max(axis=0) - origin).max()) / QUANT_MAX or 1.0
+    grid = np.rint((vertices - origin) / np.float32(step))
+    return np.clip(grid, 0, QUANT_MAX).astype(np.uint16), origin, step
+
+
+def _keys(vertices, bits=16):
+    v = vertices.astype(np.uint64)
+    return (v[:, 0] << np.uint64(2 * bits)) | (v[:, 1] << np.uint64(bits)) | v[:, 2]
+
+
+def weld(vertices):
+    """Share identical vertices: (unique vertices, faces as index triples)."""
+    _, first, inverse = np.unique(_keys(vertices), return_index=True, return_inverse=True)
+    return vertices[first], inverse.reshape(-1, 3).astype(np.uint32)
+
+
+def _proper(faces):
+    return (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2])
+
+
+def _compact(vertices, faces):
+    """Drop degenerate and repeated faces and vertices no face uses."""
+    faces = faces[_proper(faces)]
+    ordered = np.sort(faces, axis=1)
+    if len(vertices) < 1 << 21:
+        _, keep = np.unique(_keys(ordered, bits=21), return_index=True)
+    else:
+        _, keep = np.unique(ordered, axis=0, return_index=True)
+    faces = faces[np.sort(keep)]  # the first copy keeps its winding
+    used, remap = np.unique(faces, return_inverse=True)
+    return vertices[used], remap.reshape(-1, 3).astype(np.uint32)
+
+
+def _cluster(vertices, faces, cells):
+    """Merge the vertices in each of `cells` grid cells along the longest side into their mean."""
+    size = max(1, math.ceil((QUANT_MAX + 1) / cells))
+    _, cluster = np.unique(_keys(vertices // size), return_inverse=True)
+    counts = np.bincount(cluster)
+    merged = np.stack([np.bincount(cluster, weights=vertices[:, axis]) for axis in range(3)], axis=1)
+    merged = np.rint(merged / counts[:, None]).astype(np.uint16)
+    return merged, cluster.astype(np.uint32)[faces]
+
+
+def decimate(vertices, faces, target):
+    """About `target` faces by vertex clustering; the grid is refined until the count is near it."""
+    cells = max(2, int(math.sqrt(target)))  # a closed surface has about 4 * cells**2 / 3 faces
+    best = None
+    for _ in range(SEARCH_STEPS):
+        merged, clustered = _cluster(vertices, faces, cells)
+        count = int(_proper(clustered).sum())
+        if best is None or abs(count - target) < abs(best[2] - target):
+            best = merged, clustered, count
+        if abs(count - target) <= TOLERANCE * target or cells > QUANT_MAX:
+            break
+        cells = max(2, int(cells * math.sqrt(target / max(count, 1))))
+    return _compact(*best[:2])
+
+
+def encode(vertices, faces, origin, step):
+    index = np.dtype("<u2") if len(vertices) <= 0x10000 else np.dtype("<u4")
+    positions = vertices.astype("<u2").tobytes()
+    return b"".join((
+        HEADER.pack(MAGIC, len(vertices), len(faces), index.itemsize, *map(float, origin), step),
+        positions,
+        b"\0" * (-len(positions) % 4),
+        faces.astype(index).tobytes(),
+    ))
+
+
+def decode(data):
+    """(float32 vertices, faces) of an encoded level; the inverse of encode()."""
+    magic, nv, nt, index_size, ox, oy, oz, step = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("not a SmileHealth mesh")
+    offset = HEADER.size + nv * 6 + (-nv * 6 % 4)
+    vertices = np.frombuffer(data, "<u2", nv * 3, HEADER.size).reshape(-1, 3)
+    faces = np.frombuffer(data, f"<u{index_size}", nt * 3, offset).reshape(-1, 3)
+    return vertices * np.float32(step) + np.array([ox, oy, oz], dtype=np.float32), faces
+
+
+def build(triangles):
+    """[(ratio, encoded bytes, vertex count, face count)], coarse first."""
+    grid, origin, step = quantize(triangles)
+    vertices, faces = _compact(*weld(grid))
+    levels = []
+    for ratio in sorted(LEVELS):
+        target = int(len(triangles) * ratio)
+        if ratio < 1 and target < MIN_TRIANGLES:
+            continue
+        level = (vertices, faces) if ratio >= 1 else decimate(vertices, faces, target)
+        levels.append((ratio, encode(*level, origin, step), len(level[0]), len(level[1])))
+    return levels
+
+
+def create_files(name, replace=()):
+    """
+    Build the levels of the stored STL `name` and save them next to it.
+    Files named in `replace` (levels of an earlier run) are deleted first.
+    Returns the manifest entries for Model3D.lods. Touches no database.
+    """
+    storage = _storage()
+    with storage.open(name, "rb") as fp:
+        levels = build(stl.load(fp))
+    for old in replace:
+        storage.delete(old)
+    stem = os.path.splitext(name)[0]
+    return [
+        {
+            "ratio": ratio,
+            "name": storage.save(f"{stem}_lod{round(ratio * 100)}.mesh", ContentFile(data)),
+            "vertices": nv,
+            "triangles": nt,
+            "bytes": len(data),
+        }
+        for ratio, data, nv, nt in levels
+    ]
+
+
+def record(model_id, lods):
+    # update(): no post_save, so the upload signals do not run again
+    Model3D.objects.filter(pk=model_id).update(lods=lods, lod_version=LOD_VERSION)
+
+
+def pending(force=False):
+    """Models without levels or with levels built with older settings."""
+    qs = Model3D.objects.exclude(file="")
+    if not force:
+        qs = qs.filter(lod_version__lt=LOD_VERSION)
+    return qs
+
+
+def manifest(model):
+    storage = _storage()
+    return {
+        "id": model.id,
+        "format": "SHM1",
+        "original": {"url": model.file.url, "bytes": _size(storage, model.file.name)},
+        "pending": model.lod_version < LOD_VERSION,
+        "levels": [
+            {key: level[key] for key in ("ratio", "vertices", "triangles", "bytes")} | {"url": storage.url(level["name"])}
+            for level in model.lods
+        ],
+    }
+
+
+def _size(storage, name):
+    try:
+        return storage.size(name)
+    except OSError:
+        return None
@@ -0,0 +1,20 @@
+import contextlib
+import os
+
+from django.core.management.base import CommandError
+from django.db import connection
+
+
+@contextlib.contextmanager
+def scratch_database(directory, name="bench.sqlite3"):
+    """Run the block against a freshly migrated SQLite database in directory."""
+    if connection.vendor != "sqlite":
+        raise CommandError("benchmarks run against SQLite; the default database is not SQLite")
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    saved_name, test_settings["NAME"] = test_settings.get("NAME"), os.path.join(directory, name)
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+    try:
+        yield
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings["NAME"] = saved_name
@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from SmileHealth import retention
+
+
+class Command(BaseCommand):
+    help = "Move read chat messages older than MESSAGE_RETENTION_DAYS to ArchivedMessage, in resumable batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, help="Override MESSAGE_RETENTION_DAYS for this run.")
+        parser.add_argument("--batch-size", type=int, default=retention.BATCH_SIZE, help="Messages per transaction.")
+        parser.add_argument("--max-batches", type=int, help="Stop after this many batches (the next run resumes).")
+        parser.add_argument("--restart", action="store_true", help="Ignore the stored cursor and start from the oldest id.")
+
+    def handle(self, *args, **options):
+        if options["batch_size"] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        before = retention.cutoff()
+        if options["days"] is not None:
+            before = timezone.now() - timedelta(days=options["days"])
+
+        def progress(count, last_id):
+            if options["verbosity"] > 1:
+                self.stdout.write(f"  moved {count} messages, cursor at id {last_id}")
+
+        moved, finished = retention.archive(
+            before=before,
+            batch_size=options["batch_size"],
+            max_batches=options["max_batches"],
+            restart=options["restart"],
+            progress=progress,
+        )
+        self.stdout.write(f"Archived {moved} messages older than {before:%Y-%m-%d %H:%M}.")
+        if finished:
+            self.stdout.write(self.style.SUCCESS("Done; the next run starts from the beginning."))
+        else:
+            self.stdout.write(self.style.WARNING("Stopped at --max-batches; the next run resumes from the cursor."))
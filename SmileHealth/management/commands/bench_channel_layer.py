@@ -0,0 +1,137 @@
+import asyncio
+import multiprocessing
+import os
+import queue
+import statistics
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from SmileHealth.channel_layers import SQLiteChannelLayer
+
+STARTUP_GRACE = 60  # seconds for a spawned worker to import Django and join its groups
+
+
+def _worker(index, path, endpoints, messages, capacity, timeout, barrier, results):
+    """One worker process: joins its chat groups, then sends and receives concurrently."""
+    layer = SQLiteChannelLayer(path, capacity=capacity, group_capacity={"chat_*": capacity})
+
+    async def join():
+        channels = {}
+        for group, side in endpoints:
+            channels[(group, side)] = await layer.new_channel()
+            await layer.group_add(group, channels[(group, side)])
+        return channels
+
+    channels = asyncio.run(join())
+    barrier.wait(STARTUP_GRACE)  # every endpoint of every worker is in its group
+
+    async def endpoint(group, side, channel):
+        async def send():
+            for seq in range(messages):
+                await layer.group_send(group, {"type": "chat.message", "side": side, "seq": seq, "sent": time.time()})
+                await asyncio.sleep(0)
+
+        latencies, received = [], 0
+        sender = asyncio.ensure_future(send())
+        deadline = time.monotonic() + timeout
+        # Both sides of the pair send `messages`; every member receives all of them
+        while received < 2 * messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                message = await asyncio.wait_for(layer.receive(channel), remaining)
+            except asyncio.TimeoutError:
+                break
+            received += 1
+            if message["side"] != side:
+                latencies.append(time.time() - message["sent"])
+        await sender
+        return received, latencies
+
+    async def run():
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(endpoint(g, s, c) for (g, s), c in channels.items()))
+        return time.perf_counter() - start, outcomes
+
+    elapsed, outcomes = asyncio.run(run())
+    results.put({
+        "worker": index,
+        "elapsed": elapsed,
+        "received": sum(r for r, _ in outcomes),
+        "expected": 2 * messages * len(endpoints),
+        "latencies": [lat for _, lats in outcomes for lat in lats],
+    })
+
+
+class Command(BaseCommand):
+    help = "Load test SQLiteChannelLayer: N worker processes exchanging messages in chat_<a>_<b> groups."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4, help="Worker processes.")
+        parser.add_argument("--pairs", type=int, default=20, help="Chat pairs (one group each, sides on different workers).")
+        parser.add_argument("--messages", type=int, default=50, help="Messages sent by each side of a pair.")
+        parser.add_argument("--capacity", type=int, default=200, help="Per-group capacity for chat_* groups.")
+        parser.add_argument("--timeout", type=float, default=30.0, help="Seconds each endpoint waits for its messages.")
+        parser.add_argument("--path", help="Layer database (default: a temporary file).")
+
+    def handle(self, *args, **options):
+        workers = options["workers"]
+        if workers < 1 or options["pairs"] < 1:
+            raise CommandError("--workers and --pairs must be at least 1")
+        path = options["path"] or os.path.join(tempfile.mkdtemp(prefix="bench_channels_"), "channels.sqlite3")
+
+        assignments = [[] for _ in range(workers)]
+        for pair in range(options["pairs"]):
+            group = f"chat_{2 * pair + 1}_{2 * pair + 2}"
+            assignments[pair % workers].append((group, "a"))
+            assignments[(pair + 1) % workers].append((group, "b"))
+
+        ctx = multiprocessing.get_context("spawn")
+        barrier = ctx.Barrier(workers)
+        results = ctx.Queue()
+        procs = [
+            ctx.Process(target=_worker, args=(
+                i, path, endpoints, options["messages"], options["capacity"], options["timeout"], barrier, results,
+            ))
+            for i, endpoints in enumerate(assignments)
+        ]
+        for proc in procs:
+            proc.start()
+        # A worker that dies (import error, crash) never reports: wait at most
+        # the receive timeout plus STARTUP_GRACE, then give up on all of them
+        deadline = time.monotonic() + options["timeout"] + STARTUP_GRACE
+        reports = []
+        try:
+            for _ in procs:
+                reports.append(results.get(timeout=max(deadline - time.monotonic(), 0.1)))
+        except queue.Empty:
+            for proc in procs:
+                proc.terminate()
+        for proc in procs:
+            proc.join()
+        failed = [(i, proc.exitcode) for i, proc in enumerate(procs) if proc.exitcode]
+        if failed or len(reports) < workers:
+            codes = ", ".join(f"worker {i}: {code}" for i, code in failed) or "none"
+            raise CommandError(f"{workers - len(reports)} worker(s) sent no report; exit codes: {codes}")
+
+        self.stdout.write(
+            f"{workers} workers, {options['pairs']} chat groups, {options['messages']} messages per side  ({path})"
+        )
+        for r in sorted(reports, key=lambda r: r["worker"]):
+            self.stdout.write(f"  worker {r['worker']}: {r['received']}/{r['expected']} delivered in {r['elapsed']:.2f} s")
+
+        received = sum(r["received"] for r in reports)
+        expected = sum(r["expected"] for r in reports)
+        elapsed = max(r["elapsed"] for r in reports)
+        latencies = sorted(lat * 1000 for r in reports for lat in r["latencies"])
+        self.stdout.write(f"delivered {received}/{expected}  ({received / elapsed:.0f} msg/s)")
+        if latencies:
+            pct = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+            self.stdout.write(
+                f"cross-process latency: p50 {pct[49]:.1f} ms  p95 {pct[94]:.1f} ms  max {latencies[-1]:.1f} ms"
+            )
+        style = self.style.SUCCESS if received == expected else self.style.WARNING
+        self.stdout.write(style("all messages delivered" if received == expected else "messages dropped or timed out"))
@@ -0,0 +1,208 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import statistics
+import tempfile
+import time
+from collections import Counter
+from datetime import timedelta
+
+from asgiref.sync import async_to_sync
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from SmileHealth import conversations
+from SmileHealth.consumers import ChatConsumer
+from SmileHealth.models import Message
+
+from ._scratch import scratch_database
+
+
+class StatementCounter:
+    """connection.execute_wrapper that tallies statements by their first keyword."""
+
+    def __init__(self):
+        self.counts = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        self.counts[sql.lstrip().split(None, 1)[0].upper()] += 1
+        return execute(sql, params, many, context)
+
+    def take(self):
+        counts, self.counts = self.counts, Counter()
+        return counts
+
+
+def _percentiles(samples):
+    """(p50, p95, p99, max) in milliseconds."""
+    ms = sorted(s * 1000 for s in samples)
+    if len(ms) == 1:
+        return ms * 4
+    pct = statistics.quantiles(ms, n=100, method="inclusive")
+    return pct[49], pct[94], pct[98], ms[-1]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test ChatConsumer through WebsocketCommunicator: N user pairs connect (history replay "
+        "included) and exchange messages. Runs against a throwaway SQLite database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--pairs", type=int, default=200, help="Simulated user pairs (two sockets each).")
+        parser.add_argument("--messages", type=int, default=10, help="Round trips per pair (one message each way).")
+        parser.add_argument("--history", type=int, default=60, help="Messages seeded per pair before connecting.")
+        parser.add_argument("--layer", choices=("memory", "sqlite"), default="memory",
+                            help="Channel layer: InMemoryChannelLayer or SQLiteChannelLayer on a temp file.")
+        parser.add_argument("--timeout", type=float, default=30.0, help="Seconds to wait for any single frame.")
+        parser.add_argument("--verbose-consumer", action="store_true",
+                            help="Keep the consumer's connect/disconnect prints.")
+
+    def handle(self, *args, **options):
+        if options["pairs"] < 1 or options["messages"] < 1 or options["history"] < 0:
+            raise CommandError("--pairs and --messages must be at least 1, --history at least 0")
+
+        with tempfile.TemporaryDirectory(prefix="bench_chat_") as tmp:
+            layer = {"BACKEND": "channels.layers.InMemoryChannelLayer", "CONFIG": {"capacity": 1000}}
+            if options["layer"] == "sqlite":
+                layer = {
+                    "BACKEND": "SmileHealth.channel_layers.SQLiteChannelLayer",
+                    "CONFIG": {"path": os.path.join(tmp, "channels.sqlite3"), "capacity": 1000,
+                               "group_capacity": {"chat_*": 1000}},
+                }
+            # Keep the real cache (unread counters, directory) and db.sqlite3 out of it
+            isolated = override_settings(
+                CHANNEL_LAYERS={"default": layer},
+                CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+                                    "LOCATION": "bench_chat"}},
+            )
+            with isolated, scratch_database(tmp):
+                self._run(options)
+
+    def _seed(self, pairs, history):
+        User.objects.bulk_create([User(username=f"bench_chat_{i}") for i in range(2 * pairs)])
+        users = list(User.objects.order_by("id"))
+        start = timezone.now() - timedelta(days=1)
+        Message.objects.bulk_create([
+            Message(
+                sender=users[2 * p + n % 2], receiver=users[2 * p + 1 - n % 2],
+                content=f"Verlauf {n}", timestamp=start + timedelta(seconds=n),
+                is_read=n < history - 5,  # the last few are unread and get marked on connect
+            )
+            for p in range(pairs) for n in range(history)
+        ], batch_size=2000)
+        conversations.rebuild()
+        return [(users[2 * p], users[2 * p + 1]) for p in range(pairs)]
+
+    def _run(self, options):
+        pairs = self._seed(options["pairs"], options["history"])
+        counter = StatementCounter()
+        quiet = contextlib.nullcontext() if options["verbose_consumer"] else contextlib.redirect_stdout(io.StringIO())
+        with connection.execute_wrapper(counter), quiet:
+            # database_sync_to_async runs in this thread, so the wrapper sees every statement
+            report = async_to_sync(self._drive)(pairs, options, counter)
+        self._report(options, report)
+
+    async def _drive(self, pairs, options, counter):
+        timeout = options["timeout"]
+
+        def communicator(user, peer):
+            comm = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{peer.id}/")
+            comm.scope["user"] = user
+            comm.scope["url_route"] = {"kwargs": {"receiver_id": str(peer.id)}}
+            return comm
+
+        sockets = [(communicator(a, b), communicator(b, a)) for a, b in pairs]
+
+        async def connect(comm):
+            start = time.perf_counter()
+            connected, _ = await comm.connect(timeout=timeout)
+            if not connected:
+                raise CommandError("ChatConsumer rejected a benchmark connection")
+            frame = json.loads(await comm.receive_from(timeout=timeout))
+            assert frame["type"] == "history"
+            return time.perf_counter() - start
+
+        start = time.perf_counter()
+        connect_times = await asyncio.gather(*(connect(c) for pair in sockets for c in pair))
+        connect_wall = time.perf_counter() - start
+        connect_statements = counter.take()
+
+        ephemeral = Counter()
+
+        async def next_message(comm):
+            # typing/seen frames interleave with chat messages; count and skip them
+            while True:
+                frame = json.loads(await comm.receive_from(timeout=timeout))
+                if "type" not in frame:
+                    return frame
+                ephemeral[frame["type"]] += 1
+
+        async def converse(a, b):
+            latencies = []
+            for n in range(options["messages"]):
+                for sender, peer in ((a, b), (b, a)):
+                    sent = time.perf_counter()
+                    await sender.send_to(text_data=json.dumps({"message": f"Nachricht {n}"}))
+                    await next_message(peer)
+                    latencies.append(time.perf_counter() - sent)
+                    await next_message(sender)  # the sender's own echo
+            return latencies
+
+        start = time.perf_counter()
+        fanout = await asyncio.gather(*(converse(a, b) for a, b in sockets))
+        message_wall = time.perf_counter() - start
+        # Read receipts and activity rows are flushed on disconnect; they belong to the messages
+        await asyncio.gather(*(c.disconnect() for pair in sockets for c in pair))
+        message_statements = counter.take()
+
+        return {
+            "connect_times": connect_times,
+            "connect_wall": connect_wall,
+            "connect_statements": connect_statements,
+            "fanout": [lat for lats in fanout for lat in lats],
+            "message_wall": message_wall,
+            "message_statements": message_statements,
+            "ephemeral": ephemeral,
+        }
+
+    def _report(self, options, r):
+        sockets = 2 * options["pairs"]
+        messages = 2 * options["pairs"] * options["messages"]
+
+        def breakdown(counts):
+            return ", ".join(f"{kind} {n}" for kind, n in counts.most_common())
+
+        self.stdout.write(
+            f"{options['pairs']} pairs ({sockets} sockets), {options['history']} history messages per pair, "
+            f"{options['messages']} round trips per pair, {options['layer']} channel layer"
+        )
+        p50, p95, p99, top = _percentiles(r["connect_times"])
+        self.stdout.write(
+            f"connect + history: p50 {p50:.1f} ms  p95 {p95:.1f} ms  p99 {p99:.1f} ms  max {top:.1f} ms  "
+            f"({sockets / r['connect_wall']:.0f} connects/s)"
+        )
+        p50, p95, p99, top = _percentiles(r["fanout"])
+        self.stdout.write(
+            f"fan-out (send -> peer): p50 {p50:.1f} ms  p95 {p95:.1f} ms  p99 {p99:.1f} ms  max {top:.1f} ms  "
+            f"({messages / r['message_wall']:.0f} msg/s)"
+        )
+        connect_total = sum(r["connect_statements"].values())
+        message_total = sum(r["message_statements"].values())
+        self.stdout.write(
+            f"statements per connect: {connect_total / sockets:.2f}  ({breakdown(r['connect_statements'])})"
+        )
+        self.stdout.write(
+            f"statements per message: {message_total / messages:.2f}  ({breakdown(r['message_statements'])})"
+        )
+        if r["ephemeral"]:
+            self.stdout.write(f"ephemeral frames during the exchange: {breakdown(r['ephemeral'])}")
+        stored = Message.objects.count() - options["pairs"] * options["history"]
+        style = self.style.SUCCESS if stored == messages else self.style.ERROR
+        self.stdout.write(style(f"{stored}/{messages} messages stored"))
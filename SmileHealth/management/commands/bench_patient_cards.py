@@ -0,0 +1,168 @@
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from SmileHealth.cards import CARD_FIELDS, build_patient_cards
+from SmileHealth.models import Patient
+
+from ._scratch import scratch_database
+
+# Card markup as it was before PatientCard view-models (reads patient.shared_with per card)
+LEGACY_CARD_TEMPLATE = """{% load static %}
+{% for patient in patients %}
+<div class="col-6 col-sm-4 col-md-3 col-lg-2 fall-card" data-patient-name="{{ patient.ptnName }} {{ patient.ptnLastname }}">
+  <div class="card text-center position-relative" style="height: 180px;">
+    {% if patient.usrID_id == request.user.id %}
+      <a href="{% url 'patient_manage' patient.id %}" class="btn btn-light btn-sm gear-btn" title="Patient verwalten">
+        <i class="fas fa-cog"></i>
+      </a>
+      <!-- Owner-only share shortcut: opens manage page with ?open=share -->
+
+    {% endif %}
+
+    <a href="{% url 'patientImage' patient.id %}" style="text-decoration: none; color: inherit;">
+      {% if patient.thumbnail %}
+        <img src="{{ patient.thumbnail.url }}" class="patient-thumb" alt="Thumbnail von {{ patient.ptnName }} {{ patient.ptnLastname }}">
+      {% else %}    
+        <div class="bg-info d-flex align-items-center justify-content-center" style="height:105px; border-top-left-radius:.25rem; border-top-right-radius:.25rem;">
+          <img src="https://img.icons8.com/ios-filled/40/ffffff/task.png" alt="Case Icon">
+        </div>
+      {% endif %}
+      <div class="card-body d-flex flex-column justify-content-center align-items-center p-2">
+        <h6 class="fw-bold mb-0">
+          {{ patient.ptnName }} {{ patient.ptnLastname }}
+          {% if patient.visibility == 'PRIVATE' %}
+            <span class="vis-badge vis-private" title="Nur Eigentümer und Admins">Privat</span>
+          {% elif patient.visibility == 'SHARED' %}
+            <span class="vis-badge vis-shared" title="Mit ausgewählten Nutzern geteilt">Geteilt</span>
+          {% elif patient.visibility == 'PUBLIC_ORG' %}
+            <span class="vis-badge vis-public" title="Für alle angemeldeten Nutzer sichtbar">Öffentlich</span>
+          {% endif %}
+        </h6>
+
+        {% if patient.usrID_id == request.user.id %}
+          <span class="badge bg-light text-dark mt-1">Eigentümer</span>
+        {% elif patient.shared_with.all|length and request.user in patient.shared_with.all %}
+          <span class="badge bg-warning text-dark mt-1">Geteilt</span>
+        {% else %}
+          <span class="badge bg-secondary mt-1">Fremd</span>
+        {% endif %}
+
+        <!-- Chips per visibility rules -->
+        {% if patient.visibility == 'PRIVATE' %}
+          <!-- Only owner emoji -->
+          <div class="chip-row">
+            {% with owner_name=patient.usrID.get_full_name|default:patient.usrID.username %}
+              <div class="owner-chip" title="Eigentümer: {{ owner_name }}">
+                {{ owner_name|slice:":1"|upper }}
+              </div>
+            {% endwith %}
+          </div>
+        {% elif patient.visibility == 'SHARED' %}
+          <!-- Only shared users' emojis -->
+          {% with shared_list=patient.shared_with.all %}
+            {% if shared_list|length > 0 %}
+            <div class="chip-row">
+              {% for u in shared_list|slice:":5" %}
+                {% with un=u.get_full_name|default:u.username %}
+                  <div class="owner-chip shared" title="Geteilt mit: {{ un }}">
+                    {{ un|slice:":1"|upper }}
+                  </div>
+                {% endwith %}
+              {% endfor %}
+              {% if shared_list|length > 5 %}
+                <div class="owner-chip more" title="Weitere geteilt: {{ shared_list|length|add:'-5' }}">…</div>
+              {% endif %}
+            </div>
+            {% endif %}
+          {% endwith %}
+        {% else %}
+          <!-- PUBLIC_ORG: show no emojis -->
+        {% endif %}
+      </div>
+    </a>
+
+    {% if patient.usrID_id == request.user.id or request.user.is_staff or request.user.is_superuser %}
+    <button type="button" class="btn btn-danger btn-sm position-absolute top-0 end-0 m-2"
+            onclick="event.preventDefault(); confirmDelete({{ patient.id }}, this)">
+      &times;
+    </button>
+    {% endif %}
+  </div>
+</div>
+{% endfor %}
+"""
+
+
+class Command(BaseCommand):
+    help = "Benchmark index card rendering: legacy template vs. PatientCard view-models, on a throwaway SQLite database."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=5000, help="Number of patient cards.")
+        parser.add_argument("--shares", type=int, default=8, help="Users each SHARED case is shared with.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per variant; the best is reported.")
+
+    def handle(self, *args, **options):
+        with tempfile.TemporaryDirectory(prefix="bench_cards_") as tmp, scratch_database(tmp):
+            self._run(options)
+
+    def _seed(self, count, shares):
+        owner = User.objects.create(username="bench_owner", first_name="Bench", last_name="Owner")
+        users = User.objects.bulk_create([
+            User(username=f"bench_user_{i}", first_name=f"User{i}", last_name="Bench")
+            for i in range(max(shares, 1))
+        ])
+        visibilities = [Patient.Visibility.SHARED, Patient.Visibility.PRIVATE, Patient.Visibility.PUBLIC_ORG]
+        patients = Patient.objects.bulk_create([
+            Patient(ptnName=f"Name{i}", ptnLastname=f"Last{i}", ptnDOB="1990-01-01",
+                    usrID=owner, visibility=visibilities[i % 3])
+            for i in range(count)
+        ], batch_size=500)
+        Through = Patient.shared_with.through
+        Through.objects.bulk_create([
+            Through(patient_id=p.id, user_id=u.id)
+            for p in patients if p.visibility == Patient.Visibility.SHARED
+            for u in users[:shares]
+        ], batch_size=1000)
+        return users[0], [p.id for p in patients]
+
+    def _measure(self, label, fn, repeat):
+        best = None
+        for _ in range(repeat):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                html = fn()
+                elapsed = time.perf_counter() - start
+            if best is None or elapsed < best[0]:
+                best = (elapsed, len(queries), len(html))
+        elapsed, n_queries, size = best
+        self.stdout.write(f"{label:<8} {elapsed * 1000:9.1f} ms  {n_queries:4d} queries  {size / 1024:8.0f} KiB")
+        return elapsed
+
+    def _run(self, options):
+        viewer, ids = self._seed(options["count"], options["shares"])
+        request = RequestFactory().get("/index/")
+        request.user = viewer
+        legacy = Template(LEGACY_CARD_TEMPLATE)
+
+        def before():
+            patients = Patient.objects.filter(id__in=ids) \
+                .select_related("usrID").prefetch_related("shared_with").order_by("-id")
+            return legacy.render(Context({"patients": patients, "request": request}))
+
+        def after():
+            rows = Patient.objects.filter(id__in=ids).order_by("-id").values(*CARD_FIELDS)
+            cards = build_patient_cards(rows, viewer)
+            return render_to_string("partials/patient_cards.html", {"cards": cards}, request=request)
+
+        self.stdout.write(f"Rendering {len(ids)} cards ({options['shares']} shares per SHARED case)")
+        t_before = self._measure("before", before, options["repeat"])
+        t_after = self._measure("after", after, options["repeat"])
+        self.stdout.write(self.style.SUCCESS(f"speedup: {t_before / t_after:.1f}x"))
@@ -0,0 +1,132 @@
+import random
+import tempfile
+import time
+from datetime import timedelta
+from functools import reduce
+from operator import and_
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from SmileHealth import search
+from SmileHealth.models import Message
+
+from ._scratch import scratch_database
+
+WORDS = (
+    "termin abdruck implantat krone brücke füllung wurzel behandlung kontrolle röntgen "
+    "befund patient zahn schiene aligner scan modell planung praxis labor rückfrage "
+    "heute morgen bitte danke freigabe anpassung okklusion prothese nachsorge hallo"
+).split()
+SYLLABLES = ("ka", "mo", "ri", "te", "lu", "sa", "ne", "po", "di", "gu", "ve", "zo", "ba", "fi", "ku")
+QUERIES = (
+    ("common word", "termin"),
+    ("two words", "abdruck freigabe"),
+    ("prefix", "impl"),
+    ("rare word", None),  # picked from the generated vocabulary
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark FTS5 message search against icontains at scale (default 1M messages) "
+        "on a throwaway SQLite database."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000, help="Messages to generate.")
+        parser.add_argument("--users", type=int, default=100, help="Users the messages are spread over.")
+        parser.add_argument("--vocabulary", type=int, default=20_000, help="Generated words besides the common ones.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per query; the best is reported.")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        if options["rows"] < 1 or options["users"] < 2:
+            raise CommandError("--rows must be at least 1 and --users at least 2")
+        with tempfile.TemporaryDirectory(prefix="bench_search_") as tmp, scratch_database(tmp):
+            self._run(options)
+
+    def _vocabulary(self, rng, size):
+        words = set()
+        while len(words) < size:
+            words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+        return WORDS + sorted(words)
+
+    def _seed(self, options, rng):
+        User.objects.bulk_create([User(username=f"bench_search_{i}") for i in range(options["users"])])
+        user_ids = list(User.objects.values_list("id", flat=True))
+        vocabulary = self._vocabulary(rng, options["vocabulary"])
+        # Zipf-like: common words dominate, most generated words are rare
+        cum_weights, total = [], 0.0
+        for rank in range(len(vocabulary)):
+            total += 1.0 / (rank + 1)
+            cum_weights.append(total)
+
+        table = Message._meta.db_table
+        start = timezone.now() - timedelta(seconds=options["rows"])
+        sql = (
+            f'INSERT INTO "{table}" (sender_id, receiver_id, content, timestamp, is_read) '
+            f"VALUES (%s, %s, %s, %s, %s)"
+        )
+        batch = 10_000
+        begin = time.perf_counter()
+        with connection.cursor() as cursor:
+            for offset in range(0, options["rows"], batch):
+                rows = []
+                for n in range(offset, min(offset + batch, options["rows"])):
+                    sender, receiver = rng.sample(user_ids, 2)
+                    words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(5, 15))
+                    rows.append((sender, receiver, " ".join(words).capitalize(), start + timedelta(seconds=n), True))
+                with transaction.atomic():
+                    cursor.executemany(sql, rows)
+        self.stdout.write(
+            f"Inserted {options['rows']} messages for {options['users']} users in "
+            f"{time.perf_counter() - begin:.1f} s (the FTS5 triggers index them on insert)"
+        )
+        begin = time.perf_counter()
+        with connection.cursor() as cursor:
+            cursor.execute("INSERT INTO search_message (search_message) VALUES ('optimize')")
+        self.stdout.write(f"Merged the index segments ('optimize') in {time.perf_counter() - begin:.1f} s")
+        # Rank ~300 of the Zipf curve: a few thousand hits per million messages
+        return user_ids, vocabulary[min(len(WORDS) + 300, len(vocabulary) - 1)]
+
+    def _best(self, fn, repeat):
+        best, result = None, None
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000, result
+
+    def _run(self, options):
+        rng = random.Random(options["seed"])
+        user_ids, rare = self._seed(options, rng)
+        user = User.objects.get(id=user_ids[0])
+        page = search.PAGE_SIZE
+
+        def icontains(term, scoped):
+            qs = Message.objects.filter(reduce(and_, (Q(content__icontains=word) for word in term.split())))
+            if scoped:
+                qs = qs.filter(Q(sender=user) | Q(receiver=user))
+            return list(qs.order_by("-timestamp").values_list("id", flat=True)[:page + 1])
+
+        def fts(term, scoped):
+            if scoped:
+                return search.search_messages(user, term)[0]
+            return search.ranked_ids("search_message", search.match_expression(term))[0]
+
+        self.stdout.write(f"{'query':<28}{'scope':<8}{'icontains':>12}{'fts5':>12}{'speedup':>10}")
+        for label, term in QUERIES:
+            term = term or rare
+            for scoped in (True, False):
+                t_like, _ = self._best(lambda: icontains(term, scoped), options["repeat"])
+                t_fts, hits = self._best(lambda: fts(term, scoped), options["repeat"])
+                self.stdout.write(
+                    f"{label + ' (' + term + ')':<28}{'user' if scoped else 'all':<8}"
+                    f"{t_like:>9.1f} ms{t_fts:>9.1f} ms{t_like / max(t_fts, 1e-6):>9.1f}x"
+                    + ("" if hits else "  (no hits)")
+                )
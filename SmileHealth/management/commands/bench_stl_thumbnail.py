@@ -0,0 +1,113 @@
+import math
+import time
+import tracemalloc
+
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+from SmileHealth import lod, stl
+
+
+def synthetic_arch(triangles):
+    """A dental-arch-like closed surface (a bumpy tube bent into a U) with about `triangles` faces."""
+    around = 256
+    along = max(2, triangles // (2 * around))
+    t = np.linspace(-1, 1, along, dtype=np.float32)[:, None]
+    a = np.linspace(0, 2 * math.pi, around + 1, dtype=np.float32)[None, :]
+    bend = t * math.pi * 0.8
+    centre_x, centre_y = 30 * np.sin(bend), -25 * np.cos(bend)
+    teeth = 1 + 0.25 * np.abs(np.sin(t * 14 * math.pi))  # one bump per tooth
+    radius = 6 * teeth * (1 + 0.03 * np.sin(a * 9 + t * 40))
+    # the cross-section lies in the plane spanned by the arch normal and z
+    nx, ny = np.sin(bend), -np.cos(bend)
+    grid = np.stack(np.broadcast_arrays(
+        centre_x + radius * np.cos(a) * nx,
+        centre_y + radius * np.cos(a) * ny,
+        radius * np.sin(a) * 0.8,
+    ), axis=-1)
+    p00, p10, p11, p01 = grid[:-1, :-1], grid[1:, :-1], grid[1:, 1:], grid[:-1, 1:]
+    return np.concatenate([
+        np.stack([p00, p10, p11], axis=-2).reshape(-1, 3, 3),
+        np.stack([p00, p11, p01], axis=-2).reshape(-1, 3, 3),
+    ])
+
+
+def binary_stl(triangles):
+    records = np.zeros(len(triangles), dtype=stl._RECORD)
+    records["vertices"] = triangles
+    return b"bench_stl_thumbnail".ljust(80, b" ") + len(triangles).to_bytes(4, "little") + records.tobytes()
+
+
+def ascii_stl(triangles):
+    facet = "facet normal 0 0 0\n outer loop\n" + "  vertex %e %e %e\n" * 3 + " endloop\nendfacet\n"
+    body = "".join(facet % tuple(t.ravel()) for t in triangles)
+    return f"solid bench\n{body}endsolid bench\n".encode()
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark the STL thumbnail renderer (parse, project, rasterize, PNG) and optionally the "
+        "level-of-detail meshes on a synthetic scan of a given size, or on --file."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--size-mb", type=float, default=50.0, help="Size of the synthetic binary STL.")
+        parser.add_argument("--file", help="Benchmark this STL file instead.")
+        parser.add_argument("--ascii", action="store_true",
+                            help="Also time an ASCII STL of the same size (slow to generate).")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the best is reported.")
+        parser.add_argument("--output", help="Write the rendered PNG here.")
+        parser.add_argument("--lods", action="store_true",
+                            help="Also time the level-of-detail meshes the viewer loads (lod.py).")
+
+    def handle(self, *args, **options):
+        if options["repeat"] < 1 or options["size_mb"] <= 0:
+            raise CommandError("--repeat must be at least 1 and --size-mb positive")
+        if options["file"]:
+            with open(options["file"], "rb") as fp:
+                cases = [(options["file"], fp.read())]
+        else:
+            size = int(options["size_mb"] * 1_000_000)
+            cases = [("binary", binary_stl(synthetic_arch((size - 84) // stl._RECORD.itemsize)))]
+            if options["ascii"]:
+                # ASCII spends about 200 bytes per facet instead of 50
+                cases.append(("ascii", ascii_stl(synthetic_arch(size // 200))))
+
+        self.stdout.write(
+            f"{'case':<12}{'size':>10}{'triangles':>12}{'parse':>10}{'render':>10}{'total':>10}{'peak':>10}"
+        )
+        for label, data in cases:
+            parse_ms, triangles = self._best(lambda: stl.parse(data), options["repeat"])
+            render_ms, png = self._best(lambda: stl.render(triangles), options["repeat"])
+            tracemalloc.start()
+            stl.render(stl.parse(data))
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            self.stdout.write(
+                f"{label[-12:]:<12}{len(data) / 1e6:>7.1f} MB{len(triangles):>12,}"
+                f"{parse_ms:>7.0f} ms{render_ms:>7.0f} ms{parse_ms + render_ms:>7.0f} ms{peak / 1e6:>7.0f} MB"
+            )
+            if options["lods"]:
+                self._lods(triangles, len(data), options["repeat"])
+            if options["output"]:
+                with open(options["output"], "wb") as fp:
+                    fp.write(png)
+        self.stdout.write(f"PNG {stl.THUMBNAIL_SIZE[0]}x{stl.THUMBNAIL_SIZE[1]}, {len(png) / 1e3:.0f} kB")
+
+    def _lods(self, triangles, stl_bytes, repeat):
+        build_ms, levels = self._best(lambda: lod.build(triangles), repeat)
+        self.stdout.write(f"  levels of detail built in {build_ms:.0f} ms:")
+        for ratio, data, vertices, faces in levels:
+            self.stdout.write(
+                f"    {ratio:>5.0%}{faces:>12,} triangles{vertices:>11,} vertices"
+                f"{len(data) / 1e6:>8.2f} MB ({len(data) / stl_bytes:.1%} of the STL)"
+            )
+
+    def _best(self, fn, repeat):
+        best, result = None, None
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - begin
+            best = elapsed if best is None else min(best, elapsed)
+        return best * 1000, result
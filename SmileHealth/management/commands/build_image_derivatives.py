@@ -0,0 +1,80 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from SmileHealth import cache, derivatives
+
+
+def _create(job):
+    """Runs in a worker process: files only, the parent records the result."""
+    image_id, patient_id, name, old_thumbnail, old_preview = job
+    try:
+        return image_id, patient_id, derivatives.create_files(name, replace=(old_thumbnail, old_preview)), None
+    except derivatives.RENDER_ERRORS as exc:
+        return image_id, patient_id, None, f"{name}: {exc}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Build thumbnails and WebP previews for patient images that have none or were built with "
+        "older settings (DERIVATIVES_VERSION), in parallel worker processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Worker processes (1 renders in this process).")
+        parser.add_argument("--force", action="store_true", help="Rebuild the derivatives of every image.")
+        parser.add_argument("--chunk-size", type=int, default=8, help="Images handed to a worker at a time.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["chunk_size"] < 1:
+            raise CommandError("--workers and --chunk-size must be at least 1")
+        jobs = list(
+            derivatives.pending(force=options["force"])
+            .order_by("id")
+            .values_list("id", "ptnID_id", "image", "thumbnail", "preview")
+        )
+        if not jobs:
+            self.stdout.write(self.style.SUCCESS("All images have current derivatives."))
+            return
+
+        self.stdout.write(f"Building derivatives for {len(jobs)} images with {options['workers']} worker(s).")
+        start = time.perf_counter()
+        if options["workers"] == 1:
+            results = map(_create, jobs)
+            built, failed = self._record(results, len(jobs), options["verbosity"])
+        else:
+            connections.close_all()  # workers must not inherit open database connections
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as pool:
+                results = pool.map(_create, jobs, chunksize=options["chunk_size"])
+                built, failed = self._record(results, len(jobs), options["verbosity"])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"Built {built} of {len(jobs)} in {elapsed:.1f} s ({built / max(elapsed, 1e-6):.1f} images/s)."
+        )
+        if failed:
+            raise CommandError(f"{failed} image(s) could not be read; they keep showing the original.")
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def _record(self, results, total, verbosity):
+        built = failed = 0
+        patients = set()
+        for done, (image_id, patient_id, names, error) in enumerate(results, 1):
+            if error:
+                failed += 1
+                self.stderr.write(f"image {image_id}: {error}")
+            else:
+                derivatives.record(image_id, *names)
+                patients.add(patient_id)
+                built += 1
+            if verbosity > 1 and done % 100 == 0:
+                self.stdout.write(f"  {done}/{total}")
+        # record() bypasses the signals; the gallery fragments are cached per patient
+        if patients:
+            cache.bump(*(cache.patient_scope(patient_id) for patient_id in patients))
+        return built, failed
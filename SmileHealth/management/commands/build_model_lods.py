@@ -0,0 +1,66 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from SmileHealth import lod, stl
+
+
+def _create(job):
+    """Runs in a worker process: files only, the parent records the result."""
+    model_id, name, old_levels = job
+    try:
+        return model_id, lod.create_files(name, replace=[level["name"] for level in old_levels]), None
+    except (stl.STLError, OSError) as exc:
+        return model_id, None, f"{name}: {exc}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Build the level-of-detail meshes the 3D viewer loads coarse-first (see SmileHealth/lod.py) "
+        "for models that have none or were built with older settings (LOD_VERSION)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Worker processes (1 builds in this process).")
+        parser.add_argument("--force", action="store_true", help="Rebuild the levels of every model.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        jobs = list(lod.pending(force=options["force"]).order_by("id").values_list("id", "file", "lods"))
+        if not jobs:
+            self.stdout.write(self.style.SUCCESS("All 3D models have current levels of detail."))
+            return
+
+        self.stdout.write(f"Building levels of detail for {len(jobs)} models with {options['workers']} worker(s).")
+        start = time.perf_counter()
+        if options["workers"] == 1:
+            built, failed = self._record(map(_create, jobs), options["verbosity"])
+        else:
+            connections.close_all()  # workers must not inherit open database connections
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as pool:
+                built, failed = self._record(pool.map(_create, jobs), options["verbosity"])
+
+        self.stdout.write(f"Built {built} of {len(jobs)} in {time.perf_counter() - start:.1f} s.")
+        if failed:
+            raise CommandError(f"{failed} model(s) could not be read; the viewer loads their STL file.")
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def _record(self, results, verbosity):
+        built = failed = 0
+        for model_id, levels, error in results:
+            if error:
+                failed += 1
+                self.stderr.write(f"model {model_id}: {error}")
+                continue
+            lod.record(model_id, levels)
+            built += 1
+            if verbosity > 1:
+                sizes = ", ".join(f"{level['ratio']:.0%}: {level['bytes'] / 1e6:.1f} MB" for level in levels)
+                self.stdout.write(f"  model {model_id}: {sizes}")
+        return built, failed
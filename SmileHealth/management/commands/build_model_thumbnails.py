@@ -0,0 +1,76 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from SmileHealth import cache, stl
+
+
+def _create(job):
+    """Runs in a worker process: files only, the parent records the result."""
+    model_id, patient_id, name, old_thumbnail = job
+    try:
+        return model_id, patient_id, stl.create_thumbnail(name, replace=old_thumbnail), None
+    except (stl.STLError, OSError) as exc:
+        return model_id, patient_id, None, f"{name}: {exc}"
+
+
+class Command(BaseCommand):
+    help = (
+        "Render PNG thumbnails for 3D models (STL) that have none or were drawn with older settings "
+        "(THUMBNAIL_VERSION), in parallel worker processes."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Worker processes (1 renders in this process).")
+        parser.add_argument("--force", action="store_true", help="Redraw the thumbnail of every model.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1:
+            raise CommandError("--workers must be at least 1")
+        jobs = list(
+            stl.pending(force=options["force"])
+            .order_by("id")
+            .values_list("id", "ptnID_id", "file", "thumbnail")
+        )
+        if not jobs:
+            self.stdout.write(self.style.SUCCESS("All 3D models have current thumbnails."))
+            return
+
+        self.stdout.write(f"Rendering thumbnails for {len(jobs)} models with {options['workers']} worker(s).")
+        start = time.perf_counter()
+        if options["workers"] == 1:
+            built, failed = self._record(map(_create, jobs), options["verbosity"])
+        else:
+            connections.close_all()  # workers must not inherit open database connections
+            # one scan per task: a model takes seconds, chunking would only unbalance the workers
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as pool:
+                built, failed = self._record(pool.map(_create, jobs), options["verbosity"])
+
+        elapsed = time.perf_counter() - start
+        self.stdout.write(f"Rendered {built} of {len(jobs)} in {elapsed:.1f} s.")
+        if failed:
+            raise CommandError(f"{failed} model(s) could not be read; they keep showing the placeholder.")
+        self.stdout.write(self.style.SUCCESS("Done."))
+
+    def _record(self, results, verbosity):
+        built = failed = 0
+        patients = set()
+        for model_id, patient_id, name, error in results:
+            if error:
+                failed += 1
+                self.stderr.write(f"model {model_id}: {error}")
+                continue
+            stl.record(model_id, name)
+            patients.add(patient_id)
+            built += 1
+            if verbosity > 1:
+                self.stdout.write(f"  model {model_id} -> {name}")
+        # record() bypasses the signals; the gallery fragments are cached per patient
+        if patients:
+            cache.bump(*(cache.patient_scope(patient_id) for patient_id in patients))
+        return built, failed
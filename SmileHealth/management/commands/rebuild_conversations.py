@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from SmileHealth import conversations
+
+
+class Command(BaseCommand):
+    help = "Recompute the Conversation summary table from Message and verify it."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify-only", action="store_true",
+            help="Do not rebuild; only compare the current table with Message.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["verify_only"]:
+            count = conversations.rebuild()
+            self.stdout.write(f"Rebuilt conversation summaries: {count} rows.")
+
+        mismatches = conversations.verify()
+        for low, high, stored, expected in mismatches[:50]:
+            self.stderr.write(f"{low}/{high}: stored={stored} expected={expected}")
+        if mismatches:
+            raise CommandError(f"{len(mismatches)} conversation(s) differ from Message.")
+        self.stdout.write(self.style.SUCCESS("Conversation summaries match Message."))
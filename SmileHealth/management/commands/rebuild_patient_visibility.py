@@ -0,0 +1,37 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from SmileHealth import visibility
+
+
+class Command(BaseCommand):
+    help = "Rebuild the PatientVisibility index and verify it against the Q-based visibility rules."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify-only", action="store_true",
+            help="Do not rebuild; only compare the current index with the rules.",
+        )
+        parser.add_argument(
+            "--user", action="append", dest="usernames", default=[],
+            help="Verify only these usernames (repeatable). Default: all non-admin users.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["verify_only"]:
+            count = visibility.rebuild()
+            self.stdout.write(f"Rebuilt patient visibility index: {count} rows.")
+
+        users = User.objects.filter(is_staff=False, is_superuser=False).order_by("id")
+        if options["usernames"]:
+            users = users.filter(username__in=options["usernames"])
+
+        mismatches = visibility.verify(users)
+        for user, missing, extra in mismatches:
+            self.stderr.write(
+                f"{user.username}: missing={missing[:20]} extra={extra[:20]}"
+                f" ({len(missing)} missing, {len(extra)} extra)"
+            )
+        if mismatches:
+            raise CommandError(f"Visibility index differs from the rules for {len(mismatches)} user(s).")
+        self.stdout.write(self.style.SUCCESS(f"Verified {users.count()} user(s): index matches the rules."))
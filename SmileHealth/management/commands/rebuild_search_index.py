@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from SmileHealth import search
+
+
+class Command(BaseCommand):
+    help = "Repopulate the FTS5 search tables for messages, group messages and comments from their source tables and verify them."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify-only", action="store_true",
+            help="Do not rebuild; only run the FTS5 integrity check and compare row counts.",
+        )
+
+    def handle(self, *args, **options):
+        if not options["verify_only"]:
+            messages, comments, group_messages = search.rebuild()
+            self.stdout.write(
+                f"Rebuilt search index: {messages} messages, {comments} comments, {group_messages} group messages."
+            )
+
+        mismatches = search.verify()
+        for table, indexed, expected in mismatches:
+            self.stderr.write(f"{table}: {indexed} rows indexed, {expected} expected")
+        if mismatches:
+            raise CommandError("The search index differs from its source tables.")
+        self.stdout.write(self.style.SUCCESS("Search index matches messages, group messages and comments."))
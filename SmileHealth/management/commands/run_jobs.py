@@ -0,0 +1,102 @@
+import os
+import socket
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from SmileHealth import jobs, uploads
+
+MAINTENANCE_INTERVAL = 60  # seconds between sweeps for stale locks, old jobs and abandoned uploads
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued background jobs (image derivatives, video posters, STL thumbnails, file deletion) "
+        "in a pool of worker processes. Workers only touch files; this process records the results."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                            help="Worker processes (1 runs jobs in this process).")
+        parser.add_argument("--once", action="store_true", help="Exit once no job is due instead of polling.")
+        parser.add_argument("--poll", type=float, default=2.0, help="Seconds between polls of an idle queue.")
+
+    def handle(self, *args, **options):
+        if options["workers"] < 1 or options["poll"] <= 0:
+            raise CommandError("--workers must be at least 1 and --poll positive")
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.options = options
+        self.done = self.failed = 0
+        self._last_sweep = 0.0
+
+        if options["workers"] == 1:
+            self._loop(None)
+        else:
+            connections.close_all()  # workers must not inherit open database connections
+            with ProcessPoolExecutor(max_workers=options["workers"], initializer=django.setup) as pool:
+                self._loop(pool)
+        self.stdout.write(f"Finished {self.done} job(s), {self.failed} failed for good.")
+
+    def _sweep(self):
+        if time.monotonic() - self._last_sweep >= MAINTENANCE_INTERVAL:
+            self._last_sweep = time.monotonic()
+            requeued, purged = jobs.requeue_stale(), jobs.purge()
+            if requeued or purged:
+                self.stdout.write(f"Requeued {requeued} stale job(s), purged {purged} finished job(s).")
+            expired = uploads.expire()
+            if expired:
+                self.stdout.write(f"Removed {expired} abandoned chunked upload(s).")
+
+    def _idle(self):
+        """Nothing due: True when the command should exit, else wait one poll interval."""
+        if self.options["once"]:
+            return True
+        time.sleep(self.options["poll"])
+        return False
+
+    def _loop(self, pool):
+        running = {}  # future -> job; inline, the job being executed
+        try:
+            if pool is None:
+                while True:
+                    self._sweep()
+                    batch = jobs.claim(self.worker, 1)
+                    if batch:
+                        running[None] = batch[0]
+                        self._finish(batch[0], jobs.execute(batch[0].kind, batch[0].payload))
+                        del running[None]
+                    elif self._idle():
+                        return
+
+            # Two jobs per worker keep the pool busy while results are recorded
+            capacity = 2 * self.options["workers"]
+            while True:
+                self._sweep()
+                if len(running) < capacity:
+                    for job in jobs.claim(self.worker, capacity - len(running)):
+                        running[pool.submit(jobs.execute, job.kind, job.payload)] = job
+                if running:
+                    finished, _ = wait(running, timeout=self.options["poll"], return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        self._finish(running.pop(future), future.result())
+                elif self._idle():
+                    return
+        except KeyboardInterrupt:
+            # Unfinished jobs go back to the queue instead of waiting for LOCK_TIMEOUT
+            released = jobs.release([job.pk for job in running.values()])
+            self.stdout.write(f"Interrupted; released {released} running job(s).")
+
+    def _finish(self, job, outcome):
+        jobs.finish(job, outcome)
+        if job.status == job.Status.DONE:
+            self.done += 1
+            if self.options["verbosity"] > 1:
+                self.stdout.write(f"job {job.pk} ({job.kind}) done")
+        elif job.status == job.Status.FAILED:
+            self.failed += 1
+            self.stderr.write(f"job {job.pk} ({job.kind}) failed: {jobs.status(job)['error']}")
+        elif self.options["verbosity"] > 1:
+            self.stdout.write(f"job {job.pk} ({job.kind}) will be retried at {job.run_after:%H:%M:%S}")
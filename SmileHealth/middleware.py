@@ -0,0 +1,48 @@
+# SmileHealth/middleware.py
+from django.contrib.auth.models import User
+from django.core.cache import cache as django_cache
+from django.utils.functional import SimpleLazyObject
+
+from .cache import bump, model_namespace, versioned_key
+from .models import Profile
+
+PROFILE_TTL = 15 * 60
+
+
+def _profile_scope(user_id):
+    return f"profile:{user_id}"
+
+
+def get_profile(user):
+    """
+    Return the user's Profile (or None), read from the cache when possible and
+    stored in the user.profile relation cache so later accesses cost nothing.
+    Profiles are created only by the ensure_user_profile signal.
+    """
+    if not user.is_authenticated:
+        return None
+    key = versioned_key(model_namespace(Profile), user.id, scopes=(_profile_scope(user.id),))
+    profile = django_cache.get(key)
+    if profile is None:
+        profile = Profile.objects.filter(user_id=user.id).first()
+        if profile is None:
+            return None
+        django_cache.set(key, profile, PROFILE_TTL)
+    User.profile.related.set_cached_value(user, profile)
+    profile.user = user
+    return profile
+
+
+def invalidate_profile(user_id):
+    bump(_profile_scope(user_id))
+
+
+class ProfileMiddleware:
+    """Attach a lazily loaded, cached `request.profile` (also primes `request.user.profile`)."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request.profile = SimpleLazyObject(lambda: get_profile(request.user))
+        return self.get_response(request)
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:30
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def populate_visibility(apps, schema_editor):
+    """The rules of SmileHealth.visibility.compute_rows as of this migration, frozen."""
+    Patient = apps.get_model('SmileHealth', 'Patient')
+    CaseGroup = apps.get_model('SmileHealth', 'CaseGroup')
+    PatientVisibility = apps.get_model('SmileHealth', 'PatientVisibility')
+
+    patient_shares = {}
+    for pid, uid in Patient.shared_with.through.objects.values_list('patient_id', 'user_id'):
+        patient_shares.setdefault(pid, []).append(uid)
+    group_shares = {}
+    for gid, uid in CaseGroup.shared_with.through.objects.values_list('casegroup_id', 'user_id'):
+        group_shares.setdefault(gid, []).append(uid)
+
+    rows = set()
+    for pid, owner_id, visibility, group_id, group_owner_id, group_visibility in Patient.objects.values_list(
+        'id', 'usrID_id', 'visibility', 'group_id', 'group__created_by_id', 'group__visibility',
+    ):
+        if group_id:
+            # Grouped cases are governed by their group's visibility only
+            rows.add((group_owner_id, pid, 'GROUP_OWNER'))
+            if group_visibility == 'SHARED':
+                rows.update((uid, pid, 'GROUP_SHARED') for uid in group_shares.get(group_id, ()))
+            continue
+        rows.add((owner_id, pid, 'OWNER'))
+        if visibility == 'PUBLIC_ORG':
+            rows.add((None, pid, 'PUBLIC_ORG'))
+        elif visibility == 'SHARED':
+            rows.update((uid, pid, 'SHARED') for uid in patient_shares.get(pid, ()))
+
+    PatientVisibility.objects.bulk_create([
+        PatientVisibility(user_id=uid, patient_id=pid, reason=reason) for uid, pid, reason in rows
+    ], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0007_merge_20260224_1643'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PatientVisibility',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('reason', models.CharField(choices=[('OWNER', 'Owner'), ('PUBLIC_ORG', 'Public (organisation)'), ('SHARED', 'Shared with user'), ('GROUP_OWNER', 'Group owner'), ('GROUP_SHARED', 'Group shared with user')], max_length=20)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='visibility_entries', to='SmileHealth.patient')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='patient_visibility', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'patient', 'reason'), name='uniq_patient_visibility')],
+            },
+        ),
+        migrations.RunPython(populate_visibility, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:32
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0008_patientvisibility'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(fields=['ptnLastname', 'ptnName'], name='patient_name_idx'),
+        ),
+    ]
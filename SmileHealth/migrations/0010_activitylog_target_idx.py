@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:41
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0009_patient_name_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='activitylog',
+            index=models.Index(fields=['target_type', 'target_id', '-created_at'], name='activity_target_idx'),
+        ),
+    ]
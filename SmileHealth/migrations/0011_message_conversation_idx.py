@@ -0,0 +1,19 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:42
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0010_activitylog_target_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', 'timestamp'], name='message_conversation_idx'),
+        ),
+    ]
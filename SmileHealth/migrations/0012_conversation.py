@@ -0,0 +1,65 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:49
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, F, Max, Q
+from django.db.models.functions import Greatest, Least
+
+
+def populate_conversations(apps, schema_editor):
+    """SmileHealth.conversations.rebuild as of this migration, frozen."""
+    Message = apps.get_model('SmileHealth', 'Message')
+    Conversation = apps.get_model('SmileHealth', 'Conversation')
+    stats = list(
+        Message.objects.order_by()
+        .annotate(low=Least('sender_id', 'receiver_id'), high=Greatest('sender_id', 'receiver_id'))
+        .values('low', 'high')
+        .annotate(
+            last_id=Max('id'),
+            unread_low=Count('id', filter=Q(is_read=False, receiver_id=F('low'))),
+            unread_high=Count('id', filter=Q(is_read=False, receiver_id=F('high'))),
+        )
+        .filter(low__lt=F('high'))
+    )
+    # Max(id) is the newest message; ids and auto_now_add timestamps grow together
+    timestamps = {}
+    last_ids = [row['last_id'] for row in stats]
+    for start in range(0, len(last_ids), 1000):
+        timestamps.update(Message.objects.filter(id__in=last_ids[start:start + 1000]).values_list('id', 'timestamp'))
+    Conversation.objects.bulk_create([
+        Conversation(
+            user_low_id=row['low'], user_high_id=row['high'],
+            last_message_id=row['last_id'], last_message_at=timestamps[row['last_id']],
+            unread_low=row['unread_low'], unread_high=row['unread_high'],
+        )
+        for row in stats
+    ], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0011_message_conversation_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('unread_low', models.PositiveIntegerField(default=0)),
+                ('unread_high', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='SmileHealth.message')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_message_at'], name='conversation_low_recent_idx'), models.Index(fields=['user_high', '-last_message_at'], name='conversation_high_recent_idx')],
+                'constraints': [models.UniqueConstraint(fields=('user_low', 'user_high'), name='uniq_conversation_pair'), models.CheckConstraint(condition=models.Q(('user_low__lt', models.F('user_high'))), name='conversation_pair_ordered')],
+            },
+        ),
+        migrations.RunPython(populate_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.4 on 2026-10-17 06:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0012_conversation'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={},
+        ),
+        migrations.CreateModel(
+            name='ArchivedMessage',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('content', models.TextField()),
+                ('timestamp', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('receiver', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['sender', 'receiver', 'timestamp'], name='archived_conversation_idx'), models.Index(fields=['timestamp'], name='archived_timestamp_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,86 @@
+from django.db import migrations
+
+# The FTS5 schema of SmileHealth/search.py as of this migration, frozen.
+SCHEMA = [
+    "CREATE VIRTUAL TABLE search_message USING fts5("
+    "content, participants, sender_id UNINDEXED, receiver_id UNINDEXED, timestamp UNINDEXED, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '3')",
+    # Rank by content only; participants are for filtering
+    "INSERT INTO search_message (search_message, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    "CREATE VIRTUAL TABLE search_comment USING fts5("
+    "content, patient_id UNINDEXED, author_id UNINDEXED, created_at UNINDEXED, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '3')",
+    # Messages
+    'CREATE TRIGGER search_message_ai AFTER INSERT ON "SmileHealth_message" BEGIN '
+    "INSERT INTO search_message (rowid, content, participants, sender_id, receiver_id, timestamp) "
+    "VALUES (new.id, new.content, 'u' || new.sender_id || ' u' || new.receiver_id, new.sender_id, "
+    "new.receiver_id, new.timestamp); END",
+    'CREATE TRIGGER search_message_au AFTER UPDATE OF content ON "SmileHealth_message" BEGIN '
+    "UPDATE search_message SET content = new.content WHERE rowid = new.id; END",
+    'CREATE TRIGGER search_message_ad AFTER DELETE ON "SmileHealth_message" '
+    'WHEN NOT EXISTS (SELECT 1 FROM "SmileHealth_archivedmessage" WHERE id = old.id) BEGIN '
+    "DELETE FROM search_message WHERE rowid = old.id; END",
+    'CREATE TRIGGER search_archived_ai AFTER INSERT ON "SmileHealth_archivedmessage" '
+    "WHEN NOT EXISTS (SELECT 1 FROM search_message WHERE rowid = new.id) BEGIN "
+    "INSERT INTO search_message (rowid, content, participants, sender_id, receiver_id, timestamp) "
+    "VALUES (new.id, new.content, 'u' || new.sender_id || ' u' || new.receiver_id, new.sender_id, "
+    "new.receiver_id, new.timestamp); END",
+    'CREATE TRIGGER search_archived_ad AFTER DELETE ON "SmileHealth_archivedmessage" BEGIN '
+    "DELETE FROM search_message WHERE rowid = old.id; END",
+    # Comments
+    'CREATE TRIGGER search_comment_ai AFTER INSERT ON "SmileHealth_comment" BEGIN '
+    "INSERT INTO search_comment (rowid, content, patient_id, author_id, created_at) "
+    "VALUES (new.id, new.content, new.patient_id, new.author_id, new.created_at); END",
+    'CREATE TRIGGER search_comment_au AFTER UPDATE OF content ON "SmileHealth_comment" BEGIN '
+    "UPDATE search_comment SET content = new.content WHERE rowid = new.id; END",
+    'CREATE TRIGGER search_comment_ad AFTER DELETE ON "SmileHealth_comment" BEGIN '
+    "DELETE FROM search_comment WHERE rowid = old.id; END",
+]
+
+BACKFILL = [
+    "INSERT INTO search_message (rowid, content, participants, sender_id, receiver_id, timestamp) "
+    "SELECT id, content, 'u' || sender_id || ' u' || receiver_id, sender_id, receiver_id, timestamp "
+    'FROM "SmileHealth_message" '
+    "UNION ALL "
+    "SELECT id, content, 'u' || sender_id || ' u' || receiver_id, sender_id, receiver_id, timestamp "
+    'FROM "SmileHealth_archivedmessage" WHERE id NOT IN (SELECT id FROM "SmileHealth_message")',
+    "INSERT INTO search_comment (rowid, content, patient_id, author_id, created_at) "
+    'SELECT id, content, patient_id, author_id, created_at FROM "SmileHealth_comment"',
+    "INSERT INTO search_message (search_message) VALUES ('optimize')",
+    "INSERT INTO search_comment (search_comment) VALUES ('optimize')",
+]
+
+DROP = [
+    *(f"DROP TRIGGER IF EXISTS {name}" for name in (
+        "search_message_ai", "search_message_au", "search_message_ad",
+        "search_archived_ai", "search_archived_ad",
+        "search_comment_ai", "search_comment_au", "search_comment_ad",
+    )),
+    "DROP TABLE IF EXISTS search_message",
+    "DROP TABLE IF EXISTS search_comment",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return  # FTS5 tables and triggers are SQLite-specific
+    for statement in SCHEMA + BACKFILL:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for statement in DROP:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0013_message_archive'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
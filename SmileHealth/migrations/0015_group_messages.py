@@ -0,0 +1,56 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:17
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0014_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupMessage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField()),
+                ('timestamp', models.DateTimeField(auto_now_add=True)),
+                ('branch', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='group_messages', to='SmileHealth.branch')),
+                ('case_group', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='group_messages', to='SmileHealth.casegroup')),
+                ('sender', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sent_group_messages', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='GroupMessageRecipient',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('is_read', models.BooleanField(default=False)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipients', to='SmileHealth.groupmessage')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='group_message_receipts', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['branch', 'timestamp'], name='group_message_branch_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessage',
+            index=models.Index(fields=['case_group', 'timestamp'], name='group_message_casegroup_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='groupmessage',
+            constraint=models.CheckConstraint(condition=models.Q(models.Q(('branch__isnull', False), ('case_group__isnull', True)), models.Q(('branch__isnull', True), ('case_group__isnull', False)), _connector='OR'), name='group_message_one_target'),
+        ),
+        migrations.AddIndex(
+            model_name='groupmessagerecipient',
+            index=models.Index(fields=['user', 'is_read'], name='group_recipient_unread_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='groupmessagerecipient',
+            constraint=models.UniqueConstraint(fields=('user', 'message'), name='uniq_group_message_recipient'),
+        ),
+    ]
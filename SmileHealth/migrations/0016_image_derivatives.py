@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:19
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0015_group_messages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='derivatives_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='preview',
+            field=models.ImageField(blank=True, editable=False, upload_to='patient_images/'),
+        ),
+        migrations.AddField(
+            model_name='image',
+            name='thumbnail',
+            field=models.ImageField(blank=True, editable=False, upload_to='patient_images/'),
+        ),
+    ]
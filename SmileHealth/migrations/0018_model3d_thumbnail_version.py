@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:32
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0017_job_queue'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model3d',
+            name='thumbnail_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+    ]
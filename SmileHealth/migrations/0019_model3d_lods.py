@@ -0,0 +1,23 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0018_model3d_thumbnail_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='model3d',
+            name='lod_version',
+            field=models.PositiveSmallIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='model3d',
+            name='lods',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
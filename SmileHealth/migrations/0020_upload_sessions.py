@@ -0,0 +1,38 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:42
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0019_model3d_lods'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('kind', models.CharField(choices=[('VIDEO', 'Video'), ('MODEL3D', '3D model')], max_length=10)),
+                ('filename', models.CharField(max_length=255)),
+                ('size', models.PositiveBigIntegerField()),
+                ('chunk_size', models.PositiveIntegerField()),
+                ('received', models.PositiveBigIntegerField(default=0)),
+                ('crc32', models.PositiveBigIntegerField(default=0)),
+                ('status', models.CharField(choices=[('OPEN', 'Open'), ('COMPLETE', 'Complete')], default='OPEN', max_length=10)),
+                ('result_id', models.PositiveBigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='SmileHealth.patient')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'updated_at'], name='upload_stale_idx')],
+            },
+        ),
+    ]
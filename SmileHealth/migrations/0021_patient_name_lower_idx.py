@@ -0,0 +1,28 @@
+# Generated by Django 5.2.4 on 2026-10-17 07:58
+
+import django.db.models.functions.text
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0020_upload_sessions'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='patient',
+            name='patient_name_idx',
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(django.db.models.functions.text.Lower('ptnLastname'), name='patient_lastname_lower_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patient',
+            index=models.Index(django.db.models.functions.text.Lower('ptnName'), name='patient_name_lower_idx'),
+        ),
+    ]
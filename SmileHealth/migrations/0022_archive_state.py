@@ -0,0 +1,21 @@
+# Generated by Django 5.2.4 on 2026-10-17 08:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0021_patient_name_lower_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('cursor', models.BigIntegerField(default=0)),
+                ('horizon', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.4 on 2026-10-17 08:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0022_archive_state'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='activitylog',
+            name='action',
+            field=models.CharField(choices=[('LOGIN', 'Login'), ('USER_CREATED', 'User created'), ('PATIENT_CREATED', 'Patient created'), ('PATIENT_DELETED', 'Patient deleted'), ('PATIENT_SHARED', 'Patient shared'), ('GROUP_CREATED', 'Group created'), ('GROUP_UPDATED', 'Group updated'), ('GROUP_SHARED', 'Group shared'), ('GROUP_CASE_CREATED', 'Group case created'), ('GROUP_CASE_DELETED', 'Group case deleted'), ('IMAGE_UPLOADED', 'Image uploaded'), ('IMAGE_DELETED', 'Image deleted'), ('VIDEO_UPLOADED', 'Video uploaded'), ('VIDEO_DELETED', 'Video deleted'), ('MODEL3D_UPLOADED', '3D model uploaded'), ('MODEL3D_DELETED', '3D model deleted'), ('COMMENT_ADDED', 'Comment added'), ('MESSAGE_SENT', 'Message sent')], db_index=True, max_length=40),
+        ),
+    ]
@@ -0,0 +1,60 @@
+from django.db import migrations
+
+ROOM = (
+    "CASE WHEN {row}.branch_id IS NOT NULL THEN 'branch' || {row}.branch_id "
+    "ELSE 'casegroup' || {row}.case_group_id END"
+)
+
+# The FTS5 table for group messages of SmileHealth/search.py as of this migration, frozen.
+SCHEMA = [
+    "CREATE VIRTUAL TABLE search_group USING fts5("
+    "content, room, sender_id UNINDEXED, timestamp UNINDEXED, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '3')",
+    # Rank by content only; room is for filtering
+    "INSERT INTO search_group (search_group, rank) VALUES ('rank', 'bm25(1.0, 0.0)')",
+    'CREATE TRIGGER search_group_ai AFTER INSERT ON "SmileHealth_groupmessage" BEGIN '
+    "INSERT INTO search_group (rowid, content, room, sender_id, timestamp) "
+    f"VALUES (new.id, new.content, {ROOM.format(row='new')}, new.sender_id, new.timestamp); END",
+    'CREATE TRIGGER search_group_au AFTER UPDATE OF content ON "SmileHealth_groupmessage" BEGIN '
+    "UPDATE search_group SET content = new.content WHERE rowid = new.id; END",
+    'CREATE TRIGGER search_group_ad AFTER DELETE ON "SmileHealth_groupmessage" BEGIN '
+    "DELETE FROM search_group WHERE rowid = old.id; END",
+]
+
+BACKFILL = [
+    "INSERT INTO search_group (rowid, content, room, sender_id, timestamp) "
+    f'SELECT id, content, {ROOM.format(row="g")}, sender_id, timestamp FROM "SmileHealth_groupmessage" g',
+    "INSERT INTO search_group (search_group) VALUES ('optimize')",
+]
+
+DROP = [
+    "DROP TRIGGER IF EXISTS search_group_ai",
+    "DROP TRIGGER IF EXISTS search_group_au",
+    "DROP TRIGGER IF EXISTS search_group_ad",
+    "DROP TABLE IF EXISTS search_group",
+]
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return  # FTS5 tables and triggers are SQLite-specific
+    for statement in SCHEMA + BACKFILL:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for statement in DROP:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('SmileHealth', '0023_activitylog_action_choices'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -1,7 +1,11 @@
+import uuid
+
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 from django.utils.text import slugify
-from django.db.models import Q
+from django.db.models import Count, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Lower
 
 class Branch(models.Model):
     name = models.CharField(max_length=200, unique=True)
@@ -16,6 +20,35 @@ class Branch(models.Model):
     def __str__(self):
         return self.name
 
+class CaseGroupQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """
+        Groups the user may open, annotated with case_count and last_activity
+        (newest group ActivityLog entry, else created_at), most recent first.
+        """
+        if not user.is_authenticated:
+            return self.none()
+
+        groups = self
+        if not (user.is_superuser or user.is_staff):
+            # Semi-join on the share table instead of a JOIN + DISTINCT
+            shared_ids = CaseGroup.shared_with.through.objects.filter(user=user).values("casegroup_id")
+            groups = groups.filter(
+                Q(created_by=user)
+                | (Q(visibility=CaseGroup.Visibility.SHARED) & Q(pk__in=shared_ids))
+            )
+        return groups.with_activity()
+
+    def with_activity(self):
+        last_log = ActivityLog.objects.filter(
+            target_type="CaseGroup", target_id=OuterRef("pk"),
+        ).order_by("-created_at").values("created_at")[:1]
+        return self.select_related("created_by").annotate(
+            case_count=Count("patients"),
+            last_activity=Coalesce(Subquery(last_log), F("created_at")),
+        ).order_by("-last_activity", "-id")
+
+
 class CaseGroup(models.Model):
     class Visibility(models.TextChoices):
         PRIVATE = "PRIVATE", "Privat"
@@ -33,6 +66,8 @@ class CaseGroup(models.Model):
     shared_with = models.ManyToManyField(User, related_name="shared_case_groups", blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    objects = CaseGroupQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -46,6 +81,24 @@ class PatientQuerySet(models.QuerySet):
         if user.is_superuser or user.is_staff:
             return self
 
+        # Rows with user=NULL (PUBLIC_ORG cases) apply to every logged-in user.
+        # The IN-subquery is a semi-join, so no DISTINCT is needed.
+        visible_ids = PatientVisibility.objects.filter(
+            Q(user=user) | Q(user__isnull=True)
+        ).values("patient_id")
+        return self.filter(pk__in=visible_ids)
+
+    def visible_to_by_rules(self, user):
+        """
+        Reference implementation of the visibility rules, evaluated directly
+        against Patient/CaseGroup. Used to rebuild and verify PatientVisibility.
+        """
+        if not user.is_authenticated:
+            return self.none()
+
+        if user.is_superuser or user.is_staff:
+            return self
+
         # Owner always sees; PUBLIC_ORG visible to all; SHARED visible to selected users
         # Grouped cases are governed by their group's visibility
         non_group = Q(group__isnull=True) & (
@@ -69,6 +122,9 @@ class PatientManager(models.Manager):
     def visible_to(self, user):
         return self.get_queryset().visible_to(user)
 
+    def visible_to_by_rules(self, user):
+        return self.get_queryset().visible_to_by_rules(user)
+
 class Patient(models.Model):
     class Visibility(models.TextChoices):
         PRIVATE = "PRIVATE", "Privat"                      # owner (+ admins)
@@ -93,15 +149,53 @@ class Patient(models.Model):
 
     objects = PatientManager()  # <-- attach the custom manager
 
+    class Meta:
+        indexes = [
+            # Name search (views._scoped_patients) runs range queries on these
+            models.Index(Lower("ptnLastname"), name="patient_lastname_lower_idx"),
+            models.Index(Lower("ptnName"), name="patient_name_lower_idx"),
+        ]
+
     def __str__(self):
         return f"{self.ptnName} {self.ptnLastname}"
 
+class PatientVisibility(models.Model):
+    """
+    Denormalized visibility index: one row per (user, patient, reason).
+    Maintained from signals (see SmileHealth/visibility.py); rebuild with
+    `manage.py rebuild_patient_visibility`.
+    """
+    class Reason(models.TextChoices):
+        OWNER = "OWNER", "Owner"
+        PUBLIC_ORG = "PUBLIC_ORG", "Public (organisation)"
+        SHARED = "SHARED", "Shared with user"
+        GROUP_OWNER = "GROUP_OWNER", "Group owner"
+        GROUP_SHARED = "GROUP_SHARED", "Group shared with user"
+
+    # NULL user = visible to every logged-in user (PUBLIC_ORG)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True, related_name='patient_visibility')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='visibility_entries')
+    reason = models.CharField(max_length=20, choices=Reason.choices)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "patient", "reason"], name="uniq_patient_visibility"),
+        ]
+
+    def __str__(self):
+        who = self.user_id or "*"
+        return f"{who} -> {self.patient_id} ({self.reason})"
+
 # Image model for patient images
 class Image(models.Model):
     imgDesc = models.TextField(blank=True)
     image = models.ImageField(upload_to='patient_images/')
     ptnID = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='images')
     usrID = models.ForeignKey(User, on_delete=models.CASCADE, related_name='images')
+    # Display copies next to the original (see SmileHealth/derivatives.py); empty until built
+    thumbnail = models.ImageField(upload_to='patient_images/', blank=True, editable=False)
+    preview = models.ImageField(upload_to='patient_images/', blank=True, editable=False)
+    derivatives_version = models.PositiveSmallIntegerField(default=0, editable=False)
 
     def __str__(self):
         return f"Image {self.id} for {self.ptnID}"
@@ -115,11 +209,125 @@ class Message(models.Model):
     is_read = models.BooleanField(default=False, db_index=True)
 
     class Meta:
-        ordering = ['timestamp']
+        # No default ordering: every reader orders explicitly (see get_history_page)
+        indexes = [
+            # Chat history pages: one conversation direction, newest first
+            models.Index(fields=["sender", "receiver", "timestamp"], name="message_conversation_idx"),
+        ]
 
     def __str__(self):
         return f"From {self.sender} to {self.receiver} at {self.timestamp}"
+
+
+class ArchivedMessage(models.Model):
+    """
+    Cold storage for read messages older than MESSAGE_RETENTION_DAYS, moved
+    here in batches by `manage.py archive_messages` (SmileHealth/retention.py).
+    Keeps the original Message id so history cursors stay valid across tables.
+    """
+    id = models.BigIntegerField(primary_key=True)
+    sender = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    receiver = models.ForeignKey(User, related_name='+', on_delete=models.CASCADE)
+    content = models.TextField()
+    timestamp = models.DateTimeField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["sender", "receiver", "timestamp"], name="archived_conversation_idx"),
+            models.Index(fields=["timestamp"], name="archived_timestamp_idx"),
+        ]
+
+    def __str__(self):
+        return f"From {self.sender} to {self.receiver} at {self.timestamp} (archived)"
+
+
+class ArchiveState(models.Model):
+    """
+    Progress of the message archive (SmileHealth/retention.py) in a single
+    row: the cursor an interrupted `manage.py archive_messages` resumes from,
+    and the timestamp of the newest archived message.
+    """
+    cursor = models.BigIntegerField(default=0)
+    horizon = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Archive cursor {self.cursor}, horizon {self.horizon}"
+
+
+class Conversation(models.Model):
+    """
+    Summary of the messages between two users, keyed by the ordered pair
+    (user_low.id < user_high.id). Maintained from the Message save path and
+    chat read receipts (see SmileHealth/conversations.py); rebuild with
+    `manage.py rebuild_conversations`.
+    """
+    user_low = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    user_high = models.ForeignKey(User, on_delete=models.CASCADE, related_name='+')
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    unread_low = models.PositiveIntegerField(default=0)   # unread messages addressed to user_low
+    unread_high = models.PositiveIntegerField(default=0)  # unread messages addressed to user_high
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user_low", "user_high"], name="uniq_conversation_pair"),
+            models.CheckConstraint(condition=Q(user_low__lt=F("user_high")), name="conversation_pair_ordered"),
+        ]
+        indexes = [
+            models.Index(fields=["user_low", "-last_message_at"], name="conversation_low_recent_idx"),
+            models.Index(fields=["user_high", "-last_message_at"], name="conversation_high_recent_idx"),
+        ]
+
+    def __str__(self):
+        return f"Conversation {self.user_low_id}/{self.user_high_id}"
     
+class GroupMessage(models.Model):
+    """
+    A message to every member of a Branch or a CaseGroup, stored once.
+    Delivery and read state is one GroupMessageRecipient row per member at
+    send time (see SmileHealth/group_chat.py).
+    """
+    sender = models.ForeignKey(User, related_name='sent_group_messages', on_delete=models.CASCADE)
+    branch = models.ForeignKey(Branch, on_delete=models.CASCADE, null=True, blank=True, related_name='group_messages')
+    case_group = models.ForeignKey(CaseGroup, on_delete=models.CASCADE, null=True, blank=True, related_name='group_messages')
+    content = models.TextField()
+    timestamp = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=Q(branch__isnull=False, case_group__isnull=True)
+                | Q(branch__isnull=True, case_group__isnull=False),
+                name="group_message_one_target",
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["branch", "timestamp"], name="group_message_branch_idx"),
+            models.Index(fields=["case_group", "timestamp"], name="group_message_casegroup_idx"),
+        ]
+
+    def __str__(self):
+        target = f"branch {self.branch_id}" if self.branch_id else f"case group {self.case_group_id}"
+        return f"From {self.sender} to {target} at {self.timestamp}"
+
+
+class GroupMessageRecipient(models.Model):
+    message = models.ForeignKey(GroupMessage, on_delete=models.CASCADE, related_name='recipients')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='group_message_receipts')
+    is_read = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["user", "message"], name="uniq_group_message_recipient"),
+        ]
+        indexes = [
+            models.Index(fields=["user", "is_read"], name="group_recipient_unread_idx"),
+        ]
+
+    def __str__(self):
+        return f"Message {self.message_id} to {self.user_id}"
+
 # Profile model for user settings
 class Profile(models.Model):
     class Role(models.TextChoices):
@@ -162,6 +370,8 @@ class Video(models.Model):
     ptnID = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='videos')
     usrID = models.ForeignKey(User, on_delete=models.CASCADE, related_name='videos')
     uploaded_at = models.DateTimeField(auto_now_add=True)
+    # First frame as JPEG next to the file, extracted by the job queue (SmileHealth/tasks.py)
+    poster = models.ImageField(upload_to='patient_videos/', blank=True, editable=False)
 
     def __str__(self):
         return f"Video {self.id} for {self.ptnID}"
@@ -186,6 +396,9 @@ class Model3D(models.Model):
     usrID = models.ForeignKey(User, on_delete=models.CASCADE, related_name='models3d')
     file = models.FileField(upload_to='patient_models/')                 # .stl
     thumbnail = models.ImageField(upload_to='patient_models/thumbs/', blank=True, null=True)
+    thumbnail_version = models.PositiveSmallIntegerField(default=0, editable=False)
+    lods = models.JSONField(default=list, blank=True, editable=False)   # see lod.py
+    lod_version = models.PositiveSmallIntegerField(default=0, editable=False)
     uploaded_at = models.DateTimeField(auto_now_add=True)
 
     def __str__(self):
@@ -223,7 +436,81 @@ class ActivityLog(models.Model):
 
     class Meta:
         ordering = ["-created_at"]
+        indexes = [
+            models.Index(fields=["target_type", "target_id", "-created_at"], name="activity_target_idx"),
+        ]
 
     def __str__(self):
         actor = self.actor.username if self.actor else "system"
         return f"{actor}: {self.action}"
+
+
+class Job(models.Model):
+    """
+    Background work (image derivatives, video posters, file deletion) queued
+    by the request path and run by `manage.py run_jobs`; see SmileHealth/jobs.py.
+    """
+    class Status(models.TextChoices):
+        PENDING = "PENDING", "Pending"
+        RUNNING = "RUNNING", "Running"
+        DONE = "DONE", "Done"
+        FAILED = "FAILED", "Failed"
+
+    kind = models.CharField(max_length=50)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.PENDING)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True, default="")
+    locked_at = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True, default="")
+    # Whose media the job works on, for the status API; kept when the patient goes
+    patient = models.ForeignKey(Patient, on_delete=models.SET_NULL, null=True, blank=True, related_name='jobs')
+    created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_after"], name="job_due_idx"),
+            models.Index(fields=["patient", "status"], name="job_patient_idx"),
+        ]
+
+    def __str__(self):
+        return f"Job {self.id} {self.kind} ({self.status})"
+
+
+class UploadSession(models.Model):
+    """
+    A chunked, resumable upload of a video or STL file. The client sends
+    fixed-size chunks that are appended to a partial file; `received` is the
+    acknowledged offset to resume from. See SmileHealth/uploads.py.
+    """
+    class Kind(models.TextChoices):
+        VIDEO = "VIDEO", "Video"
+        MODEL3D = "MODEL3D", "3D model"
+
+    class Status(models.TextChoices):
+        OPEN = "OPEN", "Open"
+        COMPLETE = "COMPLETE", "Complete"
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='upload_sessions')
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='upload_sessions')
+    kind = models.CharField(max_length=10, choices=Kind.choices)
+    filename = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    chunk_size = models.PositiveIntegerField()
+    received = models.PositiveBigIntegerField(default=0)
+    crc32 = models.PositiveBigIntegerField(default=0)   # of the received bytes, continued per chunk
+    status = models.CharField(max_length=10, choices=Status.choices, default=Status.OPEN)
+    result_id = models.PositiveBigIntegerField(null=True, blank=True)   # the Video / Model3D created
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["status", "updated_at"], name="upload_stale_idx")]
+
+    def __str__(self):
+        return f"Upload {self.id} {self.filename} ({self.received}/{self.size})"
@@ -0,0 +1,130 @@
+# SmileHealth/retention.py
+"""
+Chat message retention: read messages older than MESSAGE_RETENTION_DAYS move
+from Message to ArchivedMessage, keeping their ids.
+
+archive_batch() moves one batch in its own transaction. archive() repeats it
+and keeps the highest Message id examined as a cursor in ArchiveState, so
+an interrupted `manage.py archive_messages` resumes where it stopped. A run
+that reaches the end clears the cursor, so messages skipped earlier are looked
+at again next time. Skipped are unread messages (the unread counters and
+Conversation.unread_* count them in Message) and the last message of every
+conversation (Conversation.last_message points at it).
+
+horizon() is the newest archived timestamp; get_history_page only reads the
+archive once a page reaches back to it. ArchiveState holds it, and the
+shared cache keeps a copy for HORIZON_TTL because every history page asks
+for it. When neither has it, it falls back to the newest ArchivedMessage row.
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from .cache import counter_key, model_namespace
+from .models import ArchivedMessage, ArchiveState, Conversation, Message
+
+BATCH_SIZE = 1000
+ARCHIVED_FIELDS = ("id", "sender_id", "receiver_id", "content", "timestamp")
+STATE_ID = 1
+HORIZON_TTL = 10 * 60
+
+
+def cutoff(now=None):
+    return (now or timezone.now()) - timedelta(days=settings.MESSAGE_RETENTION_DAYS)
+
+
+def _horizon_key():
+    return counter_key(model_namespace(ArchivedMessage, "horizon"))
+
+
+def _newest_archived():
+    return ArchivedMessage.objects.aggregate(newest=Max("timestamp"))["newest"]
+
+
+def _state():
+    state = ArchiveState.objects.filter(pk=STATE_ID).first()
+    if state is None:
+        # First run with this table: the archive may already hold messages
+        state, _ = ArchiveState.objects.get_or_create(pk=STATE_ID, defaults={"horizon": _newest_archived()})
+    return state
+
+
+def horizon():
+    """Timestamp of the newest archived message, or None while the archive is empty."""
+    value = cache.get(_horizon_key())
+    if value is None:
+        newest = ArchiveState.objects.filter(pk=STATE_ID).values_list("horizon", flat=True).first()
+        newest = newest or _newest_archived()
+        value = newest.timestamp() if newest else 0
+        # add(): a batch may have raised the horizon since the read above
+        cache.add(_horizon_key(), value, HORIZON_TTL)
+    return datetime.fromtimestamp(value, tz=dt_timezone.utc) if value else None
+
+
+def _raise_horizon(timestamp):
+    state = _state()
+    if state.horizon is None or timestamp > state.horizon:
+        ArchiveState.objects.filter(pk=STATE_ID).update(horizon=timestamp)
+    else:
+        timestamp = state.horizon
+    cache.set(_horizon_key(), timestamp.timestamp(), HORIZON_TTL)
+
+
+def _save_cursor(after_id):
+    ArchiveState.objects.filter(pk=STATE_ID).update(cursor=after_id)
+
+
+def archive_batch(before, after_id=0, batch_size=BATCH_SIZE):
+    """
+    Move up to batch_size eligible messages with id > after_id.
+    Returns (moved, last_id); last_id is None when nothing was left.
+    """
+    latest = Conversation.objects.filter(last_message__isnull=False).values("last_message_id")
+    with transaction.atomic():
+        rows = list(
+            Message.objects.filter(id__gt=after_id, timestamp__lt=before, is_read=True)
+            .exclude(id__in=latest)
+            .order_by("id")
+            .values(*ARCHIVED_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return 0, None
+        ArchivedMessage.objects.bulk_create([ArchivedMessage(**row) for row in rows], ignore_conflicts=True)
+        # Raised before the rows leave Message and in the same transaction: a
+        # reader may look into the archive needlessly, but never skips it
+        # while it holds the page
+        _raise_horizon(max(row["timestamp"] for row in rows))
+        Message.objects.filter(id__in=[row["id"] for row in rows]).delete()
+    return len(rows), rows[-1]["id"]
+
+
+def archive(before=None, batch_size=BATCH_SIZE, max_batches=None, restart=False, progress=None):
+    """
+    Archive in batches from the stored cursor. Returns (moved, finished);
+    finished is False when max_batches stopped the run early.
+    progress(moved_in_batch, last_id) is called after every batch.
+    """
+    before = before or cutoff()
+    after_id = 0 if restart else _state().cursor
+    moved = batches = 0
+    while max_batches is None or batches < max_batches:
+        count, last_id = archive_batch(before, after_id, batch_size)
+        batches += 1
+        moved += count
+        if last_id is None:
+            _save_cursor(0)
+            return moved, True
+        # Saved after the batch committed: a run killed in between repeats
+        # the batch, finding its messages already gone
+        after_id = last_id
+        _save_cursor(after_id)
+        if progress:
+            progress(count, last_id)
+        if count < batch_size:
+            _save_cursor(0)
+            return moved, True
+    return moved, False
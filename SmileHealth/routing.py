@@ -3,4 +3,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<receiver_id>\d+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/group/(?P<kind>branch|casegroup)/(?P<target_id>\d+)/$', consumers.GroupChatConsumer.as_asgi()),
+    re_path(r'ws/notify/$', consumers.NotifyConsumer.as_asgi()),
 ]
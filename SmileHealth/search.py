@@ -0,0 +1,317 @@
+# SmileHealth/search.py
+"""
+Full-text search over chat messages, group messages and patient comments
+(SQLite FTS5).
+
+Three FTS5 tables mirror the searchable text, keyed by the source row id:
+
+    search_message(content, participants, sender_id, receiver_id, timestamp)  <- Message + ArchivedMessage
+    search_comment(content, patient_id, author_id, created_at)                 <- Comment
+    search_group(content, room, sender_id, timestamp)                          <- GroupMessage
+
+They are kept current by SQL triggers (installed by migrations 0014 and 0024), so bulk
+inserts, queryset updates and cascading deletes are covered as well as
+model saves. Archiving a message (SmileHealth/retention.py) keeps its entry:
+the ArchivedMessage insert sees it is already indexed and the Message delete
+skips ids that are in the archive.
+
+Permissions are part of the FTS query. Messages index their sender and
+receiver as tokens ("u12 u34" in `participants`, weight 0 in bm25), so "my
+messages" is a posting-list intersection inside FTS5 rather than a filter
+over every hit. Group messages index their room the same way ("branch3",
+"casegroup7" in `room`) and match on the rooms the user is a member of.
+Comments only match on patients the user can see according to
+PatientVisibility (admins see every comment). Results are ranked by bm25
+among the newest RANK_WINDOW hits and paginated with LIMIT/OFFSET; older hits
+follow newest first once the window is paged through.
+
+`manage.py rebuild_search_index` repopulates the tables from the sources.
+"""
+import re
+import unicodedata
+from datetime import timezone as dt_timezone
+
+from django.apps import apps as global_apps
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.html import escape
+
+PAGE_SIZE = 20
+MAX_TERMS = 8
+# Hits scored per query, newest first; older hits follow unscored (see ranked_ids)
+RANK_WINDOW = 2000
+SNIPPET_WORDS = 16
+
+PARTICIPANTS = "'u' || {row}.sender_id || ' u' || {row}.receiver_id"
+ROOM = (
+    "CASE WHEN {row}.branch_id IS NOT NULL THEN 'branch' || {row}.branch_id "
+    "ELSE 'casegroup' || {row}.case_group_id END"
+)
+TABLES = ("search_message", "search_comment", "search_group")
+
+
+def _tables():
+    return {
+        name: global_apps.get_model("SmileHealth", model)._meta.db_table
+        for name, model in (
+            ("message", "Message"), ("archived", "ArchivedMessage"),
+            ("comment", "Comment"), ("visibility", "PatientVisibility"),
+            ("group", "GroupMessage"),
+        )
+    }
+
+
+def rebuild():
+    """Repopulate the FTS tables from the source tables. Returns (messages, comments, group messages)."""
+    t = _tables()
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute("DELETE FROM search_message")
+        cursor.execute(
+            f"INSERT INTO search_message (rowid, content, participants, sender_id, receiver_id, timestamp) "
+            f"SELECT id, content, {PARTICIPANTS.format(row='m')}, sender_id, receiver_id, timestamp "
+            f'FROM "{t["message"]}" m '
+            f"UNION ALL "
+            f"SELECT id, content, {PARTICIPANTS.format(row='a')}, sender_id, receiver_id, timestamp "
+            f'FROM "{t["archived"]}" a WHERE id NOT IN (SELECT id FROM "{t["message"]}")'
+        )
+        cursor.execute("DELETE FROM search_comment")
+        cursor.execute(
+            f"INSERT INTO search_comment (rowid, content, patient_id, author_id, created_at) "
+            f'SELECT id, content, patient_id, author_id, created_at FROM "{t["comment"]}"'
+        )
+        cursor.execute("DELETE FROM search_group")
+        cursor.execute(
+            f"INSERT INTO search_group (rowid, content, room, sender_id, timestamp) "
+            f'SELECT id, content, {ROOM.format(row="g")}, sender_id, timestamp FROM "{t["group"]}" g'
+        )
+        for table in TABLES:
+            cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('optimize')")
+    return tuple(_count(table) for table in TABLES)
+
+
+def verify():
+    """[(table, indexed, expected)] for FTS tables whose row count differs from the sources."""
+    t = _tables()
+    with connection.cursor() as cursor:
+        for table in TABLES:
+            cursor.execute(f"INSERT INTO {table} ({table}) VALUES ('integrity-check')")
+        cursor.execute(
+            f'SELECT (SELECT COUNT(*) FROM "{t["message"]}") + (SELECT COUNT(*) FROM "{t["archived"]}" '
+            f'WHERE id NOT IN (SELECT id FROM "{t["message"]}")), (SELECT COUNT(*) FROM "{t["comment"]}"), '
+            f'(SELECT COUNT(*) FROM "{t["group"]}")'
+        )
+        expected = dict(zip(TABLES, cursor.fetchone()))
+    return [
+        (table, _count(table), count)
+        for table, count in expected.items()
+        if _count(table) != count
+    ]
+
+
+def _count(table):
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COUNT(*) FROM {table}")
+        return cursor.fetchone()[0]
+
+
+def _terms(query):
+    return re.findall(r"\w+", query or "")[:MAX_TERMS]
+
+
+def match_expression(query):
+    """
+    User input -> FTS5 MATCH string: every word must occur in the content, as
+    a prefix. Words are quoted, so FTS5 operators in the input are searched
+    literally. Returns None when the input has no words.
+    """
+    terms = _terms(query)
+    if not terms:
+        return None
+    return "content : (" + " ".join(f'"{term}"*' for term in terms) + ")"
+
+
+def _as_datetime(value):
+    value = parse_datetime(value) if isinstance(value, str) else value
+    if value is not None and timezone.is_naive(value):
+        value = timezone.make_aware(value, dt_timezone.utc)
+    return value
+
+
+def ranked_ids(table, match, page=1, page_size=PAGE_SIZE, where="", params=()):
+    """
+    One page of rowids matching `match` and whether more follow. The
+    RANK_WINDOW newest hits come first, best bm25 score first: FTS5 walks the
+    posting lists by descending rowid and stops there, so a word that occurs
+    in half of all rows costs as much as a rare one. Hits older than the
+    window follow newest first, so every hit is reachable by paging.
+    """
+    offset = (max(page, 1) - 1) * page_size
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"SELECT id FROM ("
+            f"  SELECT rowid AS id, rank AS score FROM {table}"
+            f"  WHERE {table} MATCH %s{where} ORDER BY rowid DESC LIMIT %s"
+            f") ORDER BY score, id DESC LIMIT %s OFFSET %s",
+            [match, *params, RANK_WINDOW, page_size + 1, offset],
+        )
+        ids = [row[0] for row in cursor.fetchall()]
+        if len(ids) <= page_size:
+            # The page reaches the end of the window: is it full, and where does it stop?
+            cursor.execute(
+                f"SELECT COUNT(*), MIN(id) FROM ("
+                f"  SELECT rowid AS id FROM {table}"
+                f"  WHERE {table} MATCH %s{where} ORDER BY rowid DESC LIMIT %s"
+                f")",
+                [match, *params, RANK_WINDOW],
+            )
+            scored, oldest = cursor.fetchone()
+            if scored == RANK_WINDOW:
+                cursor.execute(
+                    f"SELECT rowid FROM {table} WHERE {table} MATCH %s{where} AND rowid < %s "
+                    f"ORDER BY rowid DESC LIMIT %s OFFSET %s",
+                    [match, *params, oldest, page_size + 1 - len(ids), max(offset - RANK_WINDOW, 0)],
+                )
+                ids += [row[0] for row in cursor.fetchall()]
+    return ids[:page_size], len(ids) > page_size
+
+
+def _rows(table, columns, ids):
+    """[(rowid, *columns)] for ids, in the order of ids (plain rowid lookups, no MATCH)."""
+    if not ids:
+        return []
+    marks = ", ".join(["%s"] * len(ids))
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT rowid, {', '.join(columns)} FROM {table} WHERE rowid IN ({marks})", ids)
+        rows = {row[0]: row for row in cursor.fetchall()}
+    return [rows[i] for i in ids if i in rows]
+
+
+def _fold(word):
+    """Lower case without diacritics, like the unicode61 tokenizer with remove_diacritics."""
+    decomposed = unicodedata.normalize("NFKD", word.lower())
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def snippet_html(text, query, width=SNIPPET_WORDS):
+    """
+    Escaped excerpt of text around the first hit with the matching words in
+    <mark>. Built here rather than with FTS5 snippet(), which would evaluate
+    the MATCH again for every row of the page.
+    """
+    terms = [_fold(t) for t in _terms(query)]
+    words = text.split()
+    hits = [i for i, word in enumerate(words) if any(_fold(re.sub(r"^\W+", "", word)).startswith(t) for t in terms)]
+    first = max((hits[0] if hits else 0) - width // 4, 0)
+    shown = []
+    for i in range(first, min(first + width, len(words))):
+        shown.append(f"<mark>{escape(words[i])}</mark>" if i in hits else escape(words[i]))
+    prefix = "… " if first > 0 else ""
+    suffix = " …" if first + width < len(words) else ""
+    return prefix + " ".join(shown) + suffix
+
+
+def search_messages(user, query, page=1, peer_id=None, page_size=PAGE_SIZE):
+    """Messages the user sent or received (optionally only with peer_id), best match first."""
+    match = match_expression(query)
+    if match is None:
+        return [], False
+    match = f'participants : "u{user.id}" AND {match}'
+    if peer_id is not None:
+        match = f'participants : "u{int(peer_id)}" AND {match}'
+    ids, has_more = ranked_ids("search_message", match, page, page_size)
+    rows = _rows("search_message", ("sender_id", "receiver_id", "timestamp", "content"), ids)
+
+    User = global_apps.get_model("auth", "User")
+    names = dict(
+        User.objects.filter(id__in={r[1] for r in rows} | {r[2] for r in rows}).values_list("id", "username")
+    )
+    results = []
+    for message_id, sender_id, receiver_id, timestamp, content in rows:
+        peer = receiver_id if sender_id == user.id else sender_id
+        results.append({
+            "message_id": message_id,
+            "sender_id": sender_id,
+            "sender_username": names.get(sender_id, ""),
+            "peer_id": peer,
+            "peer_username": names.get(peer, ""),
+            "timestamp": _as_datetime(timestamp).isoformat(),
+            "snippet_html": snippet_html(content, query),
+        })
+    return results, has_more
+
+
+def search_comments(user, query, page=1, patient_id=None, page_size=PAGE_SIZE):
+    """Comments on patients the user can view (optionally one patient), best match first."""
+    match = match_expression(query)
+    if match is None:
+        return [], False
+    where, params = "", []
+    if not (user.is_superuser or user.is_staff):
+        where += (
+            f' AND patient_id IN (SELECT patient_id FROM "{_tables()["visibility"]}" '
+            f"WHERE user_id = %s OR user_id IS NULL)"
+        )
+        params.append(user.id)
+    if patient_id is not None:
+        where += " AND patient_id = %s"
+        params.append(patient_id)
+    ids, has_more = ranked_ids("search_comment", match, page, page_size, where, params)
+    rows = _rows("search_comment", ("patient_id", "author_id", "created_at", "content"), ids)
+
+    Patient = global_apps.get_model("SmileHealth", "Patient")
+    User = global_apps.get_model("auth", "User")
+    patients = {
+        pid: f"{first} {last}"
+        for pid, first, last in Patient.objects.filter(id__in={r[1] for r in rows})
+        .values_list("id", "ptnName", "ptnLastname")
+    }
+    authors = dict(User.objects.filter(id__in={r[2] for r in rows}).values_list("id", "username"))
+    return [
+        {
+            "comment_id": comment_id,
+            "patient_id": patient_id,
+            "patient_name": patients.get(patient_id, ""),
+            "author_username": authors.get(author_id, ""),
+            "created_at": _as_datetime(created_at).isoformat(),
+            "snippet_html": snippet_html(content, query),
+        }
+        for comment_id, patient_id, author_id, created_at, content in rows
+    ], has_more
+
+
+def search_group_messages(user, query, page=1, page_size=PAGE_SIZE):
+    """Messages in the Branch and CaseGroup conversations the user belongs to, best match first."""
+    from . import group_chat
+
+    match = match_expression(query)
+    if match is None:
+        return [], False
+    rooms = group_chat.memberships(user.id)
+    if not rooms:
+        return [], False
+    match = "room : (" + " OR ".join(f'"{kind}{target_id}"' for kind, target_id in rooms) + f") AND {match}"
+    ids, has_more = ranked_ids("search_group", match, page, page_size)
+    rows = _rows("search_group", ("room", "sender_id", "timestamp", "content"), ids)
+
+    Branch = global_apps.get_model("SmileHealth", "Branch")
+    CaseGroup = global_apps.get_model("SmileHealth", "CaseGroup")
+    User = global_apps.get_model("auth", "User")
+    targets = [re.fullmatch(r"(branch|casegroup)(\d+)", row[1]).groups() for row in rows]
+    names = {
+        kind: dict(model.objects.filter(id__in={int(i) for k, i in targets if k == kind}).values_list("id", "name"))
+        for kind, model in (("branch", Branch), ("casegroup", CaseGroup))
+    }
+    senders = dict(User.objects.filter(id__in={r[2] for r in rows}).values_list("id", "username"))
+    results = []
+    for (message_id, _, sender_id, timestamp, content), (kind, target_id) in zip(rows, targets):
+        results.append({
+            "message_id": message_id,
+            "kind": kind,
+            "target_id": int(target_id),
+            "room_name": names[kind].get(int(target_id), ""),
+            "sender_username": senders.get(sender_id, ""),
+            "timestamp": _as_datetime(timestamp).isoformat(),
+            "snippet_html": snippet_html(content, query),
+        })
+    return results, has_more
@@ -1,11 +1,17 @@
 # SmileHealth/signals.py
 
-from django.db.models.signals import post_save, post_delete, pre_save
+from django.db.models.signals import post_init, post_save, post_delete, pre_save, pre_delete, m2m_changed
+from django.db import transaction
 from django.dispatch import receiver
 from django.contrib.auth.models import User, Group
 from django.contrib.auth.signals import user_logged_in
 
-from .models import Profile, Patient, Image, Comment, Model3D, Message, ActivityLog
+from .models import (
+    Profile, Patient, Image, Comment, Model3D, Message, ActivityLog, Branch, CaseGroup, PatientVisibility,
+    UploadSession,
+)
+from . import cache, conversations, directory, group_chat, tasks, unread, uploads, visibility
+from .middleware import invalidate_profile
 # Import Video if you added it (safe if missing)
 try:
     from .models import Video
@@ -70,7 +76,7 @@ def _log_activity(action, actor=None, target=None, details=""):
 
 # ── Profile auto-create / auto-save + role/group sync ─────────────────────────
 @receiver(post_save, sender=User)
-def ensure_user_profile(sender, instance, created, **kwargs):
+def ensure_user_profile(sender, instance, created, update_fields=None, **kwargs):
     """
     Create a Profile when a User is created; on update, keep it saved.
     Also sync is_staff and Group membership from Profile.role.
@@ -79,11 +85,13 @@ def ensure_user_profile(sender, instance, created, **kwargs):
         profile = Profile.objects.create(user=instance)  # default role = VIEWER
     else:
         profile, _ = Profile.objects.get_or_create(user=instance)
-        # Keep profile saved (your previous logic)
-        try:
-            instance.profile.save()
-        except Exception:
-            pass
+        # Keep profile saved (your previous logic); not on login, whose last_login
+        # save would otherwise invalidate the profile-derived caches every time
+        if not (update_fields and set(update_fields) <= {"last_login"}):
+            try:
+                instance.profile.save()
+            except Exception:
+                pass
 
     # If Profile has a role field (it should), sync staff flag + groups
     role = getattr(profile, "role", "VIEWER")
@@ -104,6 +112,142 @@ def sync_user_on_profile_change(sender, instance: Profile, **kwargs):
     _sync_user_groups_to_role(user, role)
 
 
+@receiver(post_save, sender=Profile)
+@receiver(post_delete, sender=Profile)
+def invalidate_cached_profile(sender, instance, **kwargs):
+    user_id = instance.user_id
+    transaction.on_commit(lambda: invalidate_profile(user_id))
+
+
+# ── Patient detail cache (see views.patient_image) ─────────────────────────────
+def _bump_patient(patient_id):
+    if patient_id:
+        transaction.on_commit(lambda: cache.bump(cache.patient_scope(patient_id)))
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def invalidate_patient_detail(sender, instance, **kwargs):
+    _bump_patient(instance.pk)
+
+
+@receiver(post_save, sender=CaseGroup)
+def invalidate_group_patient_details(sender, instance, created, **kwargs):
+    # the detail header shows the group name
+    if not created:
+        for patient_id in instance.patients.values_list("id", flat=True):
+            _bump_patient(patient_id)
+
+
+@receiver(post_save, sender=Image)
+@receiver(post_delete, sender=Image)
+@receiver(post_save, sender=Model3D)
+@receiver(post_delete, sender=Model3D)
+def invalidate_patient_media(sender, instance, **kwargs):
+    _bump_patient(instance.ptnID_id)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_patient_comments(sender, instance, **kwargs):
+    _bump_patient(instance.patient_id)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Profile)
+def invalidate_commented_patient_details(sender, instance, created=False, update_fields=None, **kwargs):
+    # The cached comments carry their author's name and avatar
+    if created or (update_fields and set(update_fields) <= {"last_login"}):
+        return
+    user_id = instance.pk if sender is User else instance.user_id
+    for patient_id in Comment.objects.filter(author_id=user_id).values_list("patient_id", flat=True).distinct():
+        _bump_patient(patient_id)
+
+
+# ── Group listing cache (see views._visible_groups) ────────────────────────────
+def _bump_group_listings(group_ids=(), user_ids=()):
+    """
+    Bump the listings of `user_ids` and of everyone who sees one of the
+    groups (creator and shared_with, read inside the transaction), plus the
+    admins' listing. Per user, as visibility.invalidate does for patients.
+    """
+    user_ids = set(user_ids)
+    if group_ids:
+        user_ids.update(CaseGroup.objects.filter(pk__in=group_ids).values_list("created_by_id", flat=True))
+        user_ids.update(
+            CaseGroup.shared_with.through.objects.filter(casegroup_id__in=group_ids).values_list("user_id", flat=True)
+        )
+    scopes = [cache.groups_scope(user_id) for user_id in user_ids if user_id]
+    scopes.append(cache.GROUPS_ALL_SCOPE)
+    transaction.on_commit(lambda: cache.bump(*scopes))
+
+
+@receiver(post_save, sender=CaseGroup)
+def invalidate_group_listing(sender, instance, **kwargs):
+    # shared_with too: a visibility change shows or hides the group for them
+    _bump_group_listings([instance.pk])
+
+
+@receiver(pre_delete, sender=CaseGroup)
+def invalidate_group_listing_on_delete(sender, instance, **kwargs):
+    # The share rows are removed by the cascade, before post_delete
+    _bump_group_listings([instance.pk])
+
+
+@receiver(m2m_changed, sender=CaseGroup.shared_with.through)
+def invalidate_group_listing_on_share(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear":
+        # the through rows are gone by post_clear
+        instance._group_listing_cleared = _case_group_pairs(instance, reverse, None)
+        return
+    if action == "post_clear":
+        pairs = instance.__dict__.pop("_group_listing_cleared", [])
+    elif action in ("post_add", "post_remove"):
+        pairs = _case_group_pairs(instance, reverse, pk_set)
+    else:
+        return
+    # Only the users added or removed: the listing does not show who else sees a group
+    _bump_group_listings(user_ids={user_id for user_id, _ in pairs})
+
+
+@receiver(pre_save, sender=Patient)
+def remember_patient_group(sender, instance, update_fields=None, **kwargs):
+    # Read at save time rather than in post_init, which runs for every loaded row
+    if instance.pk and (update_fields is None or {"group", "group_id"} & set(update_fields)):
+        instance._saved_group_id = Patient.objects.filter(pk=instance.pk).values_list("group_id", flat=True).first()
+
+
+@receiver(post_save, sender=Patient)
+@receiver(post_delete, sender=Patient)
+def invalidate_group_case_counts(sender, instance, created=False, **kwargs):
+    if created or kwargs["signal"] is post_delete:
+        group_ids = {instance.group_id}
+    elif "_saved_group_id" in instance.__dict__:
+        old_group_id = instance.__dict__.pop("_saved_group_id")
+        group_ids = {old_group_id, instance.group_id} if old_group_id != instance.group_id else set()
+    else:
+        group_ids = set()
+    group_ids.discard(None)
+    if group_ids:
+        _bump_group_listings(group_ids)
+
+
+@receiver(post_save, sender=ActivityLog)
+def invalidate_group_last_activity(sender, instance, created, **kwargs):
+    if created and instance.target_type == "CaseGroup":
+        _bump_group_listings([instance.target_id])
+
+
+# ── User directory cache (chat lists / share pickers) ──────────────────────────
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+@receiver(post_save, sender=Profile)
+def invalidate_user_directory(sender, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {"last_login"}:
+        return  # every login saves last_login; the directory does not show it
+    transaction.on_commit(directory.invalidate)
+
+
 @receiver(user_logged_in)
 def log_user_login(sender, request, user, **kwargs):
     _log_activity(ActivityLog.Action.LOGIN, actor=user, target=user)
@@ -147,14 +291,197 @@ def delete_old_thumb_on_change(sender, instance, **kwargs):
         old.thumbnail.delete(save=False)
 
 
-# ── Image / Video file cleanup ─────────────────────────────────────────────────
+# ── PatientVisibility index maintenance ───────────────────────────────────────
+@receiver(post_save, sender=Patient)
+def refresh_visibility_on_patient_save(sender, instance, **kwargs):
+    visibility.refresh_patients([instance.pk])
+
+
+@receiver(m2m_changed, sender=Patient.shared_with.through)
+def refresh_visibility_on_patient_share(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        visibility.refresh_patients([instance.pk])
+    elif pk_set is not None:
+        visibility.refresh_patients(pk_set)
+    else:
+        # user.shared_patients.clear(): the index still knows which patients were affected
+        visibility.refresh_patients(
+            PatientVisibility.objects.filter(user=instance, reason=PatientVisibility.Reason.SHARED)
+            .values_list("patient_id", flat=True)
+        )
+
+
+@receiver(pre_delete, sender=Patient)
+def remember_patient_viewers(sender, instance, **kwargs):
+    # Index rows are removed by the cascade; keep who could see the patient
+    instance._visibility_user_ids = list(instance.visibility_entries.values_list("user_id", flat=True))
+
+
+@receiver(post_delete, sender=Patient)
+def invalidate_visibility_on_patient_delete(sender, instance, **kwargs):
+    user_ids = getattr(instance, "_visibility_user_ids", [])
+    visibility.invalidate(user_ids, public=None in user_ids)
+
+
+@receiver(post_save, sender=CaseGroup)
+def refresh_visibility_on_group_save(sender, instance, created, **kwargs):
+    if not created:
+        visibility.refresh_groups([instance.pk])
+
+
+@receiver(m2m_changed, sender=CaseGroup.shared_with.through)
+def refresh_visibility_on_group_share(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "post_clear"):
+        return
+    if not reverse:
+        visibility.refresh_groups([instance.pk])
+    elif pk_set is not None:
+        visibility.refresh_groups(pk_set)
+    else:
+        visibility.refresh_patients(
+            PatientVisibility.objects.filter(user=instance, reason=PatientVisibility.Reason.GROUP_SHARED)
+            .values_list("patient_id", flat=True)
+        )
+
+
+@receiver(pre_delete, sender=CaseGroup)
+def remember_group_patients(sender, instance, **kwargs):
+    # Patient.group is SET_NULL via a bulk UPDATE, which sends no post_save
+    instance._visibility_patient_ids = list(instance.patients.values_list("id", flat=True))
+
+
+@receiver(post_delete, sender=CaseGroup)
+def refresh_visibility_on_group_delete(sender, instance, **kwargs):
+    visibility.refresh_patients(getattr(instance, "_visibility_patient_ids", []))
+
+
+# ── Group chat membership (see group_chat.py) ──────────────────────────────────
+def _branch_pairs(instance, reverse, pk_set):
+    """(user_id, branch_id) pairs touched by a Profile.branches change."""
+    if not reverse:  # profile.branches.add(...)
+        branch_ids = pk_set if pk_set is not None else instance.branches.values_list("id", flat=True)
+        return [(instance.user_id, branch_id) for branch_id in branch_ids]
+    profiles = Profile.objects.filter(pk__in=pk_set) if pk_set is not None else instance.users.all()
+    return [(user_id, instance.pk) for user_id in profiles.values_list("user_id", flat=True)]
+
+
+def _case_group_pairs(instance, reverse, pk_set):
+    """(user_id, case_group_id) pairs touched by a CaseGroup.shared_with change."""
+    if not reverse:  # group.shared_with.add(...)
+        user_ids = pk_set if pk_set is not None else instance.shared_with.values_list("id", flat=True)
+        return [(user_id, instance.pk) for user_id in user_ids]
+    group_ids = pk_set if pk_set is not None else instance.shared_case_groups.values_list("id", flat=True)
+    return [(instance.pk, group_id) for group_id in group_ids]
+
+
+def _membership_changed(kind, pairs, joined):
+    by_target = {}
+    for user_id, target_id in pairs:
+        by_target.setdefault(target_id, []).append(user_id)
+    for target_id, user_ids in by_target.items():
+        group_chat.membership_changed(user_ids, kind, target_id, joined)
+
+
+def _m2m_membership(kind, pairs_for, instance, action, reverse, pk_set):
+    if action == "pre_clear":
+        # the through rows are gone by post_clear
+        instance._group_chat_cleared = pairs_for(instance, reverse, None)
+    elif action == "post_clear":
+        _membership_changed(kind, instance.__dict__.pop("_group_chat_cleared", []), joined=False)
+    elif action in ("post_add", "post_remove"):
+        _membership_changed(kind, pairs_for(instance, reverse, pk_set), joined=action == "post_add")
+
+
+@receiver(m2m_changed, sender=Profile.branches.through)
+def update_branch_chat_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    _m2m_membership("branch", _branch_pairs, instance, action, reverse, pk_set)
+
+
+@receiver(m2m_changed, sender=CaseGroup.shared_with.through)
+def update_case_group_chat_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    _m2m_membership("casegroup", _case_group_pairs, instance, action, reverse, pk_set)
+
+
+@receiver(post_init, sender=CaseGroup)
+def remember_case_group_visibility(sender, instance, **kwargs):
+    instance._loaded_visibility = instance.__dict__.get("visibility")
+
+
+@receiver(post_save, sender=CaseGroup)
+def update_case_group_chat_on_save(sender, instance, created, **kwargs):
+    if created:
+        group_chat.membership_changed([instance.created_by_id], "casegroup", instance.pk, joined=True)
+    elif instance._loaded_visibility != instance.visibility:
+        # shared_with members gain or lose the conversation with the visibility
+        group_chat.membership_changed(
+            list(instance.shared_with.values_list("id", flat=True)), "casegroup", instance.pk,
+            joined=instance.visibility == CaseGroup.Visibility.SHARED,
+        )
+    instance._loaded_visibility = instance.visibility
+
+
+@receiver(pre_delete, sender=Branch)
+@receiver(pre_delete, sender=CaseGroup)
+def remember_group_chat_members(sender, instance, **kwargs):
+    # The membership rows are removed by the cascade
+    kind = "branch" if sender is Branch else "casegroup"
+    instance._group_chat_members = group_chat.member_ids(kind, instance.pk)
+
+
+@receiver(post_delete, sender=Branch)
+@receiver(post_delete, sender=CaseGroup)
+def close_group_chat_on_delete(sender, instance, **kwargs):
+    kind = "branch" if sender is Branch else "casegroup"
+    group_chat.membership_changed(getattr(instance, "_group_chat_members", []), kind, instance.pk, joined=False)
+
+
+# ── Image / Video / 3D model file cleanup (deferred, see tasks.py) ─────────────
 @receiver(post_delete, sender=Image)
 def delete_image_file_on_row_delete(sender, instance, **kwargs):
     """
-    When an Image row is deleted, remove its file from storage.
+    When an Image row is deleted, queue its file and derivatives for deletion.
     """
-    if instance.image:
-        instance.image.delete(save=False)
+    tasks.enqueue_file_delete(instance.image.name, instance.thumbnail.name, instance.preview.name)
+
+
+@receiver(post_delete, sender=Model3D)
+def delete_model3d_file_on_row_delete(sender, instance, **kwargs):
+    tasks.enqueue_file_delete(
+        instance.file.name,
+        instance.thumbnail.name if instance.thumbnail else "",
+        *(level["name"] for level in instance.lods),
+    )
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_partial_upload(sender, instance, **kwargs):
+    # Not in storage and never served, so no need to go through the queue
+    uploads.remove_partial(instance)
+
+
+@receiver(post_save, sender=Model3D)
+def process_model3d_upload(sender, instance, created, **kwargs):
+    """PNG preview for the gallery tile and coarse-to-fine meshes for the viewer."""
+    if created and instance.file:
+        tasks.enqueue_model_thumbnail(instance)
+        tasks.enqueue_model_lods(instance)
+
+
+@receiver(post_init, sender=Image)
+def remember_image_file(sender, instance, **kwargs):
+    if "image" in instance.__dict__:  # not deferred
+        instance._loaded_image_name = instance.__dict__["image"]
+
+
+@receiver(post_save, sender=Image)
+def build_image_derivatives(sender, instance, created, **kwargs):
+    """Thumbnail and WebP preview for the gallery; the original stays the download."""
+    replaced = instance.image.name != getattr(instance, "_loaded_image_name", instance.image.name)
+    if instance.image and (created or replaced):
+        tasks.enqueue_image_derivatives(instance)
+    instance._loaded_image_name = instance.image.name
 
 
 @receiver(post_save, sender=Image)
@@ -175,8 +502,21 @@ def log_comment_added(sender, instance, created, **kwargs):
 
 
 @receiver(post_save, sender=Message)
-def log_message_sent(sender, instance, created, **kwargs):
+def count_unread_message(sender, instance, created, **kwargs):
+    if created and not instance.is_read:
+        unread.adjust(instance.receiver_id, 1)
+
+
+@receiver(post_save, sender=Message)
+def update_conversation_summary(sender, instance, created, **kwargs):
     if created:
+        conversations.record_message(instance)
+
+
+@receiver(post_save, sender=Message)
+def log_message_sent(sender, instance, created, **kwargs):
+    # ChatConsumer batches its own MESSAGE_SENT rows off the send path
+    if created and not getattr(instance, "_activity_deferred", False):
         _log_activity(ActivityLog.Action.MESSAGE_SENT, actor=instance.sender, target=instance)
 
 
@@ -195,10 +535,10 @@ if Video:
     @receiver(post_delete, sender=Video)
     def delete_video_file_on_row_delete(sender, instance, **kwargs):
         """
-        When a Video row is deleted, remove its file from storage.
+        When a Video row is deleted, queue its file and poster for deletion; a
+        file the player still holds open is retried with backoff.
         """
-        if instance.file:
-            instance.file.delete(save=False)
+        tasks.enqueue_file_delete(instance.file.name, instance.poster.name)
 
 
     @receiver(post_save, sender=Video)
@@ -207,6 +547,18 @@ if Video:
             _log_activity(ActivityLog.Action.VIDEO_UPLOADED, actor=instance.usrID, target=instance)
 
 
+    @receiver(post_save, sender=Video)
+    def extract_video_poster(sender, instance, created, **kwargs):
+        if created and instance.file:
+            tasks.enqueue_video_poster(instance)
+
+
     @receiver(post_delete, sender=Video)
     def log_video_deleted(sender, instance, **kwargs):
         _log_activity(ActivityLog.Action.VIDEO_DELETED, actor=instance.usrID, target=instance)
+
+
+    @receiver(post_save, sender=Video)
+    @receiver(post_delete, sender=Video)
+    def invalidate_patient_videos(sender, instance, **kwargs):
+        _bump_patient(instance.ptnID_id)
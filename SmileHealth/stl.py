@@ -0,0 +1,239 @@
+# SmileHealth/stl.py
+"""
+Server-side preview images for uploaded STL scans, so the gallery does not
+download and parse every full model in the browser just to show a tile.
+
+load() reads binary and ASCII STL into an (n, 3, 3) float32 array with
+NumPy; render() draws it CPU-only:
+
+- orientation: the model is viewed along its axis of least extent (for a
+  dental arch: onto the occlusal plane), tilted by VIEW_TILT degrees so the
+  relief shows, with the longest axis horizontal
+- projection: orthographic, all vertices in one matrix product
+- rasterisation: triangles are bucketed by their screen bounding box (1, 2,
+  4, ... pixels) and each bucket is tested against its pixel grid in one
+  broadcast, chunked to FRAGMENT_BUDGET fragments; per chunk the nearest
+  fragment per pixel is merged into a z-buffer
+- shading: flat, per face, two-sided (scans are often open or inconsistently
+  wound)
+
+It renders at SUPERSAMPLE times THUMBNAIL_SIZE and scales down for
+anti-aliasing. A 50 MB binary scan (about a million triangles) takes
+about a second on one core; see `manage.py bench_stl_thumbnail`.
+
+New uploads get a "model3d.thumbnail" job from the post_save signal (see
+signals.py and tasks.py); `manage.py build_model_thumbnails` backfills
+existing models. Raising THUMBNAIL_VERSION makes the backfill redo
+thumbnails drawn with older settings.
+"""
+import io
+import os
+import re
+
+import numpy as np
+from django.core.files.base import ContentFile
+from PIL import Image as PILImage
+
+from .models import Model3D
+
+THUMBNAIL_VERSION = 1
+THUMBNAIL_SIZE = (320, 320)
+SUPERSAMPLE = 2
+MARGIN = 0.06                # of the image size, on every side
+VIEW_TILT = 25               # degrees
+COLOR = (226, 219, 203)      # plaster
+AMBIENT = 0.28
+LIGHT = (-0.35, 0.45, 1.0)   # towards the viewer, from the upper left
+FRAGMENT_BUDGET = 2_000_000  # candidate pixels tested at once, bounds the memory use
+PCA_SAMPLE = 200_000         # vertices used to find the orientation
+
+_RECORD = np.dtype([("normal", "<f4", (3,)), ("vertices", "<f4", (3, 3)), ("attribute", "<u2")])
+_VERTEX = re.compile(rb"vertex\s+(\S+\s+\S+\s+\S+)")
+
+
+class STLError(ValueError):
+    """The file is not a readable STL model."""
+
+
+def _storage():
+    return Model3D._meta.get_field("file").storage
+
+
+def parse(data):
+    """Triangles of an STL file's bytes as a float32 array of shape (n, 3, 3)."""
+    if len(data) >= 84:
+        count = int.from_bytes(data[80:84], "little")
+        # Binary files may start with "solid" too; the size decides
+        if len(data) == 84 + count * _RECORD.itemsize:
+            triangles = np.frombuffer(data, _RECORD, count, offset=84)["vertices"]
+            return _checked(triangles)
+    if data.lstrip()[:5].lower() != b"solid":
+        raise STLError("neither binary nor ASCII STL")
+    try:
+        values = np.array(b" ".join(_VERTEX.findall(data)).split(), dtype=np.float32)
+    except ValueError as exc:
+        raise STLError(f"ASCII STL with a non-numeric vertex: {exc}") from exc
+    if len(values) % 9:
+        raise STLError("ASCII STL with incomplete facets")
+    return _checked(values.reshape(-1, 3, 3))
+
+
+def _checked(triangles):
+    if not len(triangles):
+        raise STLError("STL without triangles")
+    finite = np.isfinite(triangles).all(axis=(1, 2))
+    if not finite.all():
+        triangles = triangles[finite]
+        if not len(triangles):
+            raise STLError("STL without finite coordinates")
+    return triangles
+
+
+def load(fp):
+    return parse(fp.read())
+
+
+def _view_matrix(vertices):
+    """Rotation putting the longest axis along x and the shortest towards the viewer (+z)."""
+    step = max(1, len(vertices) // PCA_SAMPLE)
+    sample = vertices[::step].astype(np.float64)
+    _, axes = np.linalg.eigh(np.cov(sample, rowvar=False))  # ascending variance
+    view, up, right = axes[:, 0], axes[:, 1], axes[:, 2]
+    if view @ (0.0, 0.0, 1.0) < 0:  # look from the side the model's +z points to
+        view = -view
+    if np.cross(right, up) @ view < 0:  # keep it a rotation, not a mirror image
+        right = -right
+    tilt = np.radians(VIEW_TILT)
+    c, s = np.cos(tilt), np.sin(tilt)
+    rotate_x = np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+    return rotate_x @ np.stack([right, up, view])
+
+
+def _project(triangles, width, height):
+    """Screen coordinates (x right, y down, z towards the viewer) in pixels."""
+    vertices = triangles.reshape(-1, 3)
+    matrix = _view_matrix(vertices).astype(np.float32)
+    points = vertices @ matrix.T
+    low, high = points.min(axis=0), points.max(axis=0)
+    extent = np.maximum(high - low, 1e-9)
+    usable = (1 - 2 * MARGIN) * np.array([width, height])
+    scale = min(usable / extent[:2])
+    centre = (low + high) / 2
+    points -= centre
+    points *= scale
+    points[:, 0] += width / 2
+    points[:, 1] = height / 2 - points[:, 1]
+    return points.reshape(-1, 3, 3)
+
+
+def _shade(screen):
+    """Flat two-sided Lambert shading per face, 0..1."""
+    normals = np.cross(screen[:, 1] - screen[:, 0], screen[:, 2] - screen[:, 0])
+    normals[:, 1] *= -1  # screen y points down
+    lengths = np.linalg.norm(normals, axis=1)
+    light = np.asarray(LIGHT, dtype=np.float32)
+    light /= np.linalg.norm(light)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        lambert = np.abs(normals @ light) / lengths
+    return AMBIENT + (1 - AMBIENT) * np.nan_to_num(lambert)
+
+
+def _rasterize(screen, shade, width, height):
+    """Z-buffer rasterisation; returns (depth, shade) images, depth -inf where empty."""
+    depth = np.full(width * height, -np.inf, dtype=np.float32)
+    colour = np.zeros(width * height, dtype=np.float32)
+
+    x, y, z = screen[..., 0], screen[..., 1], screen[..., 2]
+    # pixel centres at +0.5: the pixel columns a triangle can cover
+    x0 = np.clip(np.ceil(x.min(axis=1) - 0.5), 0, width).astype(np.int32)
+    x1 = np.clip(np.floor(x.max(axis=1) - 0.5), -1, width - 1).astype(np.int32)
+    y0 = np.clip(np.ceil(y.min(axis=1) - 0.5), 0, height).astype(np.int32)
+    y1 = np.clip(np.floor(y.max(axis=1) - 0.5), -1, height - 1).astype(np.int32)
+    span = np.maximum(x1 - x0, y1 - y0) + 1
+    area = (x[:, 1] - x[:, 0]) * (y[:, 2] - y[:, 0]) - (x[:, 2] - x[:, 0]) * (y[:, 1] - y[:, 0])
+    visible = (x1 >= x0) & (y1 >= y0) & (np.abs(area) > 1e-12)
+
+    bucket = np.zeros(len(screen), dtype=np.int32)
+    bucket[visible] = np.ceil(np.log2(span[visible])).astype(np.int32)
+    for power in np.unique(bucket[visible]):
+        size = 1 << int(power)
+        members = np.flatnonzero(visible & (bucket == power))
+        offsets = np.arange(size, dtype=np.int32)
+        per_chunk = max(1, FRAGMENT_BUDGET // (size * size))
+        for start in range(0, len(members), per_chunk):
+            idx = members[start:start + per_chunk]
+            px = (x0[idx, None] + offsets)[:, None, :]   # (t, 1, size)
+            py = (y0[idx, None] + offsets)[:, :, None]   # (t, size, 1)
+            # barycentric weights of every candidate pixel centre, relative to vertex 0
+            ax, ay = x[idx, 0, None, None], y[idx, 0, None, None]
+            ux, uy = x[idx, 1, None, None] - ax, y[idx, 1, None, None] - ay
+            vx, vy = x[idx, 2, None, None] - ax, y[idx, 2, None, None] - ay
+            dx, dy = px + np.float32(0.5) - ax, py + np.float32(0.5) - ay
+            inv = (1 / area[idx])[:, None, None]
+            w1 = (dx * vy - vx * dy) * inv
+            w2 = (ux * dy - dx * uy) * inv
+            w0 = 1 - w1 - w2
+            inside = (w0 >= -1e-6) & (w1 >= -1e-6) & (w2 >= -1e-6)
+            inside &= (px <= x1[idx, None, None]) & (py <= y1[idx, None, None])
+            tri, row, col = np.nonzero(inside)
+            if not len(tri):
+                continue
+            tz = z[idx]
+            frag_depth = (w0[tri, row, col] * tz[tri, 0] + w1[tri, row, col] * tz[tri, 1]
+                          + w2[tri, row, col] * tz[tri, 2])
+            pixel = (py[tri, row, 0] * width + px[tri, 0, col]).astype(np.int64)
+            # nearest fragment per pixel within the chunk, then against the z-buffer
+            order = np.lexsort((-frag_depth, pixel))
+            pixel, frag_depth, tri = pixel[order], frag_depth[order], tri[order]
+            first = np.ones(len(pixel), dtype=bool)
+            first[1:] = pixel[1:] != pixel[:-1]
+            pixel, frag_depth, tri = pixel[first], frag_depth[first], tri[first]
+            nearer = frag_depth > depth[pixel]
+            depth[pixel[nearer]] = frag_depth[nearer]
+            colour[pixel[nearer]] = shade[idx[tri[nearer]]]
+    return depth.reshape(height, width), colour.reshape(height, width)
+
+
+def render(triangles, size=THUMBNAIL_SIZE):
+    """PNG bytes (RGBA, transparent background) of the triangles."""
+    width, height = size[0] * SUPERSAMPLE, size[1] * SUPERSAMPLE
+    screen = _project(np.asarray(triangles, dtype=np.float32), width, height)
+    depth, shade = _rasterize(screen, _shade(screen), width, height)
+
+    rgba = np.zeros((height, width, 4), dtype=np.uint8)
+    rgba[..., :3] = (shade[..., None] * np.asarray(COLOR, dtype=np.float32)).clip(0, 255).astype(np.uint8)
+    rgba[..., 3] = np.where(np.isfinite(depth), 255, 0)
+    # premultiplied, so the transparent background does not darken the edges
+    img = PILImage.fromarray(rgba, "RGBA").convert("RGBa").resize(size, PILImage.LANCZOS).convert("RGBA")
+    out = io.BytesIO()
+    img.save(out, "PNG", optimize=True)
+    return out.getvalue()
+
+
+def create_thumbnail(name, replace=None):
+    """
+    Render the stored STL `name` to patient_models/thumbs/<stem>.png. A
+    thumbnail named in `replace` (an earlier run) is deleted first. Returns
+    the thumbnail's name. Touches no database.
+    """
+    storage = _storage()
+    with storage.open(name, "rb") as fp:
+        png = render(load(fp))
+    if replace:
+        storage.delete(replace)
+    stem = os.path.splitext(os.path.basename(name))[0]
+    upload_to = Model3D._meta.get_field("thumbnail").upload_to
+    return storage.save(f"{upload_to}{stem}.png", ContentFile(png))
+
+
+def record(model_id, thumbnail):
+    # update(): no post_save, so the upload signals do not run again
+    Model3D.objects.filter(pk=model_id).update(thumbnail=thumbnail, thumbnail_version=THUMBNAIL_VERSION)
+
+
+def pending(force=False):
+    """Models without a thumbnail or with one drawn with older settings."""
+    qs = Model3D.objects.exclude(file="")
+    if not force:
+        qs = qs.filter(thumbnail_version__lt=THUMBNAIL_VERSION)
+    return qs
@@ -0,0 +1,176 @@
+# SmileHealth/tasks.py
+"""
+Job kinds for the queue in SmileHealth/jobs.py. run() parts execute in
+`manage.py run_jobs` worker processes and only touch files; apply() parts
+record the result in the parent. Every apply() bumps the patient's version,
+because its gallery fragments are cached (see views.patient_image).
+
+Imported from SmileHealthConfig.ready(), so every process that sets up
+Django, workers included, knows all kinds.
+"""
+import os
+import shutil
+import subprocess
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from PIL import Image as PILImage
+
+from . import cache, derivatives, jobs, lod, stl
+from .models import Image, Model3D, Video
+
+POSTER_WIDTH = 640
+POSTER_TIMEOUT = 120  # seconds ffmpeg may take for one frame
+
+# Pillow cannot read the file; retrying will not change that
+_UNREADABLE = (PILImage.UnidentifiedImageError, PILImage.DecompressionBombError, SyntaxError, ValueError)
+
+
+def _bump_patient(patient_id):
+    if patient_id:
+        cache.bump(cache.patient_scope(patient_id))
+
+
+# ── Image thumbnail + WebP preview ────────────────────────────────────────────
+def enqueue_image_derivatives(image):
+    jobs.enqueue(
+        "image.derivatives",
+        {"image_id": image.pk, "name": image.image.name, "replace": [image.thumbnail.name, image.preview.name]},
+        patient_id=image.ptnID_id, created_by_id=image.usrID_id,
+    )
+
+
+def _run_image_derivatives(payload):
+    try:
+        return derivatives.create_files(payload["name"], replace=[n for n in payload["replace"] if n])
+    except _UNREADABLE as exc:
+        raise jobs.PermanentError(f"{payload['name']}: {exc}") from exc
+
+
+def _apply_image_derivatives(payload, names):
+    image = Image.objects.filter(pk=payload["image_id"]).values("image", "ptnID_id").first()
+    if image is None or image["image"] != payload["name"]:
+        # deleted or replaced while the job ran: these files belong to nobody
+        for name in names:
+            default_storage.delete(name)
+        return
+    derivatives.record(payload["image_id"], *names)
+    _bump_patient(image["ptnID_id"])
+
+
+jobs.register("image.derivatives", _run_image_derivatives, _apply_image_derivatives)
+
+
+# ── Video poster frame ────────────────────────────────────────────────────────
+def enqueue_video_poster(video):
+    jobs.enqueue(
+        "video.poster", {"video_id": video.pk, "name": video.file.name},
+        patient_id=video.ptnID_id, created_by_id=video.usrID_id,
+    )
+
+
+def _run_video_poster(payload):
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        raise jobs.PermanentError("ffmpeg is not installed; videos keep showing without a poster")
+    path = default_storage.path(payload["name"])
+    if not os.path.exists(path):
+        raise jobs.PermanentError(f"{payload['name']} does not exist")
+    frame = b""
+    for offset in ("1", "0"):  # one second in skips black intros; short clips only have frame 0
+        proc = subprocess.run(
+            [ffmpeg, "-v", "error", "-ss", offset, "-i", path, "-frames:v", "1",
+             "-vf", f"scale={POSTER_WIDTH}:-2", "-f", "image2", "-c:v", "mjpeg", "-"],
+            capture_output=True, timeout=POSTER_TIMEOUT,
+        )
+        frame = proc.stdout
+        if frame:
+            break
+    if not frame:
+        raise jobs.PermanentError(proc.stderr.decode(errors="replace").strip()[-500:] or "no video frame")
+    stem = os.path.splitext(payload["name"])[0]
+    return default_storage.save(f"{stem}_poster.jpg", ContentFile(frame))
+
+
+def _apply_video_poster(payload, name):
+    video = Video.objects.filter(pk=payload["video_id"]).values("file", "ptnID_id").first()
+    if video is None or video["file"] != payload["name"]:
+        default_storage.delete(name)
+        return
+    Video.objects.filter(pk=payload["video_id"]).update(poster=name)
+    _bump_patient(video["ptnID_id"])
+
+
+jobs.register("video.poster", _run_video_poster, _apply_video_poster)
+
+
+# ── 3D model thumbnail ────────────────────────────────────────────────────────
+def enqueue_model_thumbnail(model):
+    jobs.enqueue(
+        "model3d.thumbnail",
+        {"model_id": model.pk, "name": model.file.name, "replace": model.thumbnail.name if model.thumbnail else ""},
+        patient_id=model.ptnID_id, created_by_id=model.usrID_id,
+    )
+
+
+def _run_model_thumbnail(payload):
+    try:
+        return stl.create_thumbnail(payload["name"], replace=payload["replace"])
+    except stl.STLError as exc:
+        raise jobs.PermanentError(f"{payload['name']}: {exc}") from exc
+
+
+def _apply_model_thumbnail(payload, name):
+    model = Model3D.objects.filter(pk=payload["model_id"]).values("file", "ptnID_id").first()
+    if model is None or model["file"] != payload["name"]:
+        default_storage.delete(name)
+        return
+    stl.record(payload["model_id"], name)
+    _bump_patient(model["ptnID_id"])
+
+
+jobs.register("model3d.thumbnail", _run_model_thumbnail, _apply_model_thumbnail)
+
+
+# ── 3D model level-of-detail meshes ───────────────────────────────────────────
+def enqueue_model_lods(model):
+    jobs.enqueue(
+        "model3d.lods",
+        {"model_id": model.pk, "name": model.file.name, "replace": [level["name"] for level in model.lods]},
+        patient_id=model.ptnID_id, created_by_id=model.usrID_id,
+    )
+
+
+def _run_model_lods(payload):
+    try:
+        return lod.create_files(payload["name"], replace=payload["replace"])
+    except stl.STLError as exc:
+        raise jobs.PermanentError(f"{payload['name']}: {exc}") from exc
+
+
+def _apply_model_lods(payload, levels):
+    # The manifest reads the row directly, no gallery fragment changes
+    if not Model3D.objects.filter(pk=payload["model_id"], file=payload["name"]).exists():
+        for level in levels:
+            default_storage.delete(level["name"])
+        return
+    lod.record(payload["model_id"], levels)
+
+
+jobs.register("model3d.lods", _run_model_lods, _apply_model_lods)
+
+
+# ── Deferred file deletion ────────────────────────────────────────────────────
+def enqueue_file_delete(*names, patient_id=None):
+    for name in names:
+        if name:
+            jobs.enqueue("file.delete", {"name": name}, patient_id=patient_id)
+
+
+def _run_file_delete(payload):
+    # A file still open elsewhere (Windows: a player, a virus scanner) raises
+    # PermissionError here; the retry backoff waits it out.
+    default_storage.delete(payload["name"])
+
+
+jobs.register("file.delete", _run_file_delete, max_attempts=10)
@@ -1,3 +1,1603 @@
-from django.test import TestCase
+import asyncio
+import io
+import os
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from datetime import timedelta
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import User
+from django.core.cache import cache, caches
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.template import Context, Template
+from django.template.loader import render_to_string
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+import numpy as np
+from PIL import Image as PILImage
+
+from . import (
+    conversations, derivatives, directory, group_chat, jobs, lod, retention, search, stl, unread, uploads, views,
+    visibility,
+)
+from .access import AccessEvaluator
+from .cache_backends import TieredCache
+from .cards import CARD_FIELDS, build_patient_cards
+from .channel_layers import SQLiteChannelLayer
+from .consumers import ChatConsumer, GroupChatConsumer, NotifyConsumer, _parse_cursor
+from .context_processors import user_avatar
+from .middleware import ProfileMiddleware, get_profile
+from .models import (
+    ActivityLog, ArchivedMessage, ArchiveState, Branch, CaseGroup, Comment, Conversation, GroupMessage, GroupMessageRecipient,
+    Image, Job, Message, Model3D, Patient, PatientVisibility, Profile, UploadSession, Video,
+)
+
+
+class AccessEvaluatorTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.viewer = User.objects.create_user("viewer", password="pw")
+        self.admin = User.objects.create_user("admin", password="pw", is_superuser=True)
+        self.group = CaseGroup.objects.create(
+            name="Gruppe", created_by=self.owner, visibility=CaseGroup.Visibility.SHARED,
+        )
+        self.group.shared_with.add(self.viewer)
+
+    def _make_patients(self, n):
+        patients = []
+        for i in range(n):
+            vis = [Patient.Visibility.PRIVATE, Patient.Visibility.SHARED, Patient.Visibility.PUBLIC_ORG][i % 3]
+            p = Patient.objects.create(
+                ptnName=f"P{i}", ptnLastname="Test", ptnDOB="2000-01-01",
+                usrID=self.owner, visibility=vis,
+                group=self.group if i % 4 == 0 else None,
+            )
+            if vis == Patient.Visibility.SHARED and i % 2:
+                p.shared_with.add(self.viewer)
+            patients.append(p)
+        return patients
+
+    def _check_all(self, user, patients):
+        access = AccessEvaluator(user, patients=patients, groups=[self.group])
+        return (
+            [access.can_view_patient(p) for p in patients],
+            [access.can_edit_patient(p) for p in patients],
+            access.can_view_group(self.group),
+            access.can_create_in_group(self.group),
+        )
+
+    def test_matches_visibility_rules(self):
+        patients = self._make_patients(12)
+        expected = set(Patient.objects.visible_to_by_rules(self.viewer).values_list("id", flat=True))
+        views, edits, _, _ = self._check_all(self.viewer, patients)
+        self.assertEqual({p.id for p, ok in zip(patients, views) if ok}, expected)
+        self.assertFalse(any(edits))
+
+    def test_query_count_is_constant(self):
+        few = self._make_patients(3)
+        many = few + self._make_patients(60)
+        fresh = lambda ps: list(Patient.objects.filter(id__in=[p.id for p in ps]))
+
+        for patients in (fresh(few), fresh(many)):
+            with self.assertNumQueries(2):  # one visibility lookup, one group-share lookup
+                self._check_all(self.viewer, patients)
+
+    def test_admin_needs_no_queries(self):
+        patients = list(Patient.objects.filter(id__in=[p.id for p in self._make_patients(10)]))
+        with self.assertNumQueries(0):
+            views, edits, group_ok, _ = self._check_all(self.admin, patients)
+        self.assertTrue(all(views) and all(edits) and group_ok)
+
+
+class PatientVisibilityTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.anna = User.objects.create_user("anna", password="pw")
+        self.ben = User.objects.create_user("ben", password="pw")
+        self.group = CaseGroup.objects.create(
+            name="Gruppe", created_by=self.owner, visibility=CaseGroup.Visibility.SHARED,
+        )
+        self.group.shared_with.add(self.anna)
+
+        def patient(name, visibility, group=None):
+            return Patient.objects.create(
+                ptnName=name, ptnLastname="Test", ptnDOB="2000-01-01", usrID=self.owner,
+                visibility=visibility, group=group,
+            )
+
+        self.private = patient("privat", Patient.Visibility.PRIVATE)
+        self.shared = patient("geteilt", Patient.Visibility.SHARED)
+        self.shared.shared_with.add(self.ben)
+        self.public = patient("öffentlich", Patient.Visibility.PUBLIC_ORG)
+        self.grouped = patient("gruppe", Patient.Visibility.PRIVATE, group=self.group)
+
+    def _rows(self):
+        return set(PatientVisibility.objects.values_list("user_id", "patient_id", "reason"))
+
+    def _assert_rebuild_matches(self):
+        incremental = self._rows()
+        self.assertEqual(visibility.rebuild(), len(incremental))
+        self.assertEqual(self._rows(), incremental)
+        self.assertEqual(visibility.verify([self.owner, self.anna, self.ben]), [])
+
+    def test_incremental_index_equals_a_rebuild(self):
+        self._assert_rebuild_matches()
+        self.assertEqual(
+            set(Patient.objects.visible_to(self.anna).values_list("ptnName", flat=True)), {"öffentlich", "gruppe"},
+        )
+
+        # shares
+        self.private.shared_with.add(self.anna)
+        self.private.visibility = Patient.Visibility.SHARED
+        self.private.save()
+        self.shared.shared_with.clear()
+        self.group.shared_with.add(self.ben)
+        self._assert_rebuild_matches()
+
+        # group moves, in and out
+        self.public.group = self.group
+        self.public.save()
+        self.grouped.group = None
+        self.grouped.save()
+        self._assert_rebuild_matches()
+        self.assertIn("öffentlich", Patient.objects.visible_to(self.ben).values_list("ptnName", flat=True))
+
+        # group visibility, unshare and delete
+        self.group.shared_with.remove(self.anna)
+        self.group.visibility = CaseGroup.Visibility.PRIVATE
+        self.group.save()
+        self._assert_rebuild_matches()
+        self.group.delete()
+        self._assert_rebuild_matches()
+        self.assertEqual(
+            set(Patient.objects.visible_to(self.ben).values_list("ptnName", flat=True)), {"öffentlich"},
+        )
+
+    def test_command_rebuilds_and_verifies(self):
+        expected = self._rows()
+        PatientVisibility.objects.all().delete()
+        out = io.StringIO()
+        call_command("rebuild_patient_visibility", stdout=out)
+        self.assertEqual(self._rows(), expected)
+        self.assertIn("index matches the rules", out.getvalue())
+
+        PatientVisibility.objects.filter(patient=self.shared).delete()
+        with self.assertRaises(CommandError):
+            call_command("rebuild_patient_visibility", "--verify-only", stdout=io.StringIO(), stderr=io.StringIO())
+
+
+class ScopeCountsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.viewer = User.objects.create_user("viewer", password="pw")
+        for i, vis in enumerate([Patient.Visibility.PUBLIC_ORG, Patient.Visibility.SHARED, Patient.Visibility.PRIVATE]):
+            p = Patient.objects.create(
+                ptnName=f"P{i}", ptnLastname="Test", ptnDOB="2000-01-01", usrID=self.owner, visibility=vis,
+            )
+            if vis == Patient.Visibility.SHARED:
+                p.shared_with.add(self.viewer)
+        Patient.objects.create(ptnName="Own", ptnLastname="Case", ptnDOB="2000-01-01", usrID=self.viewer)
+
+    def test_counts_match_scopes(self):
+        self.client.force_login(self.viewer)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.get("/index/")
+        self.assertEqual(response.context["counts"], {"all": 3, "mine": 1, "shared": 1})
+
+    def test_counts_invalidated_by_share(self):
+        self.client.force_login(self.viewer)
+        self.client.get("/index/")
+        with self.captureOnCommitCallbacks(execute=True):
+            private = Patient.objects.get(visibility=Patient.Visibility.PRIVATE)
+            private.shared_with.add(self.viewer)
+            private.visibility = Patient.Visibility.SHARED
+            private.save()
+        response = self.client.get("/index/")
+        self.assertEqual(response.context["counts"], {"all": 4, "mine": 1, "shared": 2})
+
+
+class PatientCardTests(TestCase):
+    def setUp(self):
+        self.owner = User.objects.create_user("owner", password="pw", first_name="Olga", last_name="Owner")
+        self.colleagues = [User.objects.create_user(f"kollege{i}", password="pw") for i in range(6)]
+        self.admin = User.objects.create_user("chef", password="pw", is_staff=True)
+        for name, vis in [("Privat", "PRIVATE"), ("Geteilt", "SHARED"), ("Offen", "PUBLIC_ORG")]:
+            patient = Patient.objects.create(
+                ptnName=name, ptnLastname="Test", ptnDOB="2000-01-01", usrID=self.owner, visibility=vis,
+            )
+            if vis == "SHARED":
+                patient.shared_with.add(*self.colleagues)  # more than the chips shown
+        Patient.objects.filter(ptnName="Offen").update(thumbnail="patient_thumbs/offen.jpg")
+        Patient.objects.create(  # shared, but with nobody yet
+            ptnName="Leer", ptnLastname="Test", ptnDOB="2000-01-01", usrID=self.owner, visibility="SHARED",
+        )
+
+    def _render_both(self, user):
+        from .management.commands.bench_patient_cards import LEGACY_CARD_TEMPLATE
+
+        request = RequestFactory().get("/index/")
+        request.user = user
+        patients = Patient.objects.visible_to(user).order_by("-id")
+        legacy = Template(LEGACY_CARD_TEMPLATE).render(Context({
+            "patients": patients.select_related("usrID").prefetch_related("shared_with"), "request": request,
+        }))
+        cards = build_patient_cards(list(patients.values(*CARD_FIELDS)), user)
+        current = render_to_string("partials/patient_cards.html", {"cards": cards}, request=request)
+        return " ".join(legacy.split()), " ".join(current.split())
+
+    def test_cards_match_the_legacy_template_for_every_visibility(self):
+        for user in (self.owner, self.colleagues[0], User.objects.create_user("fremd", password="pw"), self.admin):
+            legacy, current = self._render_both(user)
+            self.assertEqual(current, legacy, user.username)
+        legacy, _ = self._render_both(self.colleagues[0])
+        for text in ("Geteilt mit: kollege4", "Weitere geteilt: 1", "Fremd", "/media/patient_thumbs/offen.jpg"):
+            self.assertIn(text, legacy)
+
+
+class PatientPageTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("doc", password="pw")
+        self.client.force_login(self.user)
+        # Identical names: the pages must still neither repeat nor skip a case
+        self.ids = [
+            Patient.objects.create(ptnName="Anna", ptnLastname="Müller", ptnDOB="2000-01-01", usrID=self.user).id
+            for _ in range(5)
+        ]
+        self.ids.sort(reverse=True)
+
+    def _page(self, before=None, size=2):
+        request = RequestFactory().get("/index/patients/")
+        request.user = self.user
+        _, _, patients = views._scoped_patients(request)
+        cards, cursor = views._patient_page(request, patients, before=before, size=size)
+        return [card.id for card in cards], cursor
+
+    def test_pages_follow_the_cursor(self):
+        seen, cursor = self._page()
+        self.assertEqual((seen, cursor), (self.ids[:2], self.ids[1]))
+        while cursor:
+            page, cursor = self._page(before=cursor)
+            seen += page
+        self.assertEqual(seen, self.ids)
+        self.assertEqual(self._page(before=self.ids[-1]), ([], None))
+
+    def test_endpoint_ignores_tampered_cursors(self):
+        first = self.client.get("/index/patients/", HTTP_HOST="localhost").json()
+        self.assertEqual((first["count"], first["next_cursor"]), (5, None))
+        for before in ("abc", "-3", "1 OR 1=1", "4.5", ""):
+            response = self.client.get("/index/patients/", {"before": before}, HTTP_HOST="localhost").json()
+            self.assertEqual(response["count"], 5, before)  # unusable cursor: first page
+        after = self.client.get("/index/patients/", {"before": self.ids[1]}, HTTP_HOST="localhost").json()
+        self.assertEqual(after["count"], 3)
+        beyond = self.client.get("/index/patients/", {"before": 10 ** 30}, HTTP_HOST="localhost").json()
+        self.assertEqual(beyond["count"], 5)
+
+    def test_name_search_is_a_case_insensitive_prefix_range(self):
+        Patient.objects.create(ptnName="Bert", ptnLastname="Mueller", ptnDOB="2000-01-01", usrID=self.user)
+        Patient.objects.create(ptnName="Müll", ptnLastname="Zeta", ptnDOB="2000-01-01", usrID=self.user)
+
+        def search(q):
+            return self.client.get("/index/patients/", {"q": q}, HTTP_HOST="localhost").json()["count"]
+
+        self.assertEqual(search("mü"), 6)
+        self.assertEqual(search("MüLLER ANNA"), 5)
+        self.assertEqual(search("mue"), 1)
+        self.assertEqual(search("müllerin"), 0)
+        self.assertEqual(search("%"), 0)
+
+        request = RequestFactory().get("/", {"q": "mü"})
+        request.user = self.user
+        _, _, patients = views._scoped_patients(request)
+        sql = str(patients.query)
+        self.assertNotIn("LIKE", sql)
+        self.assertIn('LOWER("SmileHealth_patient"."ptnLastname") >=', sql)
+
+
+class TieredCacheTests(TestCase):
+    def _backend(self, **options):
+        return TieredCache(None, {"OPTIONS": {"SHARED": "shared", **options}})
+
+    def setUp(self):
+        # The production layout: a file cache shared by the tiers, here in a temporary directory
+        location = tempfile.mkdtemp(prefix="smilehealth_cache_")
+        self.addCleanup(shutil.rmtree, location, ignore_errors=True)
+        override = override_settings(CACHES={
+            "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+            "shared": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": location},
+        })
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_local_tier_evicts_least_recently_used_by_size(self):
+        backend = self._backend(LOCAL_MAX_BYTES=600)
+        for i in range(3):
+            backend.set(f"k{i}", "x" * 200)
+        backend.get("k0")  # k1 is now the oldest entry
+        backend.set("k3", "x" * 200)
+        self.assertLessEqual(backend.local_size, 600)
+        caches["shared"].clear()
+        self.assertEqual(backend.get("k0"), "x" * 200)
+        self.assertIsNone(backend.get("k1"))
+
+    def test_version_counters_are_shared_between_processes(self):
+        worker_a, worker_b = self._backend(), self._backend()
+        worker_a.set("v:patient:1", 5, timeout=None)
+        self.assertEqual(worker_a.get("v:patient:1"), 5)
+        worker_b.incr("v:patient:1")
+        self.assertEqual(worker_a.get("v:patient:1"), 6)
+
+    def test_hit_and_miss_counters_per_namespace(self):
+        backend = self._backend()
+        backend.get("smilehealth.patient.detail:1:7")
+        backend.set("smilehealth.patient.detail:1:7", "detail")
+        backend.get("smilehealth.patient.detail:1:7")
+        self._backend().get("smilehealth.patient.detail:1:7")
+        self.assertEqual(backend.stats.snapshot()["smilehealth.patient.detail"],
+                         {"local_hits": 1, "shared_hits": 0, "misses": 1})
+
+
+class ProfileMiddlewareTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("doc", password="pw")
+        self.client.force_login(self.user)
+
+    def _request(self):
+        request = RequestFactory().get("/")
+        request.user = User.objects.get(pk=self.user.pk)
+        ProfileMiddleware(lambda r: None)(request)
+        return request
+
+    def test_profile_is_cached_until_it_is_saved(self):
+        self.assertEqual(get_profile(User.objects.get(pk=self.user.pk)).gender, Profile.Gender.UNSPECIFIED)
+        request = self._request()
+        with self.assertNumQueries(0):
+            self.assertEqual(request.profile.gender, Profile.Gender.UNSPECIFIED)
+            self.assertIs(request.user.profile, request.profile._wrapped)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = Profile.objects.get(user=self.user)
+            profile.gender = Profile.Gender.FEMALE
+            profile.save()
+        self.assertEqual(self._request().profile.gender, Profile.Gender.FEMALE)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile.delete()
+        self.assertIsNone(get_profile(User.objects.get(pk=self.user.pk)))
+
+    def test_settings_write_the_row_not_the_cached_copy(self):
+        get_profile(User.objects.get(pk=self.user.pk))
+        Profile.objects.filter(user=self.user).update(role=Profile.Role.DOCTOR)  # the cached copy is stale now
+        response = self.client.post("/settings/", {"gender": Profile.Gender.MALE}, HTTP_HOST="localhost")
+        self.assertEqual(response.status_code, 302)
+        profile = Profile.objects.get(user=self.user)
+        self.assertEqual((profile.role, profile.gender), (Profile.Role.DOCTOR, Profile.Gender.MALE))
+
+    def test_settings_create_a_missing_profile(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Profile.objects.filter(user=self.user).delete()
+        response = self.client.post("/settings/", {"description": "Kieferorthopädie"}, HTTP_HOST="localhost")
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Profile.objects.get(user=self.user).description, "Kieferorthopädie")
+
+    def test_missing_profile_is_looked_up_once_per_request(self):
+        Profile.objects.filter(user=self.user).delete()
+        request = self._request()
+        with self.assertNumQueries(1):
+            self.assertEqual(user_avatar(request), {"avatar": None})
+            self.assertEqual(user_avatar(request), {"avatar": None})
+
+
+class UserDirectoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.me = User.objects.create_user("ich", password="pw")
+        self.anna = User.objects.create_user("anna", password="pw", first_name="Anna", last_name="Arzt")
+        self.client.force_login(self.me)
+
+    def _search(self, **params):
+        response = self.client.get("/users/search/", params, HTTP_HOST="localhost")
+        return [u["name"] for u in response.json()["users"]]
+
+    def test_snapshot_is_reused_until_a_user_changes(self):
+        self.assertEqual([u.username for u in directory.active_users()], ["ich", "anna"])
+        with self.assertNumQueries(0):
+            directory.active_users()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.create_user("bert", password="pw")
+        self.assertEqual(self._search(q="be"), ["bert"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.anna.last_name = "Zahnärztin"
+            self.anna.save()
+        self.assertEqual(self._search(q="zahn"), ["Anna Zahnärztin"])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = Profile.objects.get(user=self.anna)
+            profile.avatar_url = "https://i.pravatar.cc/150?img=9"
+            profile.save()
+        self.assertEqual(directory.search("anna")[0].avatar_url, "https://i.pravatar.cc/150?img=9")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.anna.last_login = timezone.now()
+            self.anna.save(update_fields=["last_login"])
+        with self.assertNumQueries(0):
+            directory.active_users()  # logins do not rebuild it
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.anna.is_active = False
+            self.anna.save()
+        self.assertEqual(self._search(), ["bert"])
+
+    def test_limit_is_clamped(self):
+        User.objects.create_user("bert", password="pw")
+        self.assertEqual(len(self._search(limit=0)), 1)
+        self.assertEqual(len(self._search(limit=-5, sort="recent")), 1)
+        self.assertEqual(len(self._search(limit="viele")), 2)
+        self.assertEqual(len(self._search(limit=10 ** 6)), 2)
+
+
+class VisibleGroupsTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.viewer = User.objects.create_user("viewer", password="pw")
+        self.shared = CaseGroup.objects.create(
+            name="Geteilt", created_by=self.owner, visibility=CaseGroup.Visibility.SHARED,
+        )
+        self.shared.shared_with.add(self.viewer)
+        self.private = CaseGroup.objects.create(name="Privat", created_by=self.owner)
+        for i in range(3):
+            Patient.objects.create(
+                ptnName=f"P{i}", ptnLastname="Test", ptnDOB="2000-01-01",
+                usrID=self.owner, group=self.shared,
+            )
+
+    def test_annotated_listing_in_one_query(self):
+        with self.assertNumQueries(1):
+            groups = list(CaseGroup.objects.visible_to(self.viewer))
+            self.assertEqual([(g.name, g.case_count) for g in groups], [("Geteilt", 3)])
+            self.assertEqual(groups[0].created_by.username, "owner")
+            self.assertIsNotNone(groups[0].last_activity)
+        self.assertEqual({g.name for g in CaseGroup.objects.visible_to(self.owner)}, {"Geteilt", "Privat"})
+
+    def test_cached_listing_follows_shares_and_cases(self):
+        from .views import _visible_groups
+
+        self.assertEqual(len(_visible_groups(self.viewer)), 1)
+        with self.assertNumQueries(0):
+            _visible_groups(self.viewer)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shared.shared_with.remove(self.viewer)
+        self.assertEqual(_visible_groups(self.viewer), [])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Patient.objects.create(
+                ptnName="Neu", ptnLastname="Test", ptnDOB="2000-01-01",
+                usrID=self.owner, group=self.private,
+            )
+        counts = {g.name: g.case_count for g in _visible_groups(self.owner)}
+        self.assertEqual(counts, {"Geteilt": 3, "Privat": 1})
+
+    def test_group_changes_invalidate_only_the_users_who_see_them(self):
+        from .views import _visible_groups
+
+        outsider = User.objects.create_user("outsider", password="pw")
+        with self.captureOnCommitCallbacks(execute=True):
+            CaseGroup.objects.create(name="Eigene", created_by=outsider)
+        for user in (self.owner, self.viewer, outsider):
+            _visible_groups(user)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.private.name = "Privat (alt)"
+            self.private.save()
+            self.shared.shared_with.add(outsider)
+        with self.assertNumQueries(0):
+            self.assertEqual(len(_visible_groups(self.viewer)), 1)  # not shared with the viewer: still cached
+        self.assertIn("Privat (alt)", {g.name for g in _visible_groups(self.owner)})
+        self.assertIn("Geteilt", {g.name for g in _visible_groups(outsider)})
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.shared.shared_with.clear()
+        self.assertEqual(_visible_groups(self.viewer), [])
+        self.assertEqual([g.name for g in _visible_groups(outsider)], ["Eigene"])
+
+    def test_patient_moves_are_detected_on_save_only(self):
+        from .views import _visible_groups
+
+        _visible_groups(self.owner)
+        with self.assertNumQueries(1):
+            patients = list(Patient.objects.filter(group=self.shared))
+        self.assertFalse(any("_saved_group_id" in p.__dict__ for p in patients))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            patients[0].ptnName = "Umbenannt"
+            patients[0].save(update_fields=["ptnName"])
+        with self.assertNumQueries(0):
+            _visible_groups(self.owner)  # no move, no bump
+
+        with self.captureOnCommitCallbacks(execute=True):
+            patients[0].group = self.private
+            patients[0].save()
+        counts = {g.name: g.case_count for g in _visible_groups(self.owner)}
+        self.assertEqual(counts, {"Geteilt": 2, "Privat": 1})
+
+
+class ChatHistoryTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        other = User.objects.create_user("carol", password="pw")
+        base = timezone.now()
+        for i in range(7):
+            sender, receiver = (self.alice, self.bob) if i % 2 else (self.bob, self.alice)
+            msg = Message.objects.create(sender=sender, receiver=receiver, content=f"m{i}")
+            # two messages share each timestamp so the id tie-break is exercised
+            Message.objects.filter(pk=msg.pk).update(timestamp=base + timedelta(seconds=i // 2))
+        Message.objects.create(sender=other, receiver=self.alice, content="elsewhere")
+
+    def _page(self, before=None, limit=3):
+        consumer = ChatConsumer()
+        return async_to_sync(consumer.get_history_page)(self.alice.id, self.bob.id, before, limit)
+
+    def test_pages_walk_back_through_the_conversation(self):
+        seen = []
+        page = self._page()
+        with self.assertNumQueries(2):
+            self._page()
+        while True:
+            seen[:0] = [m["message"] for m in page["messages"]]
+            if not page["has_more"]:
+                break
+            page = self._page(_parse_cursor(page["cursor"]))
+        self.assertEqual(seen, [f"m{i}" for i in range(7)])
+
+
+class ChatWritePathTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.consumer = ChatConsumer()
+        self.consumer.user = self.bob
+        self.consumer.receiver_id = self.alice.id
+        self.consumer.receiver_username = "alice"
+        self.consumer.room_group_name = f"chat_{self.alice.id}_{self.bob.id}"
+        self.consumer.channel_layer = get_channel_layer()
+
+    def test_send_writes_only_the_message_and_its_summary(self):
+        async_to_sync(self.consumer.save_message)(self.bob.id, self.alice.id, "erste")
+        with self.assertNumQueries(4):  # SAVEPOINT, INSERT message, UPDATE conversation, RELEASE
+            msg = async_to_sync(self.consumer.save_message)(self.bob.id, self.alice.id, "hallo")
+        self.assertFalse(ActivityLog.objects.filter(action=ActivityLog.Action.MESSAGE_SENT).exists())
+
+        self.consumer._pending_logs.append(self.consumer._activity_row(msg))
+        async_to_sync(self.consumer.flush_pending)()
+        log = ActivityLog.objects.get(action=ActivityLog.Action.MESSAGE_SENT)
+        self.assertEqual((log.actor_id, log.target_id), (self.bob.id, msg.id))
+
+    def test_read_watermark_is_flushed_in_one_update(self):
+        Message.objects.bulk_create([Message(sender=self.alice, receiver=self.bob, content=str(i)) for i in range(200)])
+        conversations.rebuild()
+        # chat_message advances the watermark for each of the 200 deliveries
+        self.consumer._read_upto = Message.objects.order_by("-id").values_list("id", flat=True)[0]
+        with self.assertNumQueries(4):  # SAVEPOINT, UPDATE messages, UPDATE conversation, RELEASE
+            async_to_sync(self.consumer.flush_pending)()
+        self.assertFalse(Message.objects.filter(is_read=False).exists())
+        self.assertEqual(Conversation.objects.get().unread_high, 0)
+        with self.assertNumQueries(0):  # nothing new since the last flush
+            async_to_sync(self.consumer.flush_pending)()
+
+    def test_seen_is_announced_after_the_read_state_is_stored(self):
+        msg = Message.objects.create(sender=self.alice, receiver=self.bob, content="hallo")
+        announced = []
+
+        @database_sync_to_async
+        def stored_when_announced(upto):
+            announced.append((upto, Message.objects.get(pk=msg.pk).is_read))
+
+        self.consumer.announce_seen = stored_when_announced
+        self.consumer._read_upto = msg.id
+        async_to_sync(self.consumer.flush_pending)()
+        self.assertEqual(announced, [(msg.id, True)])
+
+
+class SQLiteChannelLayerTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "channels.sqlite3")
+
+    def _layer(self, **config):
+        return SQLiteChannelLayer(self.path, **config)
+
+    def test_group_send_reaches_other_processes(self):
+        async def run():
+            # two layer instances on one file stand in for two worker processes
+            worker_a, worker_b = self._layer(), self._layer()
+            chan_a, chan_b = await worker_a.new_channel(), await worker_b.new_channel()
+            await worker_a.group_add("chat_1_2", chan_a)
+            await worker_b.group_add("chat_1_2", chan_b)
+            await worker_a.group_send("chat_1_2", {"type": "chat.message", "text": "hallo"})
+            return await worker_a.receive(chan_a), await worker_b.receive(chan_b)
+
+        first, second = async_to_sync(run)()
+        self.assertEqual(first["text"], "hallo")
+        self.assertEqual(second, first)
+
+    def test_group_capacity_and_expiry(self):
+        async def run():
+            layer = self._layer(expiry=0.2, group_capacity={"chat_*": 2})
+            channel = await layer.new_channel()
+            await layer.group_add("chat_1_2", channel)
+            for n in range(5):
+                await layer.group_send("chat_1_2", {"n": n})
+            received = [await layer.receive(channel), await layer.receive(channel)]
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive(channel), 0.3)
+
+            await layer.send("plain", {"n": "late"})
+            await asyncio.sleep(0.3)
+            with self.assertRaises(asyncio.TimeoutError):
+                await asyncio.wait_for(layer.receive("plain"), 0.3)
+            return [m["n"] for m in received]
+
+        self.assertEqual(async_to_sync(run)(), [0, 1])
+
+    def test_buffers_of_departed_consumers_are_dropped_once_expired(self):
+        async def run():
+            layer = self._layer(expiry=0.2)
+            present, departed = await layer.new_channel(), await layer.new_channel()
+            await layer.send(departed, {"n": "unread"})
+            await layer.send(present, {"n": "read"})
+            await layer.receive(present)  # the poller buffers both, nobody waits for `departed`
+            layer._drop_stale_buffers()
+            kept = departed in layer._buffers
+            await asyncio.sleep(0.3)
+            layer._drop_stale_buffers()
+            return kept, departed in layer._buffers, dict(layer._buffer_expiry)
+
+        kept, still_there, expiries = async_to_sync(run)()
+        self.assertTrue(kept)
+        self.assertFalse(still_there)
+        self.assertEqual(expiries, {})
+
+
+class UnreadCounterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.layer = get_channel_layer()
+        self.channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(unread.notify_group(self.bob.id), self.channel)
+
+    def test_counter_is_cached_and_pushed_on_new_messages(self):
+        self.assertEqual(unread.count(self.bob.id), 0)
+        with self.assertNumQueries(0):
+            unread.count(self.bob.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content="hallo")
+        event = async_to_sync(self.layer.receive)(self.channel)
+        self.assertEqual((event["count"], event["delta"]), (1, 1))
+        with self.assertNumQueries(0):
+            self.assertEqual(unread.count(self.bob.id), 1)
+
+    def test_marking_read_pushes_the_decrement(self):
+        for i in range(3):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=str(i))
+        self.assertEqual(unread.count(self.bob.id), 3)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            async_to_sync(ChatConsumer().mark_conversation_read)(self.bob.id, self.alice.id)
+        event = async_to_sync(self.layer.receive)(self.channel)
+        self.assertEqual((event["count"], event["delta"]), (0, -3))
+
+    def test_adjusting_keeps_the_counter_expiry(self):
+        self.assertEqual(unread.count(self.bob.id), 0)
+        key = unread._key(self.bob.id)
+        expires_at = cache.get(key)[1]
+        self.assertAlmostEqual(expires_at, time.time() + unread.UNREAD_TTL, delta=5)
+
+        for _ in range(3):
+            with self.captureOnCommitCallbacks(execute=True):
+                Message.objects.create(sender=self.alice, receiver=self.bob, content="hallo")
+        self.assertEqual(cache.get(key), (3, expires_at))
+        # the cache entry expires with the original count, not after its default TIMEOUT
+        self.assertAlmostEqual(cache._expire_info[cache.make_and_validate_key(key)], expires_at, delta=1)
+
+        cache.set(key, (3, time.time() - 1), 60)  # past its expiry: further deltas do not revive it
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content="hallo")
+        self.assertEqual(cache.get(key)[0], 3)
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.carol = User.objects.create_user("carol", password="pw")
+
+    def _send(self, sender, receiver, text):
+        return Message.objects.create(sender=sender, receiver=receiver, content=text)
+
+    def test_summary_follows_sends_and_reads(self):
+        self._send(self.alice, self.bob, "1")
+        self._send(self.alice, self.bob, "2")
+        last = self._send(self.bob, self.alice, "3")
+        self._send(self.carol, self.bob, "4")
+
+        conv = Conversation.objects.get(user_low=self.alice, user_high=self.bob)
+        self.assertEqual((conv.last_message_id, conv.unread_low, conv.unread_high), (last.id, 1, 2))
+
+        async_to_sync(ChatConsumer().mark_conversation_read)(self.bob.id, self.alice.id)
+        summaries = conversations.summaries_by_peer(self.bob.id)
+        self.assertEqual(list(summaries), [self.carol.id, self.alice.id])  # most recent first
+        self.assertEqual(summaries[self.alice.id][1:], (0, "3"))
+        self.assertEqual(summaries[self.carol.id][1], 1)
+        self.assertEqual(conversations.verify(), [])
+
+    def test_out_of_order_update_keeps_the_newest_message(self):
+        newer = self._send(self.alice, self.bob, "neu")
+        older = Message(id=newer.id - 1000, sender=self.bob, receiver=self.alice, content="alt",
+                        timestamp=newer.timestamp - timedelta(seconds=5))
+        conversations.record_message(older)  # a concurrent sender committing late
+        conv = Conversation.objects.get()
+        self.assertEqual((conv.last_message_id, conv.unread_low, conv.unread_high), (newer.id, 1, 1))
+
+    def test_rebuild_recomputes_from_messages(self):
+        self._send(self.alice, self.bob, "1")
+        self._send(self.carol, self.alice, "2")
+        Conversation.objects.update(unread_low=7, last_message=None)
+        self.assertEqual(len(conversations.verify()), 2)
+        self.assertEqual(conversations.rebuild(), 2)
+        self.assertEqual(conversations.verify(), [])
+
+
+class MessageRetentionTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        old = timezone.now() - timedelta(days=400)
+        self.ids = []
+        for i in range(8):
+            sender, receiver = (self.alice, self.bob) if i % 2 else (self.bob, self.alice)
+            msg = Message.objects.create(sender=sender, receiver=receiver, content=f"m{i}")
+            # m0-m5 are past the retention window, m6 and m7 are recent
+            Message.objects.filter(pk=msg.pk).update(timestamp=old + timedelta(minutes=i) if i < 6 else msg.timestamp)
+            self.ids.append(msg.id)
+        Message.objects.exclude(content="m2").update(is_read=True)
+        conversations.rebuild()
+
+    def _page(self, before=None, limit=3):
+        return async_to_sync(ChatConsumer().get_history_page)(self.alice.id, self.bob.id, before, limit)
+
+    def test_archive_skips_unread_and_keeps_ids(self):
+        moved, finished = retention.archive(batch_size=2)
+        self.assertEqual((moved, finished), (5, True))
+        self.assertEqual(set(ArchivedMessage.objects.values_list("id", flat=True)),
+                         {self.ids[i] for i in (0, 1, 3, 4, 5)})
+        self.assertEqual(list(Message.objects.order_by("id").values_list("content", flat=True)), ["m2", "m6", "m7"])
+        self.assertEqual(retention.horizon(), ArchivedMessage.objects.get(content="m5").timestamp)
+        self.assertEqual(conversations.verify(), [])
+
+    def test_interrupted_run_resumes_from_the_cursor(self):
+        self.assertEqual(retention.archive(batch_size=2, max_batches=1), (2, False))
+        self.assertEqual(ArchiveState.objects.get().cursor, self.ids[1])
+        cache.clear()  # the cursor survives a cache flush or eviction
+        self.assertEqual(retention.archive(batch_size=2, max_batches=1), (2, False))  # m3, m4; m2 is unread
+        self.assertEqual(ArchiveState.objects.get().cursor, self.ids[4])
+        self.assertEqual(retention.archive(batch_size=2), (1, True))
+        self.assertEqual(ArchiveState.objects.get().cursor, 0)
+        self.assertEqual(ArchivedMessage.objects.count(), 5)
+
+    def test_horizon_outlives_the_cache(self):
+        self.assertIsNone(retention.horizon())
+        retention.archive()
+        newest = ArchivedMessage.objects.get(content="m5").timestamp
+        self.assertEqual(ArchiveState.objects.get().horizon, newest)
+        cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(retention.horizon(), newest)
+        with self.assertNumQueries(0):
+            self.assertEqual(retention.horizon(), newest)
+
+        expires = cache._expire_info[cache.make_and_validate_key(retention._horizon_key())]
+        self.assertLessEqual(expires, time.time() + retention.HORIZON_TTL)
+
+        # Archives written before ArchiveState existed: the newest row counts
+        ArchiveState.objects.all().delete()
+        cache.clear()
+        self.assertEqual(retention.horizon(), newest)
+
+    def test_history_pages_into_the_archive(self):
+        retention.archive()
+        with self.assertNumQueries(2):  # m7 and the next row (m6) are newer than the archive
+            self._page(limit=1)
+        page = self._page(limit=2)  # m6, m7 and then m2 (old but unread): reaches into the archive
+        seen = []
+        while True:
+            seen[:0] = [m["message"] for m in page["messages"]]
+            if not page["has_more"]:
+                break
+            page = self._page(_parse_cursor(page["cursor"]), limit=2)
+        self.assertEqual(seen, [f"m{i}" for i in range(8)])
+
+
+class EphemeralChatEventsTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+
+    def _communicator(self, user, peer):
+        comm = WebsocketCommunicator(ChatConsumer.as_asgi(), f"/ws/chat/{peer.id}/")
+        comm.scope["user"] = user
+        comm.scope["url_route"] = {"kwargs": {"receiver_id": str(peer.id)}}
+        return comm
+
+    def _run(self, scenario):
+        async def run():
+            alice, bob = self._communicator(self.alice, self.bob), self._communicator(self.bob, self.alice)
+            for comm in (alice, bob):
+                await comm.connect()
+                await comm.receive_json_from()  # history
+            try:
+                return await scenario(alice, bob)
+            finally:
+                await alice.disconnect()
+                await bob.disconnect()
+        return async_to_sync(run)()
+
+    def test_typing_is_coalesced_and_stays_off_the_database(self):
+        async def scenario(alice, bob):
+            for _ in range(5):
+                await alice.send_json_to({"command": "typing"})
+            await alice.send_json_to({"command": "typing", "typing": False})
+            frames = [await bob.receive_json_from(), await bob.receive_json_from()]
+            self.assertTrue(await bob.receive_nothing())
+            self.assertTrue(await alice.receive_nothing())  # never echoed to the typist
+            return frames
+
+        async def idle(alice, bob):
+            return None
+
+        with CaptureQueriesContext(connection) as baseline:
+            self._run(idle)
+        with CaptureQueriesContext(connection) as queries:
+            frames = self._run(scenario)
+        self.assertEqual(frames, [{"type": "typing", "typing": True}, {"type": "typing", "typing": False}])
+        self.assertEqual(len(queries), len(baseline))  # connect and disconnect only
+
+    def test_delivery_is_announced_as_one_seen_watermark(self):
+        async def scenario(alice, bob):
+            for text in ("eins", "zwei", "drei"):
+                await alice.send_json_to({"message": text})
+            for _ in range(3):
+                await bob.receive_json_from()
+                await alice.receive_json_from()  # own echo
+            return await alice.receive_json_from(timeout=3)  # after FLUSH_INTERVAL
+
+        seen = self._run(scenario)
+        newest = Message.objects.order_by("-id").first()
+        self.assertEqual(seen, {"type": "seen", "upto": newest.id})
+        self.assertFalse(Message.objects.filter(is_read=False).exists())
+
+
+class FullTextSearchTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.carol = User.objects.create_user("carol", password="pw")
+        self.admin = User.objects.create_user("admin", password="pw", is_staff=True)
+
+    def test_messages_match_only_the_users_conversations(self):
+        Message.objects.create(sender=self.alice, receiver=self.bob, content="Der Abdruck kommt morgen")
+        Message.objects.create(sender=self.carol, receiver=self.bob, content="Abdruck ist da")
+        Message.objects.create(sender=self.carol, receiver=self.alice, content="Termin verschoben")
+
+        results, has_more = search.search_messages(self.alice, "abdr")
+        self.assertEqual(len(results), 1)
+        self.assertFalse(has_more)
+        self.assertEqual(results[0]["peer_username"], "bob")
+        self.assertIn("<mark>Abdruck</mark>", results[0]["snippet_html"])
+
+        self.assertEqual(len(search.search_messages(self.bob, "abdruck")[0]), 2)
+        self.assertEqual(len(search.search_messages(self.bob, "abdruck", peer_id=self.carol.id)[0]), 1)
+        self.assertEqual(search.search_messages(self.bob, 'NEAR("x" OR')[0], [])  # operators are literal
+
+    def test_comments_follow_patient_visibility(self):
+        patient = Patient.objects.create(
+            ptnName="Max", ptnLastname="Muster", ptnDOB="2000-01-01",
+            usrID=self.alice, visibility=Patient.Visibility.PRIVATE,
+        )
+        Comment.objects.create(patient=patient, author=self.alice, content="Röntgen zeigt <b>Befund</b>")
+
+        results, _ = search.search_comments(self.alice, "rontgen")  # diacritics are folded
+        self.assertEqual([r["patient_name"] for r in results], ["Max Muster"])
+        self.assertIn("<mark>Röntgen</mark>", results[0]["snippet_html"])
+        self.assertIn("&lt;b&gt;Befund&lt;/b&gt;", results[0]["snippet_html"])
+        self.assertEqual(search.search_comments(self.bob, "rontgen")[0], [])
+        self.assertEqual(len(search.search_comments(self.admin, "rontgen")[0]), 1)
+
+    def test_index_follows_updates_archiving_and_deletes(self):
+        msg = Message.objects.create(sender=self.alice, receiver=self.bob, content="Krone passt", is_read=True)
+        Message.objects.filter(pk=msg.pk).update(content="Brücke passt")
+        self.assertEqual(search.search_messages(self.alice, "krone")[0], [])
+        self.assertEqual(len(search.search_messages(self.alice, "brucke")[0]), 1)
+
+        Message.objects.create(sender=self.bob, receiver=self.alice, content="Danke")  # stays the last message
+        Message.objects.filter(pk=msg.pk).update(timestamp=timezone.now() - timedelta(days=400))
+        self.assertEqual(retention.archive()[0], 1)
+        self.assertEqual(search.search_messages(self.alice, "brucke")[0][0]["message_id"], msg.id)
+        self.assertEqual(search.verify(), [])
+
+        ArchivedMessage.objects.all().delete()
+        self.assertEqual(search.search_messages(self.alice, "brucke")[0], [])
+        self.assertEqual(search.rebuild(), (1, 0, 0))
+        self.assertEqual(search.verify(), [])
+
+    def test_group_messages_match_only_the_users_rooms(self):
+        branch = Branch.objects.create(name="Mitte")
+        branch.users.add(self.alice.profile, self.bob.profile)
+        group_chat.send(self.alice.id, "branch", branch.id, "Fortbildung am Freitag")
+
+        results, has_more = search.search_group_messages(self.bob, "fortbild")
+        self.assertFalse(has_more)
+        self.assertEqual(
+            [(r["kind"], r["target_id"], r["room_name"], r["sender_username"]) for r in results],
+            [("branch", branch.id, "Mitte", "alice")],
+        )
+        self.assertEqual(search.search_group_messages(self.carol, "fortbild")[0], [])
+
+        self.client.force_login(self.carol)
+        self.assertEqual(self.client.get("/search/", {"q": "fortbild"}).json()["groups"]["results"], [])
+        branch.users.add(self.carol.profile)
+        self.assertEqual(len(self.client.get("/search/", {"q": "fortbild", "kind": "groups"}).json()["groups"]["results"]), 1)
+        self.assertEqual(search.verify(), [])
+
+    def test_endpoint_pages_results(self):
+        for i in range(search.PAGE_SIZE + 3):
+            Message.objects.create(sender=self.alice, receiver=self.bob, content=f"Planung {i}")
+        self.client.force_login(self.alice)
+        first = self.client.get("/search/", {"q": "planung", "kind": "messages"}).json()
+        second = self.client.get("/search/", {"q": "planung", "kind": "messages", "page": 2}).json()
+        self.assertTrue(first["messages"]["has_more"])
+        self.assertEqual(len(first["messages"]["results"]) + len(second["messages"]["results"]), search.PAGE_SIZE + 3)
+        self.assertNotIn("comments", first)
+        self.assertEqual(self.client.get("/search/", {"q": "x", "kind": "dateien"}).status_code, 400)
+
+    def test_paging_continues_past_the_rank_window(self):
+        Message.objects.bulk_create([
+            Message(sender=self.alice, receiver=self.bob, content=f"Planung {i}")
+            for i in range(search.RANK_WINDOW + 30)
+        ])
+        Message.objects.create(sender=self.alice, receiver=self.bob, content="Planung Planung Planung")
+        ids = list(Message.objects.order_by("-id").values_list("id", flat=True))
+
+        seen, page, has_more = [], 0, True
+        while has_more:
+            page += 1
+            results, has_more = search.search_messages(self.alice, "planung", page, page_size=300)
+            seen += [r["message_id"] for r in results]
+        self.assertEqual(page, 7)
+        self.assertEqual(sorted(seen, reverse=True), ids)
+        self.assertEqual(seen[0], ids[0])  # best score within the window
+        # hits older than the window follow it, newest first
+        self.assertEqual(seen[search.RANK_WINDOW:], ids[search.RANK_WINDOW:])
+
+
+class GroupChatTests(TestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+        self.carol = User.objects.create_user("carol", password="pw")
+        self.branch = Branch.objects.create(name="Mitte")
+        self.branch.users.add(self.alice.profile, self.bob.profile)
+
+    def _socket(self, user, path, consumer, **kwargs):
+        comm = WebsocketCommunicator(consumer.as_asgi(), path)
+        comm.scope["user"] = user
+        comm.scope["url_route"] = {"kwargs": kwargs}
+        return comm
+
+    def _group(self, user):
+        return self._socket(
+            user, f"/ws/group/branch/{self.branch.id}/", GroupChatConsumer,
+            kind="branch", target_id=str(self.branch.id),
+        )
+
+    def _notify(self, user):
+        return self._socket(user, "/ws/notify/", NotifyConsumer)
+
+    def test_index_lists_the_users_group_conversations(self):
+        CaseGroup.objects.create(name="Implantate", created_by=self.alice)
+        self.assertEqual(
+            [(room["kind"], room["name"]) for room in group_chat.rooms(self.alice.id)],
+            [("branch", "Mitte"), ("casegroup", "Implantate")],
+        )
+        self.client.force_login(self.carol)
+        self.assertNotContains(self.client.get("/index/", HTTP_HOST="localhost"), "data-kind=")
+        self.client.force_login(self.alice)
+        self.assertContains(
+            self.client.get("/index/", HTTP_HOST="localhost"),
+            f'data-kind="branch" data-id="{self.branch.id}" data-name="Mitte"',
+        )
+
+    def test_send_cost_does_not_grow_with_the_group(self):
+        with CaptureQueriesContext(connection) as small:
+            group_chat.send(self.alice.id, "branch", self.branch.id, "klein")
+
+        big = Branch.objects.create(name="Zentrale")
+        User.objects.bulk_create([User(username=f"member{i}") for i in range(200)])
+        members = User.objects.filter(username__startswith="member")
+        Profile.objects.bulk_create([Profile(user=user) for user in members])
+        big.users.add(*Profile.objects.filter(user__in=members), self.alice.profile)
+        with CaptureQueriesContext(connection) as large:
+            msg = group_chat.send(self.alice.id, "branch", big.id, "Ankündigung")
+
+        # SAVEPOINT, INSERT message, SELECT members, INSERT recipients, RELEASE
+        self.assertEqual(len(small), 5)
+        self.assertEqual(len(large), len(small))
+        self.assertEqual(msg.recipients.count(), 200)
+        self.assertFalse(msg.recipients.filter(user=self.alice).exists())
+
+    def test_message_reaches_room_and_notify_sockets(self):
+        async def run():
+            alice, bob_chat, bob_notify = self._group(self.alice), self._group(self.bob), self._notify(self.bob)
+            outsider = self._group(self.carol)
+            self.assertFalse((await outsider.connect())[0])
+            for comm in (alice, bob_chat, bob_notify):
+                await comm.connect()
+                await comm.receive_json_from()  # history / unread count
+            await alice.send_json_to({"message": "Teamsitzung um 9"})
+            frames = (await bob_chat.receive_json_from(), await bob_notify.receive_json_from())
+            await alice.receive_json_from()  # own echo
+            self.assertTrue(await alice.receive_nothing())
+            for comm in (alice, bob_chat, bob_notify):
+                await comm.disconnect()
+            return frames
+
+        chat, notify = async_to_sync(run)()
+        msg = GroupMessage.objects.get()
+        self.assertEqual((chat["message"], chat["message_id"]), ("Teamsitzung um 9", msg.id))
+        self.assertEqual((notify["type"], notify["kind"], notify["target_id"]), ("group_message", "branch", self.branch.id))
+        # bob had the conversation open, so his recipient row is read
+        self.assertTrue(GroupMessageRecipient.objects.get(user=self.bob).is_read)
+
+    def test_membership_changes_update_subscriptions_live(self):
+        def change(*, join):
+            with self.captureOnCommitCallbacks(execute=True):
+                if join:
+                    self.carol.profile.branches.add(self.branch)
+                else:
+                    self.branch.users.remove(self.carol.profile)
+
+        async def run():
+            alice, carol = self._group(self.alice), self._notify(self.carol)
+            for comm in (alice, carol):
+                await comm.connect()
+                await comm.receive_json_from()
+            await database_sync_to_async(change)(join=True)
+            joined = await carol.receive_json_from()
+            await alice.send_json_to({"message": "Willkommen"})
+            delivered = await carol.receive_json_from()
+
+            carol_chat = self._group(self.carol)
+            await carol_chat.connect()
+            await carol_chat.receive_json_from()
+            await database_sync_to_async(change)(join=False)
+            left = await carol.receive_json_from()
+            removed = await carol_chat.receive_json_from()
+            closed = await carol_chat.receive_output()
+            await alice.send_json_to({"message": "Nur noch Mitglieder"})
+            await alice.receive_json_from()
+            await alice.receive_json_from()
+            self.assertTrue(await carol.receive_nothing())
+            for comm in (alice, carol):
+                await comm.disconnect()
+            return joined, delivered, left, removed, closed
+
+        joined, delivered, left, removed, closed = async_to_sync(run)()
+        self.assertEqual((joined["type"], joined["joined"]), ("membership", True))
+        self.assertEqual(delivered["message"], "Willkommen")
+        self.assertEqual((left["type"], left["joined"]), ("membership", False))
+        self.assertEqual(removed, {"type": "removed"})
+        self.assertEqual(closed["type"], "websocket.close")
+
+
+def use_temporary_media(test):
+    media = tempfile.mkdtemp(prefix="smilehealth_media_")
+    test.addCleanup(shutil.rmtree, media, ignore_errors=True)
+    override = override_settings(MEDIA_ROOT=media)
+    override.enable()
+    test.addCleanup(override.disable)
+
+
+class ImageDerivativeTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.patient = Patient.objects.create(ptnName="Max", ptnLastname="Muster", ptnDOB="1990-01-01", usrID=self.owner)
+
+    def _upload(self, name, pil_image=None, fmt="JPEG", raw=None):
+        if raw is None:
+            out = io.BytesIO()
+            pil_image.save(out, fmt)
+            raw = out.getvalue()
+        image = Image.objects.create(ptnID=self.patient, usrID=self.owner, image=SimpleUploadedFile(name, raw))
+        jobs.run_pending()  # what `manage.py run_jobs` does
+        image.refresh_from_db()
+        return image
+
+    def _open(self, field):
+        with field.open("rb") as fp:
+            img = PILImage.open(fp)
+            img.load()
+        return img
+
+    def test_upload_builds_thumbnail_and_webp_preview(self):
+        image = self._upload("intraoral.jpg", PILImage.new("RGB", (2400, 1800), "salmon"))
+        self.assertEqual(image.derivatives_version, derivatives.DERIVATIVES_VERSION)
+        self.assertTrue(image.thumbnail.name.startswith("patient_images/intraoral"))
+        thumb, preview = self._open(image.thumbnail), self._open(image.preview)
+        self.assertEqual((thumb.format, thumb.size), ("JPEG", derivatives.THUMBNAIL_SIZE))
+        self.assertEqual((preview.format, preview.size), ("WEBP", (1600, 1200)))
+
+        self.client.force_login(self.owner)
+        page = self.client.get(f"/patient/{self.patient.id}/").content.decode()
+        self.assertIn(f'src="{image.thumbnail.url}"', page)
+        self.assertIn(f'data-original="{image.image.url}"', page)
+
+        paths = [image.image.path, image.thumbnail.path, image.preview.path]
+        image.delete()
+        self.assertTrue(all(os.path.exists(path) for path in paths))  # deferred to the queue
+        jobs.run_pending()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+    def test_sixteen_bit_xray_is_stretched_not_clipped(self):
+        # 12-bit detector values (1000..4060) in a 16-bit PNG
+        xray = PILImage.linear_gradient("L").resize((512, 512)).convert("I").point(lambda v: 1000 + v * 12)
+        image = self._upload("xray.png", xray.convert("I;16"), fmt="PNG")
+        thumb = self._open(image.thumbnail)
+        self.assertEqual(thumb.mode, "L")
+        low, high = thumb.getextrema()
+        self.assertLess(low, 8)
+        self.assertGreater(high, 247)
+
+    def test_backfill_builds_missing_derivatives_in_workers(self):
+        images = [self._upload(f"alt{i}.jpg", PILImage.new("RGB", (800, 600), "teal")) for i in range(3)]
+        for image in images:
+            image.thumbnail.delete(save=False)
+            image.preview.delete(save=False)
+        Image.objects.update(thumbnail="", preview="", derivatives_version=0)
+        broken = self._upload("kaputt.jpg", raw=b"not an image")
+        self.assertFalse(broken.thumbnail)
+        self.assertEqual(Job.objects.get(payload__image_id=broken.id).status, Job.Status.FAILED)
+
+        out = io.StringIO()
+        with self.assertRaises(CommandError):  # the unreadable file is reported
+            call_command("build_image_derivatives", workers=2, stdout=out, stderr=io.StringIO())
+        self.assertIn("Built 3 of 4", out.getvalue())
+        for image in images:
+            image.refresh_from_db()
+            self.assertEqual(self._open(image.preview).size, (800, 600))
+        self.assertEqual(derivatives.pending().count(), 1)
+
+
+class PatientDetailCacheTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        cache.clear()
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.colleague = User.objects.create_user("colleague", password="pw")
+        self.patient = Patient.objects.create(
+            ptnName="Max", ptnLastname="Muster", ptnDOB="1990-01-01", usrID=self.owner,
+            visibility=Patient.Visibility.PUBLIC_ORG,
+        )
+
+    def _page(self, user):
+        self.client.force_login(user)
+        return self.client.get(f"/patient/{self.patient.id}/", HTTP_HOST="localhost").content.decode()
+
+    def _jpeg(self):
+        out = io.BytesIO()
+        PILImage.new("RGB", (8, 8), "salmon").save(out, "JPEG")
+        return SimpleUploadedFile("scan.jpg", out.getvalue())
+
+    def test_media_comments_and_authors_refresh_the_page(self):
+        page = self._page(self.owner)
+        for empty in ("Keine Bilder vorhanden.", "Keine Videos vorhanden.", "Keine 3D-Modelle vorhanden."):
+            self.assertIn(empty, page)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image = Image.objects.create(ptnID=self.patient, usrID=self.owner, image=self._jpeg())
+        self.assertIn(f'data-original="{image.image.url}"', self._page(self.owner))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            video = Video.objects.create(
+                ptnID=self.patient, usrID=self.owner, vidDesc="", file=SimpleUploadedFile("op.mp4", b"\0" * 64),
+            )
+        self.assertIn(f'src="{video.file.url}"', self._page(self.owner))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            model = Model3D.objects.create(
+                ptnID=self.patient, usrID=self.owner,
+                file=SimpleUploadedFile("kiefer.stl", _binary_stl(_cube_triangles())),
+            )
+        self.assertIn(f'href="{model.file.url}" download', self._page(self.owner))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Comment.objects.create(patient=self.patient, author=self.colleague, content="Befund unauffällig")
+        self.assertIn("Befund unauffällig", self._page(self.owner))
+
+        # A changed author name or avatar reaches the cached comments
+        with self.captureOnCommitCallbacks(execute=True):
+            profile = Profile.objects.get(user=self.colleague)
+            profile.avatar_url = "https://i.pravatar.cc/150?img=7"
+            profile.save()
+        self.assertIn('src="https://i.pravatar.cc/150?img=7"', self._page(self.owner))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.colleague.first_name, self.colleague.last_name = "Clara", "Kollegin"
+            self.colleague.save()
+        self.assertIn("Clara Kollegin ·", self._page(self.owner))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            image.delete()
+            video.delete()
+            model.delete()
+        page = self._page(self.owner)
+        for empty in ("Keine Bilder vorhanden.", "Keine Videos vorhanden.", "Keine 3D-Modelle vorhanden."):
+            self.assertIn(empty, page)
+
+    def test_permission_classes_get_their_own_fragments(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            image = Image.objects.create(ptnID=self.patient, usrID=self.owner, image=self._jpeg())
+        delete_link = f'href="/image/{image.id}/delete/"'
+
+        self.assertIn(delete_link, self._page(self.owner))
+        self.assertNotIn(delete_link, self._page(self.colleague))
+
+        cache.clear()
+        self.assertNotIn(delete_link, self._page(self.colleague))
+        self.assertIn(delete_link, self._page(self.owner))
+
+
+class JobQueueTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.patient = Patient.objects.create(ptnName="Max", ptnLastname="Muster", ptnDOB="1990-01-01", usrID=self.owner)
+        self.calls = []
+
+        def flaky(payload):
+            self.calls.append(payload)
+            if payload.get("permanent"):
+                raise jobs.PermanentError("kaputt")
+            raise OSError("busy")
+
+        jobs.register("test.flaky", flaky, max_attempts=3)
+        self.addCleanup(jobs.KINDS.pop, "test.flaky")
+
+    def _make_due(self):
+        Job.objects.filter(status=Job.Status.PENDING).update(run_after=timezone.now())
+
+    def test_failures_back_off_until_max_attempts(self):
+        job = jobs.enqueue("test.flaky", {})
+        waits = []
+        for _ in range(3):
+            self._make_due()
+            jobs.run_pending()
+            job.refresh_from_db()
+            waits.append((job.run_after - timezone.now()).total_seconds())
+        self.assertEqual((job.status, job.attempts, len(self.calls)), (Job.Status.FAILED, 3, 3))
+        self.assertTrue(jobs.RETRY_BASE * 0.7 < waits[0] < waits[1])  # doubled, with jitter
+        self.assertIn("OSError: busy", job.last_error)
+
+        permanent = jobs.enqueue("test.flaky", {"permanent": True})
+        jobs.run_pending()
+        permanent.refresh_from_db()
+        self.assertEqual((permanent.status, permanent.attempts), (Job.Status.FAILED, 1))
+
+    def test_claims_do_not_overlap_and_stale_locks_are_requeued(self):
+        for _ in range(5):
+            jobs.enqueue("test.flaky", {})
+        first, second = jobs.claim("a", 3), jobs.claim("b", 3)
+        self.assertEqual((len(first), len(second)), (3, 2))
+        self.assertFalse({job.pk for job in first} & {job.pk for job in second})
+        self.assertEqual(jobs.claim("c", 3), [])
+
+        self.assertEqual(jobs.requeue_stale(timezone.now() + jobs.LOCK_TIMEOUT + timedelta(seconds=1)), 5)
+        self.assertEqual(jobs.release([]), 0)
+        self._make_due()
+        self.assertEqual(len(jobs.claim("c", 10)), 5)
+
+    def test_upload_returns_before_processing_and_reports_status(self):
+        out = io.BytesIO()
+        PILImage.new("RGB", (900, 600), "navy").save(out, "JPEG")
+        self.client.force_login(self.owner)
+        self.client.post(f"/patient/{self.patient.id}/upload/", {"images": SimpleUploadedFile("scan.jpg", out.getvalue())})
+        image = Image.objects.get()
+        self.assertFalse(image.thumbnail)
+        pending = self.client.get(f"/patient/{self.patient.id}/jobs/").json()
+        self.assertEqual(pending["pending"], 1)
+        job_id = pending["jobs"][0]["id"]
+
+        call_command("run_jobs", workers=2, once=True, stdout=io.StringIO())
+        image.refresh_from_db()
+        self.assertTrue(image.thumbnail)
+        self.assertEqual(self.client.get(f"/patient/{self.patient.id}/jobs/").json()["pending"], 0)
+        self.assertEqual(self.client.get(f"/jobs/{job_id}/").json()["job"]["status"], Job.Status.DONE)
+
+        stranger = User.objects.create_user("fremd", password="pw")
+        self.patient.visibility = Patient.Visibility.PRIVATE
+        self.patient.save()
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(f"/jobs/{job_id}/").status_code, 403)
+
+    def test_video_files_are_deleted_by_the_queue(self):
+        video = Video.objects.create(ptnID=self.patient, usrID=self.owner, file=SimpleUploadedFile("op.mp4", b"\0" * 64))
+        path = video.file.path
+        self.client.force_login(self.owner)
+        self.client.post(f"/patient/{self.patient.id}/videos/delete/", {"selected_videos": [video.id]})
+        self.assertTrue(os.path.exists(path))
+        jobs.run_pending()
+        self.assertFalse(os.path.exists(path))
+        # the poster job needs ffmpeg and a real video; either way it must not be left pending
+        self.assertFalse(Job.objects.filter(status__in=(Job.Status.PENDING, Job.Status.RUNNING)).exists())
+
+
+def _cube_triangles():
+    corners = [(x, y, z) for x in (0, 10) for y in (0, 10) for z in (0, 4)]
+    faces = [(0, 1, 3, 2), (4, 6, 7, 5), (0, 4, 5, 1), (2, 3, 7, 6), (0, 2, 6, 4), (1, 5, 7, 3)]
+    return [[corners[i] for i in tri] for a, b, c, d in faces for tri in ((a, b, c), (a, c, d))]
+
+
+def _binary_stl(triangles, header=b"solid exported by a scanner"):
+    body = b"".join(struct.pack("<12fH", 0, 0, 0, *[v for vertex in tri for v in vertex], 0) for tri in triangles)
+    return header.ljust(80, b" ") + struct.pack("<I", len(triangles)) + body
+
+
+def _ascii_stl(triangles):
+    facets = "".join(
+        "facet normal 0 0 0\n outer loop\n"
+        + "".join(f"  vertex {x} {y} {z}\n" for x, y, z in tri)
+        + " endloop\nendfacet\n"
+        for tri in triangles
+    )
+    return f"solid cube\n{facets}endsolid cube\n".encode()
+
+
+class STLThumbnailTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.patient = Patient.objects.create(ptnName="Max", ptnLastname="Muster", ptnDOB="1990-01-01", usrID=self.owner)
+
+    def _upload(self, name, raw):
+        model = Model3D.objects.create(ptnID=self.patient, usrID=self.owner, file=SimpleUploadedFile(name, raw))
+        jobs.run_pending()
+        model.refresh_from_db()
+        return model
+
+    def test_binary_and_ascii_parse_to_the_same_triangles(self):
+        cube = _cube_triangles()
+        # binary headers starting with "solid" are common; the file size decides
+        binary = stl.parse(_binary_stl(cube))
+        self.assertEqual(binary.shape, (12, 3, 3))
+        self.assertEqual(stl.parse(_ascii_stl(cube)).tolist(), binary.tolist())
+        garbled = _ascii_stl(cube).replace(b"vertex 0 0 0", b"vertex 0 zero 0", 1)
+        for broken in (b"", b"not an stl at all", _binary_stl(cube)[:-10].replace(b"solid", b"xxxxx"), garbled):
+            with self.assertRaises(stl.STLError):
+                stl.parse(broken)
+
+    def test_render_keeps_the_nearest_surface(self):
+        screen = np.array([[(1, 1, z), (7, 1, z), (1, 7, z)] for z in (2.0, 1.0, 3.0)], dtype=np.float32)
+        depth, shade = stl._rasterize(screen, np.array([0.2, 0.5, 0.9], dtype=np.float32), 8, 8)
+        self.assertEqual((depth[2, 2], shade[2, 2]), (3.0, np.float32(0.9)))
+        self.assertEqual(depth[7, 7], -np.inf)
+
+        img = PILImage.open(io.BytesIO(stl.render(stl.parse(_ascii_stl(_cube_triangles())))))
+        self.assertEqual((img.format, img.size, img.mode), ("PNG", stl.THUMBNAIL_SIZE, "RGBA"))
+        self.assertEqual(img.getpixel((0, 0))[3], 0)
+        self.assertEqual(img.getpixel((160, 160))[3], 255)
+
+    def test_upload_queues_thumbnail_and_backfill_renders_the_rest(self):
+        model = self._upload("kiefer.stl", _binary_stl(_cube_triangles()))
+        self.assertTrue(model.thumbnail.name.startswith("patient_models/thumbs/kiefer"))
+        self.assertEqual(model.thumbnail_version, stl.THUMBNAIL_VERSION)
+        thumbnail = model.thumbnail.path
+        self.assertTrue(os.path.exists(thumbnail))
+
+        broken = self._upload("kaputt.stl", b"not an stl")
+        self.assertFalse(broken.thumbnail)
+        self.assertEqual(Job.objects.get(kind="model3d.thumbnail", payload__model_id=broken.id).status, Job.Status.FAILED)
+
+        Model3D.objects.filter(pk=model.pk).update(thumbnail="", thumbnail_version=0)
+        out = io.StringIO()
+        with self.assertRaisesMessage(CommandError, "1 model(s) could not be read"):
+            call_command("build_model_thumbnails", workers=1, stdout=out, stderr=io.StringIO())
+        self.assertIn("Rendered 1 of 2", out.getvalue())
+        model.refresh_from_db()
+        self.assertTrue(model.thumbnail)
+
+        model.delete()
+        jobs.run_pending()
+        self.assertFalse(os.path.exists(model.thumbnail.path))
+        self.assertFalse(os.path.exists(model.file.path))
+
+
+def _sphere_triangles(rings=64, segments=128, radius=10.0):
+    polar = np.linspace(0, np.pi, rings + 1)[:, None]
+    azimuth = np.linspace(0, 2 * np.pi, segments + 1)[None, :]
+    grid = np.stack(np.broadcast_arrays(
+        radius * np.sin(polar) * np.cos(azimuth), radius * np.sin(polar) * np.sin(azimuth), radius * np.cos(polar),
+    ), axis=-1).astype(np.float32)
+    a, b, c, d = grid[:-1, :-1], grid[1:, :-1], grid[1:, 1:], grid[:-1, 1:]
+    return np.concatenate([np.stack([a, b, c], axis=-2), np.stack([a, c, d], axis=-2)]).reshape(-1, 3, 3)
+
+
+class LevelOfDetailTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.patient = Patient.objects.create(ptnName="Max", ptnLastname="Muster", ptnDOB="1990-01-01", usrID=self.owner)
+
+    def test_levels_are_decimated_quantized_and_round_trip(self):
+        sphere = _sphere_triangles()
+        levels = lod.build(sphere)
+        # 5% would be below MIN_TRIANGLES for this mesh
+        self.assertEqual([ratio for ratio, *_ in levels], [0.25, 1.0])
+        (_, coarse, _, coarse_faces), (_, full, full_vertices, full_faces) = levels
+        self.assertLess(abs(coarse_faces - 0.25 * len(sphere)), 0.25 * len(sphere) * 0.5)
+        self.assertLess(len(full), len(_binary_stl(sphere.tolist())) / 2)
+
+        vertices, faces = lod.decode(full)
+        self.assertEqual((len(vertices), len(faces)), (full_vertices, full_faces))
+        # the poles and the seam are welded; the degenerate pole triangles are gone
+        self.assertEqual(full_vertices, 63 * 128 + 2)
+        step = 20.0 / lod.QUANT_MAX
+        self.assertTrue(np.allclose(np.linalg.norm(vertices, axis=1), 10.0, atol=step))
+        vertices, faces = lod.decode(coarse)
+        self.assertEqual(faces.dtype.itemsize, 2)
+        self.assertLess(faces.max(), len(vertices))
+        self.assertTrue(np.allclose(np.linalg.norm(vertices, axis=1), 10.0, atol=0.5))
+        self.assertEqual(lod.build(np.array(_cube_triangles(), dtype=np.float32))[0][3], 12)
+
+    def test_upload_builds_levels_and_manifest_lists_them_coarse_first(self):
+        model = Model3D.objects.create(
+            ptnID=self.patient, usrID=self.owner, file=SimpleUploadedFile("kiefer.stl", _binary_stl(_sphere_triangles(128, 256))),
+        )
+        self.client.force_login(self.owner)
+        pending = self.client.get(f"/model/{model.id}/manifest/").json()
+        self.assertEqual((pending["pending"], pending["levels"]), (True, []))
+
+        jobs.run_pending()
+        manifest = self.client.get(f"/model/{model.id}/manifest/").json()
+        self.assertFalse(manifest["pending"])
+        self.assertEqual([level["ratio"] for level in manifest["levels"]], [0.05, 0.25, 1.0])
+        self.assertEqual(manifest["original"]["bytes"], 84 + 50 * 128 * 256 * 2)
+        self.assertTrue(all(level["url"].startswith("/media/patient_models/kiefer_lod") for level in manifest["levels"]))
+        sizes = [level["bytes"] for level in manifest["levels"]]
+        self.assertEqual(sizes, sorted(sizes))
+
+        stranger = User.objects.create_user("fremd", password="pw")
+        self.patient.visibility = Patient.Visibility.PRIVATE
+        self.patient.save()
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(f"/model/{model.id}/manifest/").status_code, 403)
+
+        model.refresh_from_db()
+        paths = [model.file.storage.path(level["name"]) for level in model.lods]
+        self.assertTrue(all(os.path.exists(path) for path in paths))
+        model.delete()
+        jobs.run_pending()
+        self.assertFalse(any(os.path.exists(path) for path in paths))
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        use_temporary_media(self)
+        partial = tempfile.mkdtemp(prefix="smilehealth_uploads_")
+        self.addCleanup(shutil.rmtree, partial, ignore_errors=True)
+        override = override_settings(CHUNKED_UPLOAD_DIR=partial)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.owner = User.objects.create_user("owner", password="pw")
+        self.patient = Patient.objects.create(ptnName="Max", ptnLastname="Muster", ptnDOB="1990-01-01", usrID=self.owner)
+        self.client.force_login(self.owner)
+
+    def _start(self, filename, data, content_type=""):
+        res = self.client.post(
+            f"/patient/{self.patient.id}/uploads/", {"filename": filename, "size": len(data), "content_type": content_type},
+        )
+        self.assertEqual(res.status_code, 201, res.content)
+        # small chunks keep the test fast; the client follows whatever chunk_size says
+        UploadSession.objects.filter(pk=res.json()["id"]).update(chunk_size=1000)
+        return f"/uploads/{res.json()['id']}/"
+
+    def _put(self, url, offset, chunk, crc=None):
+        crc = zlib.crc32(chunk) if crc is None else crc
+        return self.client.put(
+            f"{url}?offset={offset}", chunk, content_type="application/octet-stream",
+            headers={"X-Upload-CRC32": f"{crc:08x}"},
+        )
+
+    def test_chunks_resume_and_assemble_into_a_video(self):
+        data = os.urandom(2500)
+        url = self._start("../op video.mp4", data, "video/mp4")
+        session = UploadSession.objects.get()
+        self.assertEqual((session.kind, session.filename), (UploadSession.Kind.VIDEO, "op video.mp4"))
+
+        self.assertEqual(self._put(url, 0, data[:1000]).json()["offset"], 1000)
+        repeated = self._put(url, 0, data[:1000])
+        self.assertEqual((repeated.status_code, repeated.json()["offset"]), (409, 1000))
+        damaged = self._put(url, 1000, data[1000:2000], crc=zlib.crc32(b"other"))
+        self.assertEqual((damaged.status_code, damaged.json()["offset"]), (422, 1000))
+        self.assertEqual(self._put(url, 1000, data[1000:1999]).status_code, 400)  # chunks are fixed-size
+        self.assertEqual(self.client.get(url).json()["offset"], 1000)  # where a reload resumes
+
+        self.assertEqual(self._put(url, 1000, data[1000:2000]).status_code, 200)
+        early = self.client.post(f"{url}complete/", {"crc32": f"{zlib.crc32(data):08x}"})
+        self.assertEqual(early.status_code, 409)
+        self.assertEqual(self._put(url, 2000, data[2000:]).json()["offset"], 2500)
+
+        wrong = self.client.post(f"{url}complete/", {"crc32": f"{zlib.crc32(data[::-1]):08x}"})
+        self.assertEqual(wrong.status_code, 422)
+        with self.captureOnCommitCallbacks(execute=True):
+            done = self.client.post(f"{url}complete/", {"crc32": f"{zlib.crc32(data):08x}"}).json()
+        video = Video.objects.get()
+        self.assertEqual((done["status"], done["result_id"]), (UploadSession.Status.COMPLETE, video.id))
+        with video.file.open("rb") as fp:
+            self.assertEqual(fp.read(), data)
+        self.assertFalse(os.path.exists(uploads.partial_path(session)))  # moved, not copied
+        self.assertTrue(Job.objects.filter(kind="video.poster", payload__video_id=video.id).exists())
+
+        again = self.client.post(f"{url}complete/", {"crc32": f"{zlib.crc32(data):08x}"}).json()
+        self.assertEqual((again["result_id"], Video.objects.count()), (video.id, 1))
+
+    def test_stl_sessions_are_personal_and_expire(self):
+        self.assertEqual(
+            self.client.post(f"/patient/{self.patient.id}/uploads/", {"filename": "notes.txt", "size": 10}).status_code, 400,
+        )
+        data = _binary_stl(_cube_triangles())
+        url = self._start("kiefer.stl", data)
+        self._put(url, 0, data[:1000])
+
+        stranger = User.objects.create_user("fremd", password="pw")
+        self.client.force_login(stranger)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self._put(url, 1000, data[1000:]).status_code, 403)
+        self.assertEqual(
+            self.client.post(f"/patient/{self.patient.id}/uploads/", {"filename": "b.stl", "size": 10}).status_code, 403,
+        )
+
+        self.client.force_login(self.owner)
+        self.assertEqual(self._put(url, 1000, data[1000:]).json()["offset"], len(data))
+        missing = self.client.post(f"{url}complete/")
+        self.assertEqual((missing.status_code, missing.json()["offset"]), (400, len(data)))
+        self.assertFalse(Model3D.objects.exists())
+        self.client.post(f"{url}complete/", {"crc32": f"{zlib.crc32(data):08x}"})
+        self.assertEqual(Model3D.objects.get().file.size, len(data))
+
+        stale = UploadSession.objects.get(pk=self._start("zweites.stl", data).split("/")[2])
+        UploadSession.objects.filter(pk=stale.pk).update(updated_at=timezone.now() - uploads.SESSION_TTL)
+        self.assertTrue(os.path.exists(uploads.partial_path(stale)))
+        self.assertEqual(uploads.expire(), 1)
+        self.assertFalse(os.path.exists(uploads.partial_path(stale)))
+        self.assertEqual(UploadSession.objects.count(), 1)  # the completed one is not stale yet
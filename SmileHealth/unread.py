@@ -0,0 +1,72 @@
+# SmileHealth/unread.py
+"""
+Per-user unread message counters, pushed to the browser over ws/notify/.
+
+count() reads a cached counter and only runs the COUNT query on a miss.
+adjust() is called when messages are created or marked read: once the
+transaction commits it adds the delta to the counter and sends the new value
+to the user's notify group (NotifyConsumer).
+
+The cached value is (count, expires_at). Adjusting it is a get and a set,
+not atomic between processes, so concurrent updates can be lost. Every set
+keeps the expiry the count was made with, so the counter is recounted at
+most UNREAD_TTL after the COUNT query however busy the chat is. That bounds
+how long a lost update stays visible. cache.incr() would not do this: on
+the file cache it is also a get and a set, and it resets the timeout to
+the backend default.
+"""
+import time
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.db import transaction
+
+from .cache import counter_key, model_namespace
+from .models import Message
+
+UNREAD_TTL = 5 * 60
+
+
+def notify_group(user_id):
+    return f"notify_{user_id}"
+
+
+def _key(user_id):
+    return counter_key(model_namespace(Message, "unread"), user_id)
+
+
+def count(user_id):
+    key = _key(user_id)
+    cached = cache.get(key)
+    if cached is not None:
+        return max(cached[0], 0)
+    value = Message.objects.filter(receiver_id=user_id, is_read=False).count()
+    cache.add(key, (value, time.time() + UNREAD_TTL), UNREAD_TTL)
+    return max(value, 0)
+
+
+def adjust(user_id, delta):
+    if user_id and delta:
+        transaction.on_commit(lambda: _apply(user_id, delta))
+
+
+def _apply(user_id, delta):
+    key = _key(user_id)
+    cached = cache.get(key)
+    value = None  # not cached: no COUNT on the write path, the client applies the delta
+    if cached is not None:
+        value, expires_at = cached[0] + delta, cached[1]
+        remaining = expires_at - time.time()
+        if remaining > 0:
+            cache.set(key, (value, expires_at), remaining)
+        value = max(value, 0)
+    push(user_id, value, delta)
+
+
+def push(user_id, value, delta=0):
+    layer = get_channel_layer()
+    if layer is not None:
+        async_to_sync(layer.group_send)(
+            notify_group(user_id), {"type": "unread.count", "count": value, "delta": delta},
+        )
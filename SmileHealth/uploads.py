@@ -0,0 +1,196 @@
+# SmileHealth/uploads.py
+"""
+Chunked, resumable uploads for videos and STL files. A dropped connection
+no longer restarts a 2 GB upload from zero, and no request carries more
+than one chunk.
+
+Protocol (views.upload_session_start / upload_session / upload_session_complete);
+every JSON answer carries `offset`, the number of acknowledged bytes:
+
+1. POST /patient/<id>/uploads/ with filename, size and content_type
+   creates an UploadSession. The answer holds its id and chunk_size.
+2. PUT /uploads/<id>/?offset=<n> sends one chunk. The raw chunk bytes are
+   the body, and X-Upload-CRC32 carries the chunk's CRC-32 in hex. Every
+   chunk but the last is exactly chunk_size long. The body goes to the
+   partial file in BLOCK_SIZE blocks. The offset only advances once the
+   length and CRC match. A chunk for any other offset gets a 409 with the
+   offset to continue from.
+3. GET /uploads/<id>/ returns the acknowledged offset, to resume after a
+   dropped connection or a page reload.
+4. POST /uploads/<id>/complete/ with the whole file's crc32 compares it
+   with the CRC the session kept over all chunks. It then moves the
+   partial file into storage and creates the Video or Model3D row, which
+   queues the usual poster or thumbnail jobs. Repeating it returns the
+   same row.
+
+The checksum is CRC-32, not SHA-256, for two reasons. Browsers offer
+SubtleCrypto only over HTTPS, and it cannot hash incrementally.
+zlib.crc32 can be continued from the stored value, so the whole file is
+verified without reading it again.
+
+Under ASGI, Django spools a request body before the view runs, in memory
+up to FILE_UPLOAD_MAX_MEMORY_SIZE. CHUNK_SIZE stays below that limit.
+
+expire() removes sessions untouched for SESSION_TTL, together with their
+partial files. `manage.py run_jobs` calls it on its maintenance sweep.
+"""
+import os
+import zlib
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .models import Model3D, UploadSession, Video
+
+CHUNK_SIZE = 8 * 1024 * 1024
+BLOCK_SIZE = 256 * 1024
+SESSION_TTL = timedelta(hours=24)
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".m4v", ".webm", ".avi", ".mkv")
+
+
+class UploadError(Exception):
+    """Refused upload step; `status` is the HTTP status for the client."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class _PartialFile(File):
+    # FileSystemStorage moves files that have a temporary path instead of copying them
+    def temporary_file_path(self):
+        return self.file.name
+
+
+def kind_for(filename, content_type=""):
+    name, ctype = filename.lower(), (content_type or "").lower()
+    if name.endswith(".stl") or "model/stl" in ctype or "application/sla" in ctype:
+        return UploadSession.Kind.MODEL3D
+    if ctype.startswith("video/") or name.endswith(VIDEO_EXTENSIONS):
+        return UploadSession.Kind.VIDEO
+    return None
+
+
+def partial_path(session):
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{session.pk}.part")
+
+
+def remove_partial(session):
+    try:
+        os.remove(partial_path(session))
+    except FileNotFoundError:
+        pass
+
+
+def start(user, patient, filename, size, content_type=""):
+    filename = os.path.basename((filename or "").replace("\\", "/")).strip()[:255]
+    kind = kind_for(filename, content_type)
+    if not filename or kind is None:
+        raise UploadError("Nur Videos und STL-Dateien können in Teilen hochgeladen werden.")
+    if size <= 0:
+        raise UploadError("Ungültige Dateigröße.")
+    if size > settings.CHUNKED_UPLOAD_MAX_SIZE:
+        raise UploadError("Datei ist zu groß.", status=413)
+
+    session = UploadSession(
+        user=user, patient=patient, kind=kind, filename=filename, size=size, chunk_size=CHUNK_SIZE,
+    )
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    open(partial_path(session), "wb").close()
+    session.save()
+    return session
+
+
+def write_chunk(session, offset, stream, length, crc):
+    """Stream one chunk from `stream` into the partial file and acknowledge it."""
+    if session.status != UploadSession.Status.OPEN:
+        raise UploadError("Upload ist bereits abgeschlossen.", status=409)
+    if offset != session.received or offset >= session.size:
+        raise UploadError("Falscher Offset.", status=409)
+    if length != min(session.chunk_size, session.size - offset):
+        raise UploadError("Falsche Blockgröße.")
+
+    chunk_crc, running, written = 0, session.crc32, 0
+    try:
+        # No truncation: bytes a failed attempt left behind are overwritten by
+        # the retry, and complete() cuts the file to its size
+        with open(partial_path(session), "r+b") as fp:
+            fp.seek(offset)
+            while written < length:
+                block = stream.read(min(BLOCK_SIZE, length - written))
+                if not block:
+                    break
+                fp.write(block)
+                chunk_crc = zlib.crc32(block, chunk_crc)
+                running = zlib.crc32(block, running)
+                written += len(block)
+    except FileNotFoundError:
+        raise UploadError("Upload ist abgelaufen.", status=410)
+    if written != length:
+        raise UploadError("Block unvollständig.")
+    if chunk_crc != crc:
+        raise UploadError("Prüfsumme des Blocks stimmt nicht.", status=422)
+
+    # Conditional on the offset: of two attempts at the same chunk only one counts
+    acknowledged = UploadSession.objects.filter(
+        pk=session.pk, status=UploadSession.Status.OPEN, received=offset,
+    ).update(received=offset + length, crc32=running, updated_at=timezone.now())
+    if not acknowledged:
+        session.refresh_from_db()
+        raise UploadError("Block wurde bereits geschrieben.", status=409)
+    session.received, session.crc32 = offset + length, running
+
+
+def complete(session, crc):
+    """Create the Video / Model3D from the finished upload; `crc` is the whole file's CRC-32."""
+    model = Video if session.kind == UploadSession.Kind.VIDEO else Model3D
+    if session.status == UploadSession.Status.COMPLETE:
+        return model.objects.get(pk=session.result_id)
+    if session.received != session.size:
+        raise UploadError("Upload ist unvollständig.", status=409)
+    if crc != session.crc32:
+        raise UploadError("Prüfsumme der Datei stimmt nicht.", status=422)
+
+    path = partial_path(session)
+    with transaction.atomic():
+        if not UploadSession.objects.filter(pk=session.pk, status=UploadSession.Status.OPEN).update(
+            status=UploadSession.Status.COMPLETE,
+        ):
+            # completed meanwhile by a repeated request
+            session.refresh_from_db()
+            return model.objects.get(pk=session.result_id)
+        try:
+            with open(path, "r+b") as fp:
+                fp.truncate(session.size)
+                upload = _PartialFile(fp, name=session.filename)
+                fields = {"ptnID": session.patient, "usrID": session.user, "file": upload}
+                if model is Video:
+                    fields["vidDesc"] = ""
+                obj = model.objects.create(**fields)
+        except FileNotFoundError:
+            raise UploadError("Upload ist abgelaufen.", status=410)
+        UploadSession.objects.filter(pk=session.pk).update(result_id=obj.pk)
+    session.status, session.result_id = UploadSession.Status.COMPLETE, obj.pk
+    return obj
+
+
+def expire(now=None):
+    """Delete sessions untouched for SESSION_TTL; their partial files go with them (signals.py)."""
+    now = now or timezone.now()
+    return UploadSession.objects.filter(updated_at__lt=now - SESSION_TTL).delete()[0]
+
+
+def status(session):
+    return {
+        "id": str(session.pk),
+        "filename": session.filename,
+        "kind": session.kind,
+        "size": session.size,
+        "chunk_size": session.chunk_size,
+        "offset": session.received,
+        "status": session.status,
+        "result_id": session.result_id,
+    }
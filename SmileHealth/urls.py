@@ -7,12 +7,14 @@ urlpatterns = [
     path('', views.login, name='login'),       # login page
     path('logout/', views.logout_view, name='logout'),
     path('index/', views.index, name='index'),  # main page
+    path('index/patients/', views.patient_page, name='patient_page'),  # infinite scroll / search
 
     # NEW: progress page after login
     path('progress/', views.progress, name='progress'),
 
     # Admin dashboard
     path('admin-dashboard/', views.admin_dashboard, name='admin_dashboard'),
+    path('admin-dashboard/cache-stats/', views.admin_cache_stats, name='admin_cache_stats'),
 
     # Case groups
     path('group/create/', views.group_create, name='group_create'),
@@ -53,13 +55,29 @@ urlpatterns = [
     path('patient/<int:patient_id>/upload_models/', views.upload_models, name='upload_models'),
     path('patient/<int:patient_id>/delete_models/', views.delete_models, name='delete_models'),
     path('model/<int:model_id>/delete/', views.delete_single_model, name='delete_single_model'),
+    path('model/<int:model_id>/manifest/', views.model_manifest, name='model_manifest'),
+
+    # Chunked, resumable uploads for videos and STL files
+    path('patient/<int:patient_id>/uploads/', views.upload_session_start, name='upload_session_start'),
+    path('uploads/<uuid:session_id>/', views.upload_session, name='upload_session'),
+    path('uploads/<uuid:session_id>/complete/', views.upload_session_complete, name='upload_session_complete'),
+
+    # Background media jobs (thumbnails, posters, file deletion)
+    path('jobs/<int:job_id>/', views.job_status, name='job_status'),
+    path('patient/<int:patient_id>/jobs/', views.patient_jobs, name='patient_jobs'),
 
     # Feedback routes
     path('feedback/send/', views.send_feedback, name='send_feedback'),
 
+    # User directory (chat list / share pickers)
+    path('users/search/', views.user_search, name='user_search'),
+
     # Chat notifications
     path('messages/unread-count/', views.get_unread_message_count, name='unread_message_count'),
 
+    # Full-text search over chat messages and patient comments
+    path('search/', views.full_text_search, name='search'),
+
 
 ]
 if settings.DEBUG:
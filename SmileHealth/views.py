@@ -1,23 +1,34 @@
 from django.http import JsonResponse, HttpResponseForbidden
 from django.shortcuts import render, redirect, get_object_or_404
+from django.template.loader import render_to_string
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import authenticate, login as auth_login, logout, update_session_auth_hash
 from django.contrib import messages
 from django.contrib.auth.models import User
-from django.views.decorators.http import require_POST
-from django.db.models import Q
+from django.views.decorators.http import require_http_methods, require_POST
+from django.db.models import Q, Count, Exists, OuterRef, Value
+from django.db.models.functions import Lower
+from django.core.cache import cache, caches
 from django.core.exceptions import ValidationError
+from django.db import transaction
 from django.core.mail import EmailMessage
 from django.conf import settings
 from django.urls import reverse
 from django.utils.timesince import timesince
-import os, uuid, time, threading
+import os, uuid
 from django.core.files.storage import default_storage
 
 
 from .models import (
-    Patient, Image, Message, Profile, Video, Comment, Model3D, ActivityLog, CaseGroup
+    Patient, Image, Message, Profile, Video, Comment, Model3D, ActivityLog, CaseGroup, Job, UploadSession
 )
+from .access import AccessEvaluator, is_admin
+from .cards import CARD_FIELDS, build_patient_cards
+from .directory import users_except, search as search_users
+from .middleware import get_profile
+from .cache import GROUPS_ALL_SCOPE, get_version, groups_scope, model_namespace, patient_scope, stats as cache_stats, versioned_key
+from .visibility import cache_scopes
+from . import conversations, group_chat, jobs, lod, search, unread, uploads
 
 # ---------- Auth & Progress ----------
 
@@ -56,42 +67,13 @@ def logout_view(request):
 
 # ---------- Access Helpers ----------
 
-def _is_admin(user):
-    return user.is_superuser or user.is_staff
-
 def _is_admin_role(user):
     if not user.is_authenticated:
         return False
     if user.is_superuser:
         return True
-    try:
-        return user.profile.role == Profile.Role.ADMIN
-    except Exception:
-        return False
-
-
-def _can_view_group(user, group):
-    if not user.is_authenticated:
-        return False
-    if _is_admin(user):
-        return True
-    if group.created_by_id == user.id:
-        return True
-    if group.visibility == CaseGroup.Visibility.SHARED and group.shared_with.filter(id=user.id).exists():
-        return True
-    return False
-
-
-def _can_manage_group(user, group):
-    return _is_admin(user) or group.created_by_id == user.id
-
-
-def _can_create_in_group(user, group):
-    if _is_admin(user) or group.created_by_id == user.id:
-        return True
-    if group.visibility == CaseGroup.Visibility.SHARED and group.shared_with.filter(id=user.id).exists():
-        return True
-    return False
+    profile = get_profile(user)
+    return profile is not None and profile.role == Profile.Role.ADMIN
 
 
 def _default_avatar_for_gender(gender):
@@ -101,71 +83,17 @@ def _default_avatar_for_gender(gender):
         return "https://randomuser.me/api/portraits/men/1.jpg"
     return "https://i.pravatar.cc/150?img=1"
 
-def _can_view_patient(user, patient):
-    if not user.is_authenticated:
-        return False
-    if _is_admin(user):
-        return True
-    if patient.group_id:
-        return _can_view_group(user, patient.group)
-    if patient.usrID_id == user.id:
-        return True
-    if patient.visibility == Patient.Visibility.PUBLIC_ORG:
-        return True
-    if patient.visibility == Patient.Visibility.SHARED and patient.shared_with.filter(id=user.id).exists():
-        return True
-    return False
-
-
-def _can_edit_patient(user, patient):
-    return _is_admin(user) or (patient.usrID_id == user.id)
-
-def _can_access_patient(user, patient):
-    return _can_view_patient(user, patient)
-
-
-def _safe_delete_file(path, attempts=20, delay=0.5):
-    """Delete a file on disk with retries; tries rename first to break Windows locks."""
-    if not path:
-        return
-    base_dir = os.path.dirname(path) or '.'
-    for i in range(max(1, attempts)):
-        try:
-            if os.path.exists(path):
-                # try rename to temp name to release lock
-                tmp_name = os.path.join(base_dir, f".__del_{uuid.uuid4().hex}")
-                try:
-                    os.replace(path, tmp_name)
-                    path = tmp_name
-                except PermissionError:
-                    pass
-                if os.path.exists(path):
-                    os.remove(path)
-            return
-        except PermissionError:
-            if i == attempts - 1:
-                raise
-            time.sleep(delay)
-
 
 # ---------- Main Pages ----------
 
-@login_required
-def index(request):
-    users = User.objects.exclude(id=request.user.id)
-    avatar = Profile.objects.filter(user=request.user).first()
+PATIENT_PAGE_SIZE = 48
 
-    unread_count = Message.objects.filter(receiver=request.user, is_read=False).count()
-    last_notified = request.session.get("unread_notice_count", 0)
-    if unread_count > 0 and unread_count != last_notified:
-        messages.info(request, f"Sie haben {unread_count} ungelesene Nachricht(en).")
-        request.session["unread_notice_count"] = unread_count
 
+def _scoped_patients(request):
+    """Return (scope, base_non_group, patients) for the index grid filters."""
     scope = request.GET.get('scope', 'all')
 
-    base_qs = Patient.objects.visible_to(request.user) \
-        .select_related('usrID') \
-        .prefetch_related('shared_with')
+    base_qs = Patient.objects.visible_to(request.user)
 
     owner = request.GET.get('owner')
     if owner and request.user.is_staff:
@@ -176,42 +104,139 @@ def index(request):
     if scope == 'mine':
         patients = base_non_group.filter(usrID=request.user)
     elif scope == 'shared':
-        patients = base_non_group.filter(shared_with=request.user) \
+        patients = base_non_group.filter(_shared_with_me(request.user)) \
                                  .exclude(usrID=request.user) \
-                                 .exclude(visibility=Patient.Visibility.PUBLIC_ORG) \
-                                 .distinct()
+                                 .exclude(visibility=Patient.Visibility.PUBLIC_ORG)
     else:
         patients = base_non_group
 
-    counts = {
-        'all': base_non_group.count(),
-        'mine': base_non_group.filter(usrID=request.user).count(),
-        'shared': base_non_group.filter(shared_with=request.user)
-                         .exclude(usrID=request.user)
-                         .exclude(visibility=Patient.Visibility.PUBLIC_ORG)
-                         .distinct()
-                         .count(),
-    }
-
-    if _is_admin(request.user):
-        groups = CaseGroup.objects.all()
-    else:
-        groups = CaseGroup.objects.filter(
-            Q(created_by=request.user)
-            | (Q(visibility=CaseGroup.Visibility.SHARED) & Q(shared_with=request.user))
-        ).distinct()
+    # Name search: every word must prefix-match first or last name
+    terms = (request.GET.get('q') or '').split()
+    if terms:
+        patients = patients.alias(lastname_key=Lower('ptnLastname'), name_key=Lower('ptnName'))
+    for term in terms:
+        patients = patients.filter(_name_prefix('lastname_key', term) | _name_prefix('name_key', term))
+
+    return scope, base_non_group, patients
+
+
+def _name_prefix(key, term):
+    """
+    Case-insensitive prefix match as a range on Lower(<name>), which the
+    patient_*_lower_idx expression indexes serve (istartswith compiles to
+    LIKE, which scans). The term goes through the database's LOWER() too,
+    so both sides are folded alike. Under binary collation every string
+    starting with the term sorts between it and term + U+10FFFF.
+    """
+    return Q(**{f'{key}__gte': Lower(Value(term)), f'{key}__lt': Lower(Value(term + '\U0010ffff'))})
+
+
+def _shared_with_me(user):
+    # Exists() instead of a shared_with join: no row fan-out, so no DISTINCT needed
+    return Q(Exists(Patient.shared_with.through.objects.filter(
+        patient_id=OuterRef('pk'), user_id=user.id,
+    )))
+
+
+def _patient_page(request, patients, before=None, size=PATIENT_PAGE_SIZE):
+    """
+    Keyset (seek) pagination on -id: returns (cards, next_cursor).
+    `before` is the last id of the previous page; next_cursor is None on the last page.
+    """
+    qs = patients.order_by('-id')
+    if before:
+        qs = qs.filter(id__lt=before)
+    rows = list(qs.values(*CARD_FIELDS)[:size + 1])
+    next_cursor = None
+    if len(rows) > size:
+        rows = rows[:size]
+        next_cursor = rows[-1]['id']
+    return build_patient_cards(rows, request.user), next_cursor
+
+
+SCOPE_COUNTS_TTL = 10 * 60
+
+
+def _scope_counts(request, base_non_group):
+    """
+    'all' / 'mine' / 'shared' badge counts in a single aggregate query, cached
+    per user until a visibility change affecting that user bumps its version.
+    """
+    user = request.user
+    owner = request.GET.get('owner') if user.is_staff else ''
+    key = versioned_key(model_namespace(Patient, 'scope_counts'), user.id, owner or '-', scopes=cache_scopes(user))
+    counts = cache.get(key)
+    if counts is None:
+        counts = base_non_group.aggregate(
+            all=Count('id'),
+            mine=Count('id', filter=Q(usrID=user)),
+            shared=Count('id', filter=_shared_with_me(user)
+                         & ~Q(usrID=user)
+                         & ~Q(visibility=Patient.Visibility.PUBLIC_ORG)),
+        )
+        cache.set(key, counts, SCOPE_COUNTS_TTL)
+    return counts
+
+
+GROUPS_TTL = 10 * 60
+
+
+def _visible_groups(user):
+    """
+    CaseGroup.objects.visible_to(user) as a list, cached per user (one entry
+    shared by all admins) until a change to one of the user's groups bumps
+    groups_scope(user.id), or any group change bumps GROUPS_ALL_SCOPE for admins.
+    """
+    admin = is_admin(user)
+    key = versioned_key(model_namespace(CaseGroup, 'visible'), 'all' if admin else user.id,
+                        scopes=(GROUPS_ALL_SCOPE if admin else groups_scope(user.id),))
+    groups = cache.get(key)
+    if groups is None:
+        groups = list(CaseGroup.objects.visible_to(user))
+        cache.set(key, groups, GROUPS_TTL)
+    return groups
+
+
+def _cursor_param(request):
+    value = request.GET.get('before') or ''
+    return int(value) if value.isdigit() else None
+
+
+@login_required
+def index(request):
+    unread_count = unread.count(request.user.id)
+    last_notified = request.session.get("unread_notice_count", 0)
+    if unread_count > 0 and unread_count != last_notified:
+        messages.info(request, f"Sie haben {unread_count} ungelesene Nachricht(en).")
+        request.session["unread_notice_count"] = unread_count
+
+    scope, base_non_group, patients = _scoped_patients(request)
+    cards, next_cursor = _patient_page(request, patients)
+
+    counts = _scope_counts(request, base_non_group)
 
     return render(request, 'index.html', {
-        'users': users,
-        'patients': patients,
-        'groups': groups,
-        'avatar': avatar,
+        'owner_choices': users_except(request.user.id) if request.user.is_staff else [],
+        'cards': cards,
+        'next_cursor': next_cursor,
+        'q': request.GET.get('q', ''),
+        'groups': _visible_groups(request.user),
+        'chat_rooms': group_chat.rooms(request.user.id),
         'scope': scope,
         'counts': counts,
         'unread_count': unread_count,
     })
 
 
+@login_required
+def patient_page(request):
+    """Next page of patient cards for the index grid (infinite scroll and search)."""
+    _, _, patients = _scoped_patients(request)
+    cards, next_cursor = _patient_page(request, patients, before=_cursor_param(request))
+    html = render_to_string('partials/patient_cards.html', {'cards': cards}, request=request)
+    return JsonResponse({'ok': True, 'html': html, 'count': len(cards), 'next_cursor': next_cursor})
+
+
 @login_required
 def group_create(request):
     if request.method != "POST":
@@ -255,14 +280,15 @@ def group_create(request):
 
 @login_required
 def group_detail(request, group_id):
-    group = get_object_or_404(CaseGroup, id=group_id)
-    if not _can_view_group(request.user, group):
+    group = get_object_or_404(CaseGroup.objects.select_related("created_by"), id=group_id)
+    if not any(g.id == group.id for g in _visible_groups(request.user)):
         return HttpResponseForbidden("Kein Zugriff")
+    access = AccessEvaluator(request.user, groups=[group])
 
     if request.method == "POST":
         form_type = request.POST.get("form")
 
-        if form_type in {"update_group", "share_group"} and not _can_manage_group(request.user, group):
+        if form_type in {"update_group", "share_group"} and not access.can_manage_group(group):
             messages.error(request, "Nur Eigentümer oder Admin dürfen diese Gruppe verwalten.")
             return redirect('group_detail', group_id=group.id)
 
@@ -319,13 +345,29 @@ def group_detail(request, group_id):
     return render(request, "group_detail.html", {
         "group": group,
         "cases": cases,
-        "can_manage": _can_manage_group(request.user, group),
-        "users": User.objects.exclude(id=request.user.id),
+        "can_manage": access.can_manage_group(group),
+        "users": users_except(request.user.id),
+        "shared_ids": set(group.shared_with.values_list("id", flat=True)),
         "groups": [group],
         "group_activities": group_activities,
     })
 
 
+@login_required
+def admin_cache_stats(request):
+    """Cache hit/miss counters of the worker process serving this request."""
+    if not _is_admin_role(request.user):
+        return HttpResponseForbidden("Kein Zugriff")
+    backend = caches['default'].__class__
+    return JsonResponse({
+        'ok': True,
+        'backend': f"{backend.__module__}.{backend.__name__}",
+        'pid': os.getpid(),
+        'local_bytes': getattr(cache, 'local_size', None),
+        'namespaces': cache_stats(),
+    })
+
+
 @login_required
 def admin_dashboard(request):
     if not _is_admin_role(request.user):
@@ -488,12 +530,12 @@ def admin_dashboard(request):
 @login_required
 def patient_manage(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    users = User.objects.exclude(id=request.user.id)
+    access = AccessEvaluator(request.user, patients=[patient])
 
     if request.method == "POST":
         form_type = request.POST.get("form")
 
-        if not _can_edit_patient(request.user, patient):
+        if not access.can_edit_patient(patient):
             messages.error(request, "Nur Eigentümer oder Manager/Admin dürfen diesen Patienten bearbeiten oder teilen.")
             return redirect('patient_manage', patient_id=patient.id)
 
@@ -583,22 +625,16 @@ def patient_manage(request, patient_id):
 
     return render(request, 'patient_manage.html', {
         'patient': patient,
-        'users': users,
-        'can_edit': _can_edit_patient(request.user, patient),
+        'users': users_except(request.user.id),
+        'shared_ids': set(patient.shared_with.values_list('id', flat=True)),
+        'can_edit': access.can_edit_patient(patient),
     })
 
 # ---------- Misc Pages ----------
 
 @login_required
 def load_new_fall(request):
-    if _is_admin(request.user):
-        groups = CaseGroup.objects.all()
-    else:
-        groups = CaseGroup.objects.filter(
-            Q(created_by=request.user)
-            | (Q(visibility=CaseGroup.Visibility.SHARED) & Q(shared_with=request.user))
-        ).distinct()
-    return render(request, 'newFall.html', {"groups": groups})
+    return render(request, 'newFall.html', {"groups": _visible_groups(request.user)})
 
 @login_required
 def patient_list(request):
@@ -616,7 +652,7 @@ def add_patient(request):
         group = None
         if group_id and str(group_id).isdigit():
             group = CaseGroup.objects.filter(id=int(group_id)).first()
-            if not group or not _can_create_in_group(request.user, group):
+            if not group or not AccessEvaluator(request.user, groups=[group]).can_create_in_group(group):
                 messages.error(request, "Keine Berechtigung fuer diese Gruppe.")
                 return redirect('index')
 
@@ -646,32 +682,68 @@ def add_patient(request):
 
 # ---------- Patient Detail & Comments ----------
 
+PATIENT_DETAIL_TTL = 60 * 60
+
+
+def _cached_patient_detail(patient_id):
+    """
+    (patient, comments) for the detail page, cached under the patient's version.
+    Media/comment/patient signals bump the version, see signals.py.
+    """
+    key = versioned_key(model_namespace(Patient, 'detail'), patient_id, scopes=(patient_scope(patient_id),))
+    detail = cache.get(key)
+    if detail is None:
+        patient = get_object_or_404(Patient.objects.select_related('group'), id=patient_id)
+        comments = list(
+            Comment.objects.filter(patient=patient)
+            .select_related('author', 'author__profile')
+            .order_by('created_at')
+        )
+        detail = (patient, comments)
+        cache.set(key, detail, PATIENT_DETAIL_TTL)
+    return detail
+
+
 @login_required
 def patient_image(request, patient_id):
-    patient = get_object_or_404(Patient, id=patient_id)
+    patient, comments = _cached_patient_detail(patient_id)
+    access = AccessEvaluator(request.user, patients=[patient])
 
-    if not _can_view_patient(request.user, patient):
+    if not access.can_view_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
+    can_edit = access.can_edit_patient(patient)
+
+    # Lazy querysets: only evaluated when the gallery fragments miss the cache
     models3d = Model3D.objects.filter(ptnID=patient).order_by('-id')
     images = Image.objects.filter(ptnID=patient)
     videos = patient.videos.all().order_by('-uploaded_at')
-    comments = Comment.objects.filter(patient=patient).select_related('author', 'author__profile').order_by('created_at')
+    # Thumbnails/posters still being made: the page polls patient_jobs and reloads
+    pending_jobs = Job.objects.filter(
+        patient=patient, status__in=(Job.Status.PENDING, Job.Status.RUNNING),
+    ).count()
 
     return render(request, 'patientImage.html', {
         'patient': patient,
         'images': images,
         'videos': videos,
         'comments': comments,
-        'can_comment': _can_view_patient(request.user, patient),
-        'models3d': models3d
+        'last_comment_id': comments[-1].id if comments else 0,
+        'can_comment': access.can_view_patient(patient),
+        'can_edit': can_edit,
+        'models3d': models3d,
+        'pending_jobs': pending_jobs,
+        # fragment cache key parts: patient version + permission class
+        'fragment_ttl': PATIENT_DETAIL_TTL,
+        'fragment_version': get_version(patient_scope(patient.id)),
+        'perm_class': 'edit' if can_edit else 'view',
     })
 
 
 @login_required
 def add_comment(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_view_patient(request.user, patient):
+    if not AccessEvaluator(request.user, patients=[patient]).can_view_patient(patient):
         return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
 
     if request.method != 'POST':
@@ -699,7 +771,7 @@ def add_comment(request, patient_id):
 @login_required
 def comments_feed(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_view_patient(request.user, patient):
+    if not AccessEvaluator(request.user, patients=[patient]).can_view_patient(patient):
         return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
 
     try:
@@ -733,24 +805,26 @@ def comments_feed(request, patient_id):
 @login_required
 def upload_images(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     if request.method == 'POST' and request.FILES.getlist('images'):
-        for file in request.FILES.getlist('images'):
-            Image.objects.create(
-                ptnID=patient,
-                usrID=request.user,
-                image=file,
-                imgDesc=''
-            )
+        # One commit for all rows; derivatives are made by the job queue (tasks.py)
+        with transaction.atomic():
+            for file in request.FILES.getlist('images'):
+                Image.objects.create(
+                    ptnID=patient,
+                    usrID=request.user,
+                    image=file,
+                    imgDesc=''
+                )
     return redirect('patientImage', patient_id=patient.id)
 
 
 @login_required
 def delete_images(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     if request.method == 'POST':
@@ -761,9 +835,9 @@ def delete_images(request, patient_id):
 
 @login_required
 def delete_single_image(request, image_id):
-    image = get_object_or_404(Image, id=image_id)
+    image = get_object_or_404(Image.objects.select_related('ptnID'), id=image_id)
     patient = image.ptnID
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     image.delete()
@@ -775,7 +849,7 @@ def delete_single_image(request, image_id):
 @login_required
 def delete_patient(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     group = patient.group
@@ -795,20 +869,75 @@ def delete_patient(request, patient_id):
 
 # ---------- Messaging / Settings ----------
 
+@login_required
+def user_search(request):
+    """Lazy user lookup for chat lists and share pickers, served from the cached directory."""
+    try:
+        limit = max(1, min(int(request.GET.get('limit', 50)), 500))
+    except ValueError:
+        limit = 50
+    query = request.GET.get('q', '')
+    if request.GET.get('sort') != 'recent':
+        users = search_users(query, exclude_id=request.user.id, limit=limit)
+        return JsonResponse({'ok': True, 'users': [u.as_dict() for u in users]})
+
+    # Chat list: conversation partners by last message, then everyone else
+    summaries = conversations.summaries_by_peer(request.user.id)
+    matches = search_users(query, exclude_id=request.user.id, limit=None)
+    recent = sorted((u for u in matches if u.id in summaries), key=lambda u: summaries[u.id][0], reverse=True)
+    others = [u for u in matches if u.id not in summaries]
+    payload = []
+    for u in (recent + others)[:limit]:
+        item = u.as_dict()
+        if u.id in summaries:
+            last_at, unread_count, text = summaries[u.id]
+            item.update(last_message=text[:80], last_message_at=last_at.isoformat(), unread=unread_count)
+        payload.append(item)
+    return JsonResponse({'ok': True, 'users': payload})
+
+
+@login_required
+def full_text_search(request):
+    """Ranked full-text search over the user's chat and group messages and the comments they may see."""
+    query = request.GET.get('q', '').strip()
+    kind = request.GET.get('kind', 'all')
+    if kind not in ('all', 'messages', 'groups', 'comments'):
+        return JsonResponse({'ok': False, 'error': 'Unbekannter Suchtyp.'}, status=400)
+    try:
+        page = max(int(request.GET.get('page', 1)), 1)
+        peer_id = int(request.GET['peer']) if request.GET.get('peer') else None
+        patient_id = int(request.GET['patient']) if request.GET.get('patient') else None
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'Ungültiger Parameter.'}, status=400)
+
+    payload = {'ok': True, 'q': query, 'page': page}
+    if kind in ('all', 'messages'):
+        results, has_more = search.search_messages(request.user, query, page, peer_id=peer_id)
+        payload['messages'] = {'results': results, 'has_more': has_more}
+    if kind in ('all', 'groups'):
+        results, has_more = search.search_group_messages(request.user, query, page)
+        payload['groups'] = {'results': results, 'has_more': has_more}
+    if kind in ('all', 'comments'):
+        results, has_more = search.search_comments(request.user, query, page, patient_id=patient_id)
+        payload['comments'] = {'results': results, 'has_more': has_more}
+    return JsonResponse(payload)
+
+
 @login_required
 def get_unread_message_count(request):
-    count = Message.objects.filter(receiver=request.user, is_read=False).count()
-    return JsonResponse({'unread_count': count})
+    return JsonResponse({'unread_count': unread.count(request.user.id)})
 
 
 @login_required
 def user_settings(request):
     avatar_nums = range(1, 15)
     user = request.user
-    profile, created = Profile.objects.get_or_create(user=user)
 
     if request.method == "POST":
-        profile = user.profile
+        # Write path: the row itself, not the cached copy on request.profile (which
+        # may be stale, or None when the user has no Profile yet)
+        profile, _ = Profile.objects.get_or_create(user=user)
+        user.profile = profile  # user.save() below re-saves user.profile (ensure_user_profile)
 
         # Basic fields
         user.username   = request.POST.get("username", user.username)
@@ -881,52 +1010,38 @@ def user_settings(request):
 @login_required
 def upload_videos(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     if request.method == 'POST' and request.FILES.getlist('videos'):
-        for f in request.FILES.getlist('videos'):
-            Video.objects.create(ptnID=patient, usrID=request.user, file=f, vidDesc='')
+        # Posters are extracted by the job queue (tasks.py)
+        with transaction.atomic():
+            for f in request.FILES.getlist('videos'):
+                Video.objects.create(ptnID=patient, usrID=request.user, file=f, vidDesc='')
     return redirect('patientImage', patient_id=patient.id)
 
 
 @login_required
 def delete_videos(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     if request.method == 'POST':
+        # Files are deleted by the job queue, retried while a player still holds them
         ids = request.POST.getlist('selected_videos')
-        videos = list(Video.objects.filter(id__in=ids, ptnID=patient))
-        warned=False
-        for v in videos:
-            try:
-                _safe_delete_file(getattr(v.file, 'path', ''))
-            except PermissionError:
-                if not warned:
-                    messages.warning(request, "Einige Videos werden im Hintergrund gelöscht, da sie noch verwendet werden.")
-                    warned=True
-                threading.Thread(target=_safe_delete_file, args=(getattr(v.file, 'path', ''), 30, 0.6), daemon=True).start()
         Video.objects.filter(id__in=ids, ptnID=patient).delete()
     return redirect('patientImage', patient_id=patient.id)
 
 
 @login_required
 def delete_single_video(request, video_id):
-    video = get_object_or_404(Video, id=video_id)
+    video = get_object_or_404(Video.objects.select_related('ptnID'), id=video_id)
     patient = video.ptnID
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
-    path = getattr(video.file, 'path', '')
-    try:
-        _safe_delete_file(path)
-    except PermissionError:
-        # try background cleanup, but still remove DB row to unblock UI
-        threading.Thread(target=_safe_delete_file, args=(path, 30, 0.6), daemon=True).start()
-        messages.warning(request, "Datei wird verwendet. Löschung wird erneut im Hintergrund versucht.")
-    video.delete()
+    video.delete()  # the file is deleted by the job queue
     return redirect('patientImage', patient_id=patient.id)
 
 
@@ -936,16 +1051,17 @@ def delete_single_video(request, video_id):
 @require_POST
 def upload_models(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     files = request.FILES.getlist('models')
-    for f in files:
-        name = (f.name or '').lower()
-        ctype = (f.content_type or '').lower()
-        if not (name.endswith('.stl') or 'model/stl' in ctype or 'application/sla' in ctype):
-            continue
-        Model3D.objects.create(ptnID=patient, usrID=request.user, file=f)
+    with transaction.atomic():
+        for f in files:
+            name = (f.name or '').lower()
+            ctype = (f.content_type or '').lower()
+            if not (name.endswith('.stl') or 'model/stl' in ctype or 'application/sla' in ctype):
+                continue
+            Model3D.objects.create(ptnID=patient, usrID=request.user, file=f)
 
     return redirect('patientImage', patient_id=patient.id)
 
@@ -954,7 +1070,7 @@ def upload_models(request, patient_id):
 @require_POST
 def delete_models(request, patient_id):
     patient = get_object_or_404(Patient, id=patient_id)
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     ids = request.POST.getlist('selected_models')
@@ -964,9 +1080,9 @@ def delete_models(request, patient_id):
 
 @login_required
 def delete_single_model(request, model_id):
-    m = get_object_or_404(Model3D, id=model_id)
+    m = get_object_or_404(Model3D.objects.select_related('ptnID'), id=model_id)
     patient = m.ptnID
-    if not _can_edit_patient(request.user, patient):
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
         return HttpResponseForbidden("Kein Zugriff")
 
     pid = patient.id
@@ -974,6 +1090,124 @@ def delete_single_model(request, model_id):
     return redirect('patientImage', patient_id=pid)
 
 
+@login_required
+def model_manifest(request, model_id):
+    """Level-of-detail meshes of a 3D model, coarse first, for the viewer (see lod.py)."""
+    m = get_object_or_404(Model3D.objects.select_related('ptnID'), id=model_id)
+    if not AccessEvaluator(request.user, patients=[m.ptnID]).can_view_patient(m.ptnID):
+        return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
+    return JsonResponse({'ok': True, **lod.manifest(m)})
+
+
+# ---------- Chunked uploads (videos, STL; see uploads.py) ----------
+
+def _upload_error(exc, session=None):
+    data = {'ok': False, 'error': str(exc)}
+    if session is not None:
+        data['offset'] = session.received
+    return JsonResponse(data, status=exc.status)
+
+
+def _own_upload_session(request, session_id):
+    """The session, if it belongs to the user and they may still edit the patient; else None."""
+    session = get_object_or_404(UploadSession.objects.select_related('patient', 'user'), id=session_id)
+    if session.user_id != request.user.id or not AccessEvaluator(request.user).can_edit_patient(session.patient):
+        return None
+    return session
+
+
+@login_required
+@require_POST
+def upload_session_start(request, patient_id):
+    patient = get_object_or_404(Patient, id=patient_id)
+    if not AccessEvaluator(request.user).can_edit_patient(patient):
+        return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'Ungültige Dateigröße.'}, status=400)
+    try:
+        session = uploads.start(
+            request.user, patient, request.POST.get('filename', ''), size, request.POST.get('content_type', ''),
+        )
+    except uploads.UploadError as exc:
+        return _upload_error(exc)
+    return JsonResponse({'ok': True, **uploads.status(session)}, status=201)
+
+
+@login_required
+@require_http_methods(['GET', 'PUT', 'DELETE'])
+def upload_session(request, session_id):
+    """GET: acknowledged offset to resume from. PUT ?offset=n: one chunk as the raw body. DELETE: abort."""
+    session = _own_upload_session(request, session_id)
+    if session is None:
+        return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
+
+    if request.method == 'DELETE':
+        session.delete()
+        return JsonResponse({'ok': True})
+    if request.method == 'PUT':
+        try:
+            offset = int(request.GET.get('offset', ''))
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+            crc = int(request.headers.get('X-Upload-CRC32', ''), 16)
+        except ValueError:
+            return JsonResponse({'ok': False, 'error': 'offset, Content-Length und X-Upload-CRC32 nötig.',
+                                 'offset': session.received}, status=400)
+        try:
+            # request.read() streams the body; request.body would load it whole
+            uploads.write_chunk(session, offset, request, length, crc)
+        except uploads.UploadError as exc:
+            return _upload_error(exc, session)
+    return JsonResponse({'ok': True, **uploads.status(session)})
+
+
+@login_required
+@require_POST
+def upload_session_complete(request, session_id):
+    session = _own_upload_session(request, session_id)
+    if session is None:
+        return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
+    # Required: without it a damaged partial file would be accepted unchecked
+    if not request.POST.get('crc32'):
+        return JsonResponse({'ok': False, 'error': 'Prüfsumme fehlt.', 'offset': session.received}, status=400)
+    try:
+        crc = int(request.POST['crc32'], 16)
+    except ValueError:
+        return JsonResponse({'ok': False, 'error': 'Ungültige Prüfsumme.', 'offset': session.received}, status=400)
+    try:
+        uploads.complete(session, crc)
+    except uploads.UploadError as exc:
+        return _upload_error(exc, session)
+    return JsonResponse({'ok': True, **uploads.status(session)})
+
+
+# ---------- Background jobs ----------
+
+@login_required
+def job_status(request, job_id):
+    job = get_object_or_404(Job.objects.select_related('patient'), id=job_id)
+    allowed = is_admin(request.user) or job.created_by_id == request.user.id
+    if not allowed and job.patient is not None:
+        allowed = AccessEvaluator(request.user, patients=[job.patient]).can_view_patient(job.patient)
+    if not allowed:
+        return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
+    return JsonResponse({'ok': True, 'job': jobs.status(job)})
+
+
+@login_required
+def patient_jobs(request, patient_id):
+    """Unfinished and failed media jobs of a patient, newest first."""
+    patient = get_object_or_404(Patient, id=patient_id)
+    if not AccessEvaluator(request.user, patients=[patient]).can_view_patient(patient):
+        return JsonResponse({'ok': False, 'error': 'Kein Zugriff'}, status=403)
+
+    qs = Job.objects.filter(patient=patient).exclude(status=Job.Status.DONE).order_by('-id')[:50]
+    items = [jobs.status(job) for job in qs]
+    pending = sum(item['status'] in (Job.Status.PENDING, Job.Status.RUNNING) for item in items)
+    return JsonResponse({'ok': True, 'pending': pending, 'jobs': items})
+
+
 # ---------- Feedback ----------
 
 @login_required
@@ -0,0 +1,165 @@
+# SmileHealth/visibility.py
+"""
+Maintenance of the PatientVisibility index.
+
+Rows are always recomputed per patient from the source tables (Patient,
+CaseGroup and both shared_with tables), so every signal handler only has to
+know *which* patients are affected. Migration 0008 carries a frozen copy of
+compute_rows for its backfill; changes to the rules here do not reach it.
+
+Whenever a refresh actually changes rows, the cache versions of the affected
+users (and of PUBLIC_ORG / admin views) are bumped so per-user cached data
+such as the index scope counters is invalidated.
+"""
+from django.apps import apps as global_apps
+from django.db import transaction
+
+from . import cache
+
+REASON_OWNER = "OWNER"
+REASON_PUBLIC_ORG = "PUBLIC_ORG"
+REASON_SHARED = "SHARED"
+REASON_GROUP_OWNER = "GROUP_OWNER"
+REASON_GROUP_SHARED = "GROUP_SHARED"
+
+BATCH_SIZE = 500
+
+# Cache scopes: per user, everything PUBLIC_ORG, and everything (admins)
+PUBLIC_SCOPE = "patients:public"
+ALL_SCOPE = "patients:all"
+
+
+def user_scope(user_id):
+    return f"patients:user:{user_id}"
+
+
+def cache_scopes(user):
+    """Cache scopes whose version must be part of any per-user visibility-derived key."""
+    if user.is_superuser or user.is_staff:
+        return (ALL_SCOPE,)
+    return (user_scope(user.id), PUBLIC_SCOPE)
+
+
+def invalidate(user_ids, public=False):
+    """Bump the cache versions of the given users once the transaction commits."""
+    scopes = [user_scope(uid) for uid in set(user_ids) if uid]
+    if public:
+        scopes.append(PUBLIC_SCOPE)
+    scopes.append(ALL_SCOPE)
+    transaction.on_commit(lambda: cache.bump(*scopes))
+
+
+def _models():
+    return (
+        global_apps.get_model("SmileHealth", "Patient"),
+        global_apps.get_model("SmileHealth", "CaseGroup"),
+        global_apps.get_model("SmileHealth", "PatientVisibility"),
+    )
+
+
+def compute_rows(patient_ids=None):
+    """
+    Yield (user_id, patient_id, reason) tuples for the given patients
+    (all patients when patient_ids is None). Runs a constant number of queries.
+    """
+    Patient, CaseGroup, _ = _models()
+
+    patients = Patient.objects.all()
+    if patient_ids is not None:
+        patients = patients.filter(pk__in=list(patient_ids))
+    rows = list(patients.values_list(
+        "id", "usrID_id", "visibility", "group_id",
+        "group__created_by_id", "group__visibility",
+    ))
+    if not rows:
+        return
+
+    ids = [r[0] for r in rows]
+    patient_shares = {}
+    for pid, uid in Patient.shared_with.through.objects.filter(patient_id__in=ids) \
+            .values_list("patient_id", "user_id"):
+        patient_shares.setdefault(pid, []).append(uid)
+
+    group_ids = {r[3] for r in rows if r[3]}
+    group_shares = {}
+    if group_ids:
+        for gid, uid in CaseGroup.shared_with.through.objects.filter(casegroup_id__in=group_ids) \
+                .values_list("casegroup_id", "user_id"):
+            group_shares.setdefault(gid, []).append(uid)
+
+    for pid, owner_id, visibility, group_id, group_owner_id, group_visibility in rows:
+        if group_id:
+            # Grouped cases are governed by their group's visibility only
+            yield (group_owner_id, pid, REASON_GROUP_OWNER)
+            if group_visibility == "SHARED":
+                for uid in group_shares.get(group_id, ()):
+                    yield (uid, pid, REASON_GROUP_SHARED)
+            continue
+
+        yield (owner_id, pid, REASON_OWNER)
+        if visibility == "PUBLIC_ORG":
+            yield (None, pid, REASON_PUBLIC_ORG)
+        elif visibility == "SHARED":
+            for uid in patient_shares.get(pid, ()):
+                yield (uid, pid, REASON_SHARED)
+
+
+def refresh_patients(patient_ids):
+    """Recompute the index rows of the given patients."""
+    patient_ids = list({pid for pid in patient_ids if pid})
+    if not patient_ids:
+        return
+    _, _, PatientVisibility = _models()
+
+    changed = set()
+    with transaction.atomic():
+        for start in range(0, len(patient_ids), BATCH_SIZE):
+            chunk = patient_ids[start:start + BATCH_SIZE]
+            existing = PatientVisibility.objects.filter(patient_id__in=chunk)
+            old_rows = set(existing.values_list("user_id", "patient_id", "reason"))
+            new_rows = set(compute_rows(chunk))
+            if old_rows == new_rows:
+                continue
+            existing.delete()
+            PatientVisibility.objects.bulk_create([
+                PatientVisibility(user_id=uid, patient_id=pid, reason=reason)
+                for uid, pid, reason in new_rows
+            ], batch_size=BATCH_SIZE)
+            changed |= old_rows ^ new_rows
+
+    if changed:
+        invalidate((uid for uid, _, _ in changed), public=any(uid is None for uid, _, _ in changed))
+
+
+def refresh_groups(group_ids):
+    """Recompute the index rows of every patient in the given case groups."""
+    group_ids = [gid for gid in group_ids if gid]
+    if not group_ids:
+        return
+    Patient, _, _ = _models()
+    refresh_patients(Patient.objects.filter(group_id__in=group_ids).values_list("id", flat=True))
+
+
+def rebuild():
+    """Drop and recompute the whole index. Returns the number of rows written."""
+    Patient, _, PatientVisibility = _models()
+    with transaction.atomic():
+        PatientVisibility.objects.all().delete()
+        ids = list(Patient.objects.values_list("id", flat=True))
+        refresh_patients(ids)
+    return PatientVisibility.objects.count()
+
+
+def verify(users):
+    """
+    Compare Patient.objects.visible_to (index) against visible_to_by_rules for
+    each user. Returns a list of (user, missing_ids, extra_ids) mismatches.
+    """
+    Patient, _, _ = _models()
+    mismatches = []
+    for user in users:
+        expected = set(Patient.objects.visible_to_by_rules(user).values_list("id", flat=True))
+        actual = set(Patient.objects.visible_to(user).values_list("id", flat=True))
+        if expected != actual:
+            mismatches.append((user, sorted(expected - actual), sorted(actual - expected)))
+    return mismatches